@@ -0,0 +1,1004 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date, datetime, timedelta
+from collections import namedtuple
+import os
+import json
+import logging
+import tempfile
+import time
+from urlparse import urlparse
+import fcntl
+from urllib2 import HTTPError
+from fetcher import TokenBucket, HostLimiter, FetchPool, HTTPClient
+from fetcher import CircuitBreaker, CircuitOpenError, FETCH_ERRORS
+from fetcher import is_transient, backoff_delay
+import fetchplan
+from instrument import Stats
+from checkpoint import Checkpoint
+
+# NumPy, through columnar, is imported only by the methods that use the
+# binary cache, so cache only runs start quickly
+
+CACHE_INDEX_VERSION = 1
+
+CACHE_STATE_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+# one parsed cache row, its fields as columnar.FIELDS. A tuple, so no per
+# row dict or instance state
+CacheRow = namedtuple('CacheRow', ('date', 'open_val', 'high', 'low', 'close',
+                                   'volume', 'adj_close'))
+
+# a stock as listed in a symbols file
+ListedStock = namedtuple('ListedStock', ('symbol', 'name', 'market'))
+
+class StockCache(object):
+    """The per symbol cache files: fetching, merging and deduping
+    them, with no db. Run on its own, the stocks are those listed in
+    settings.symbols_files, and the date each stock's cache was brought
+    up to is kept in a state file in the cache dir, so a fetch node
+    needs no db credentials. StockCollection builds on it to load the
+    caches into the db.
+
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.listed_stocks = None
+        self.stats = Stats(self.settings.profile_stage)
+        self.host_limiter = HostLimiter(self.settings.fetch_per_host_limit)
+        self.breaker = CircuitBreaker(self.settings.fetch_breaker_threshold,
+                                      self.settings.fetch_breaker_reset)
+        self.fetch_errors = {}
+        self.http = HTTPClient(self.settings.http_connect_timeout,
+                               self.settings.http_read_timeout,
+                               self.settings.http_gzip)
+        if self.settings.fetch_rate:
+            self.rate_limiter = TokenBucket(self.settings.fetch_rate,
+                                            self.settings.fetch_burst)
+        else: self.rate_limiter = None
+
+    @property
+    def stocks(self):
+        """The stocks listed in settings.symbols_files, read on first use.
+
+        """
+        if self.listed_stocks is None:
+            self.listed_stocks = [ListedStock(*row)
+                                  for row in self.read_symbols(self.settings)]
+        return self.listed_stocks
+
+    def validate_symbol(self, symbol):
+        if "." in symbol:
+            # some stocks with . in name cannot be looked up UGLYHACK
+            return [symbol, False]
+        if "-" in symbol:
+            [lhs, rhs] = symbol.split("-")
+            cleaned_symbol = lhs + "-P" + rhs
+            # UGLYHACK the url doesn't work and y! has no data for
+            # this stock even after fixing the symbol
+            return [cleaned_symbol, False]
+        else:
+            return [symbol, True]
+
+    def read_symbols(self, settings):
+        """Reads the symbols files, dropping symbols that don't validate.
+
+        Returns a (symbol, name, market) tuple per stock.
+        """
+        rows = []
+        for symbols_file in settings.symbols_files:
+            input_file = open(symbols_file[u'file'])
+            market = symbols_file[u'name']
+            lines = iter(input_file)
+            lines.next()
+            for line in lines:
+                [symbol, name] = line.split(u"\t")
+                [symbol,  symbol_is_valid] = self.validate_symbol(symbol)
+                if symbol_is_valid:
+                    if name[:-2] == "": name=None
+                    else: name=unicode(name[:-2])
+                    rows.append((unicode(symbol), name, unicode(market)))
+                else:
+                    # discarding symbol, couldn't validate
+                    pass
+            input_file.close()
+        return rows
+
+    def update_cache(self, start_date=None, end_date=None, failed_only=False):
+        """Brings the cache files of the listed stocks up to date,
+        saving in the state file the date each stock was updated to.
+        Only one process should update a cache dir at a time. With
+        failed_only, only the stocks in the failure ledger are fetched.
+        An interrupted run is resumed, see open_checkpoint.
+
+        Returns the http client's request, connection and byte counters,
+        bytes_wire being body bytes as received and bytes_decoded the
+        same after gunzipping.
+        """
+        if not start_date: start_date = self.settings.start_date
+        if not end_date: end_date = self.settings.today
+        state = self.read_state()
+        stocks = self.stocks
+        if failed_only: stocks = self.select_failed(stocks)
+        jobs = [(stock.symbol, stock.market,
+                 state.get(self.get_state_key(stock.symbol, stock.market)))
+                for stock in stocks]
+        checkpoint = self.open_checkpoint(u"update_cache", start_date, end_date,
+                                          failed_only)
+        results = self.refresh_caches(jobs, start_date, end_date,
+                                      checkpoint=checkpoint)
+        for [symbol, market, last_cache_update], num_appended in zip(jobs, results):
+            if num_appended is not False:
+                state[self.get_state_key(symbol, market)] = end_date
+        self.write_state(state)
+        if checkpoint: checkpoint.finish()
+        return self.http.stats()
+
+    def refresh_caches(self, jobs, start_date, end_date, lease=None,
+                       checkpoint=None):
+        """Takes (symbol, market, last_cache_update) jobs and fetches,
+        on settings.fetch_workers threads, what each cache file lacks
+        from start_date to end_date. Changed files are deduped and, with
+        settings.binary_cache on, converted. Jobs not yet started when
+        the workqueue.Lease given is lost are skipped. Missing cache files
+        are created. Jobs done in
+        checkpoint count as done with nothing appended, and successful
+        ones are marked in it.
+
+        The failure ledger is updated with the jobs that failed and
+        those that succeeded.
+
+        Returns per job the number of rows appended, False if the
+        fetch failed or was skipped.
+        """
+        def refresh(job):
+            [symbol, market, last_cache_update] = job
+            key = self.get_state_key(symbol, market)
+            if lease and lease.lost: return False
+            if checkpoint and key in checkpoint: return 0
+            self.ensure_cache_file_exists(symbol, market)
+            num_appended = self.fetch_missing(symbol, market, start_date, end_date,
+                                              last_cache_update)
+            if num_appended: self.dedupe(symbol, market)
+            if self.settings.binary_cache and (num_appended or not os.path.exists(
+                    self.get_binary_cache_file_path(symbol, market))):
+                with self.stats.stage('convert'):
+                    self.convert_cache_file(symbol, market)
+            if checkpoint and num_appended is not False: checkpoint.mark(key)
+            return num_appended
+
+        pool = FetchPool(self.settings.fetch_workers)
+        try:
+            results = pool.map(refresh, jobs)
+        finally:
+            self.http.close()
+        failed = {}
+        succeeded = []
+        for [symbol, market, last_cache_update], result in zip(jobs, results):
+            key = self.get_state_key(symbol, market)
+            if result is not False: succeeded.append(key)
+            elif key in self.fetch_errors: failed[key] = self.fetch_errors[key]
+        self.update_failures(failed, succeeded)
+        return results
+
+    def update_cache_shards(self, queue, worker=None, start_date=None,
+                            end_date=None):
+        """Claims shards of the listed stocks from queue, a workqueue
+        FileLeaseQueue or DBLeaseQueue, and brings their cache files up
+        to date, until every shard is done for the round ending at
+        end_date. Several workers, sharing the cache dir, can run this
+        at once; each stock is fetched by one of them. The state file
+        is left alone, the cache index recording what was fetched.
+
+        Returns the shards this worker completed.
+        """
+        # imported here so update_cache doesn't pay for SQLAlchemy
+        import workqueue
+        if not start_date: start_date = self.settings.start_date
+        if not end_date: end_date = self.settings.today
+        if not worker: worker = workqueue.default_worker_id()
+        num_shards = self.settings.fetch_shards
+        lease_seconds = self.settings.fetch_lease_seconds
+        round_id = end_date.isoformat()
+        shards = {}
+        for stock in self.stocks:
+            shard = workqueue.shard_of(stock.symbol, stock.market, num_shards)
+            shards.setdefault(shard, []).append(stock)
+        completed = []
+        while True:
+            shard = queue.claim(round_id, num_shards, worker, lease_seconds)
+            if shard is None: break
+            lease = workqueue.Lease(queue, round_id, shard, worker, lease_seconds)
+            try:
+                for stock in shards.get(shard, []):
+                    self.ensure_cache_file_exists(stock.symbol, stock.market)
+                self.refresh_caches([(stock.symbol, stock.market, None)
+                                     for stock in shards.get(shard, [])],
+                                    start_date, end_date, lease)
+            except:
+                # left to lapse for another worker to retry
+                lease.release(complete=False)
+                raise
+            if lease.release(): completed.append(shard)
+        return completed
+
+    def get_state_path(self):
+        return self.settings.cache_dir + "/state.json"
+
+    def get_state_key(self, symbol, market):
+        return market + u"_" + symbol
+
+    def read_state(self):
+        """Returns the date each stock's cache was last brought up to
+        by update_cache, keyed by get_state_key.
+
+        """
+        path = self.get_state_path()
+        if not os.path.exists(path): return {}
+        state_file = open(path)
+        try:
+            state = json.load(state_file)
+        finally:
+            state_file.close()
+        if state.get('version') != CACHE_STATE_VERSION: return {}
+        return dict((key, self.parse_iso_date(day))
+                    for key, day in state['last_cache_update'].items())
+
+    def write_state(self, last_cache_updates):
+        """Writes the state file through a temp file and rename.
+
+        """
+        path = self.get_state_path()
+        temp_path = path + ".tmp"
+        state_file = open(temp_path, 'w')
+        try:
+            json.dump({'version': CACHE_STATE_VERSION,
+                       'last_cache_update': dict((key, day.isoformat()) for key, day
+                                                 in last_cache_updates.items())},
+                      state_file, sort_keys=True)
+        finally:
+            state_file.close()
+        os.rename(temp_path, path)
+
+    def open_checkpoint(self, *run):
+        """Returns the Checkpoint of the run named by run, resuming the
+        one left by an interrupted run of the same name, or None if
+        settings.checkpoint_runs is off.
+
+        """
+        if not self.settings.checkpoint_runs: return None
+        run_id = u" ".join([unicode(part) for part in run])
+        return Checkpoint(self.get_checkpoint_path(), run_id)
+
+    def get_checkpoint_path(self):
+        return self.settings.cache_dir + "/checkpoint.log"
+
+    def get_failures_path(self):
+        return self.settings.cache_dir + "/failures.json"
+
+    def read_failures(self):
+        """Returns the failure ledger: per stock, keyed by get_state_key,
+        whose last fetch failed, a dict of the 'error', the number of
+        'runs' it has failed in a row and when it 'last_failed'.
+
+        """
+        path = self.get_failures_path()
+        if not os.path.exists(path): return {}
+        ledger_file = open(path)
+        try:
+            return json.load(ledger_file)
+        finally:
+            ledger_file.close()
+
+    def update_failures(self, failed, succeeded):
+        """Adds to the failure ledger the stocks in failed, a dict of
+        error messages by get_state_key, and removes those in succeeded.
+        Updates are made under an flock, so workers sharing the cache
+        dir can update the ledger at once.
+
+        """
+        if not (failed or succeeded): return
+        path = self.get_failures_path()
+        lock_file = open(path + ".lock", 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            ledger = self.read_failures()
+            for key in succeeded: ledger.pop(key, None)
+            now = datetime.utcnow().isoformat()
+            for key, error in failed.items():
+                runs = ledger.get(key, {}).get('runs', 0) + 1
+                ledger[key] = {'error': error, 'runs': runs, 'last_failed': now}
+            ledger_file = open(path + ".tmp", 'w')
+            try:
+                json.dump(ledger, ledger_file, indent=2, sort_keys=True)
+            finally:
+                ledger_file.close()
+            os.rename(path + ".tmp", path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def select_failed(self, stocks):
+        """Returns those of stocks in the failure ledger.
+
+        """
+        failures = self.read_failures()
+        return [stock for stock in stocks
+                if self.get_state_key(stock.symbol, stock.market) in failures]
+
+    def run_report(self):
+        """Returns the run statistics gathered since the last
+        stats.reset(), see instrument.Stats.report, with the http
+        client's counters under 'http'.
+
+        """
+        report = self.stats.report()
+        report['http'] = self.http.stats()
+        return report
+
+    def parse_csv_line(self, line):
+        """Takes as input a line of text formatted like
+        from Yahoo finance. Example:
+        2011-11-14,63.44,63.54,62.93,63.05,6832800,63.05
+
+        Returns a dict with the parsed values.
+
+        """
+        return dict(zip(CacheRow._fields, self.parse_csv_row(line)))
+
+    def parse_csv_row(self, line):
+        """Parses a line as parse_csv_line does.
+
+        Returns a CacheRow.
+        """
+        def dollah_to_cents(s):
+            [lhs, rhs] = s.split(".")
+            return (int(lhs)*100)+int(rhs)
+        vals = line.split(",")
+        return CacheRow(date(year=int(vals[0][:4]),
+                             month=int(vals[0][5:7]),
+                             day=int(vals[0][-2:])),
+                        dollah_to_cents(vals[1]),
+                        dollah_to_cents(vals[2]),
+                        dollah_to_cents(vals[3]),
+                        dollah_to_cents(vals[4]),
+                        int(vals[5]),
+                        dollah_to_cents(vals[6]))
+
+    def iter_cache_rows(self, symbol, market, start_date, end_date,
+                        date_sorted=False, offset=0):
+        """Yields as CacheRows the rows of the cache file dated from start_date
+        to end_date inclusive, reading the file one line at a time
+        from byte offset. Rows outside the range are skipped on their
+        date text, without being parsed.
+
+        If date_sorted is set the file is taken to be in ascending
+        date order and reading stops at the first row after end_date.
+        """
+        first_day = start_date.isoformat()
+        last_day = end_date.isoformat()
+        cache_file = open(self.get_cache_file_path(symbol, market))
+        cache_file.seek(offset)
+        try:
+            for line in cache_file:
+                line = line.rstrip("\n")
+                if line == "": continue
+                day = line[:10]
+                if day < first_day: continue
+                if day > last_day:
+                    if date_sorted: break
+                    continue
+                yield self.parse_csv_row(line)
+        finally:
+            cache_file.close()
+
+    def ensure_cache_file_exists(self, symbol, market):
+        if not os.path.exists(self.get_cache_file_path(symbol, market)):
+            _ = open(self.get_cache_file_path(symbol, market), 'w').close()
+        try:
+            _ = open(self.get_cache_file_path(symbol, market), mode='r')
+        except IOError:
+            _ = open(self.get_cache_file_path(symbol, market), mode='a')
+
+    def get_cache_file_path(self, symbol, market):
+        return self.settings.cache_dir+"/"\
+               + market + u"_" + symbol + u".csv"
+
+    def get_cache_index_path(self, symbol, market):
+        return self.settings.cache_dir+"/"\
+               + market + u"_" + symbol + u".idx"
+
+    def get_cache_index(self, symbol, market):
+        """Returns the index of the cache file: its row count, first and
+        last dates, the byte offset of the first row of each month, the
+        gaps of more than settings.cache_gap_days between consecutive
+        rows, the date ranges fetched so far, and under 'restate' whether
+        the file was rebuilt for readjusted prices since the last load.
+        The index is read from its sidecar file, or rebuilt if that is
+        missing or does not match the cache file's size and mtime.
+
+        """
+        stat = os.stat(self.get_cache_file_path(symbol, market))
+        try:
+            index_file = open(self.get_cache_index_path(symbol, market))
+            try:
+                index = json.load(index_file)
+            finally:
+                index_file.close()
+            if index['version'] == CACHE_INDEX_VERSION and\
+               index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+        return self.index_cache_file(symbol, market)
+
+    def read_stale_index(self, symbol, market):
+        """Returns the sidecar index file's contents, whether or not the
+        index is current, or an empty dict if it can't be read.
+
+        """
+        try:
+            index_file = open(self.get_cache_index_path(symbol, market))
+            try:
+                return json.load(index_file)
+            finally:
+                index_file.close()
+        except (IOError, ValueError):
+            return {}
+
+    def index_cache_file(self, symbol, market):
+        """Scans the cache file and writes its index. A file found out
+        of date order, as written before files were kept sorted, is
+        sorted first.
+
+        Returns the index.
+        """
+        path = self.get_cache_file_path(symbol, market)
+        self.repair_cache_tail(path)
+        index = self.scan_cache_file(path)
+        if index is None:
+            cache_file = open(path)
+            lines = [line for line in cache_file if line.strip()]
+            cache_file.close()
+            lines.sort(key=lambda line: line[:10])
+            self.replace_cache_file(path, lines)
+            index = self.scan_cache_file(path)
+        # what was fetched, and whether the datapoints need restating,
+        # can't be told from the cache file
+        stale = self.read_stale_index(symbol, market)
+        index['fetched'] = stale.get('fetched', [])
+        index['restate'] = stale.get('restate', False)
+        self.write_cache_index(symbol, market, index)
+        return index
+
+    def repair_cache_tail(self, path):
+        """Cuts off the cache file a last row torn by a crash part way
+        through an append. Rows end in a newline, so anything after the
+        last one is torn, as is anything from a line holding the NUL
+        bytes a crash can leave in blocks not yet written.
+
+        Returns number of bytes cut.
+        """
+        size = os.path.getsize(path)
+        if not size: return 0
+        cache_file = open(path, 'rb+')
+        try:
+            start = max(0, size - 65536)
+            cache_file.seek(start)
+            tail = cache_file.read()
+            cut = tail.rfind("\n") + 1
+            nul = tail.find("\0")
+            if nul != -1: cut = min(cut, tail.rfind("\n", 0, nul) + 1)
+            if start + cut == size: return 0
+            cache_file.truncate(start + cut)
+        finally:
+            cache_file.close()
+        log.warning(u"cut a torn row of %s bytes off %s", size - start - cut, path)
+        return size - start - cut
+
+    def scan_cache_file(self, path):
+        """Builds the index of the cache file at path.
+        Returns None if the file is not in date order.
+
+        """
+        index = {'version': CACHE_INDEX_VERSION, 'rows': 0, 'min_date': None,
+                 'max_date': None, 'months': {}, 'gaps': [], 'fetched': [],
+                 'restate': False}
+        offset = 0
+        cache_file = open(path)
+        try:
+            for line in cache_file:
+                day = line[:10]
+                if line.strip():
+                    if index['max_date'] and day < index['max_date']: return None
+                    if day[:7] not in index['months']: index['months'][day[:7]] = offset
+                    if not index['min_date']: index['min_date'] = day
+                    self.note_cache_gap(index, day)
+                    index['max_date'] = day
+                    index['rows'] += 1
+                offset += len(line)
+        finally:
+            cache_file.close()
+        return index
+
+    def note_cache_gap(self, index, day):
+        """Records a gap in the index if day, the date of a row about to
+        follow the last indexed row, is more than settings.cache_gap_days
+        after it.
+
+        """
+        if not index['max_date']: return
+        last = self.parse_iso_date(index['max_date'])
+        if (self.parse_iso_date(day) - last).days > self.settings.cache_gap_days:
+            index['gaps'].append([index['max_date'], day])
+
+    def write_cache_index(self, symbol, market, index):
+        """Stamps the index with the cache file's size and mtime and
+        writes it to the sidecar file.
+
+        """
+        stat = os.stat(self.get_cache_file_path(symbol, market))
+        index['size'] = stat.st_size
+        index['mtime'] = stat.st_mtime
+        index_path = self.get_cache_index_path(symbol, market)
+        index_file = open(index_path + ".tmp", 'w')
+        json.dump(index, index_file)
+        index_file.close()
+        os.rename(index_path + ".tmp", index_path)
+
+    def get_cache_offset(self, index, start_date):
+        """Returns the byte offset in the cache file to read from to
+        find rows dated start_date or later, None if there are none.
+
+        """
+        month = start_date.isoformat()[:7]
+        months = [m for m in index['months'] if m >= month]
+        if not months or index['max_date'] < start_date.isoformat(): return None
+        return index['months'][min(months)]
+
+    def missing_date_ranges(self, symbol, market, start_date, end_date,
+                            last_cache_update=None):
+        """Plans the fetches needed to cache start_date to end_date.
+        Covered are the dates from the first cached row up to the later
+        of the last cached row and last_cache_update, less the gaps
+        between rows, plus the ranges recorded as fetched before.
+        Missing ranges no more than settings.fetch_merge_days apart are
+        merged into one.
+
+        Returns a list of [start, end] date ranges to fetch.
+        """
+        index = self.get_cache_index(symbol, market)
+        covered = [[self.parse_iso_date(first), self.parse_iso_date(last)]
+                   for [first, last] in index['fetched']]
+        if index['rows']:
+            first = self.parse_iso_date(index['min_date'])
+            last = self.parse_iso_date(index['max_date'])
+            if last_cache_update and last_cache_update > last: last = last_cache_update
+            holes = [[self.parse_iso_date(before) + timedelta(days=1),
+                      self.parse_iso_date(after) - timedelta(days=1)]
+                     for [before, after] in index['gaps']]
+            covered.extend(fetchplan.subtract(first, last, holes))
+        elif last_cache_update:
+            covered.append([self.settings.start_date, last_cache_update])
+        return fetchplan.plan_fetches(start_date, end_date, covered,
+                                      self.settings.fetch_merge_days)
+
+    def record_fetched_range(self, symbol, market, start_date, end_date):
+        """Adds a successfully fetched date range to the cache file's index.
+
+        """
+        index = self.get_cache_index(symbol, market)
+        ranges = [[self.parse_iso_date(first), self.parse_iso_date(last)]
+                  for [first, last] in index['fetched']]
+        ranges.append([start_date, end_date])
+        index['fetched'] = [[first.isoformat(), last.isoformat()]
+                            for [first, last] in fetchplan.union(ranges)]
+        self.write_cache_index(symbol, market, index)
+
+    def parse_iso_date(self, s):
+        return date(year=int(s[:4]), month=int(s[5:7]), day=int(s[8:10]))
+
+    def append_cache_rows(self, symbol, market, lines):
+        """Adds csv rows, in any order, to the cache file keeping it in
+        date order, and updates its index. Rows dated after the last
+        cached date are appended; otherwise the file is merged and
+        rewritten. Rows already cached are not dropped; that is left to
+        dedupe. Rows dated the same as a cached row go after it.
+
+        Returns number of rows added.
+        """
+        lines = sorted([str(line) for line in lines if line.strip()],
+                       key=lambda line: line[:10])
+        if not lines: return 0
+        path = self.get_cache_file_path(symbol, market)
+        index = self.get_cache_index(symbol, market)
+        if index['rows'] and lines[0][:10] <= index['max_date']:
+            cache_file = open(path)
+            merged = [line.rstrip("\n") + "\n" for line in cache_file if line.strip()]
+            cache_file.close()
+            merged.extend([line + "\n" for line in lines])
+            merged.sort(key=lambda line: line[:10])
+            self.replace_cache_file(path, merged)
+            self.index_cache_file(symbol, market)
+            return len(lines)
+        offset = os.path.getsize(path)
+        cache_file = open(path, 'a')
+        for line in lines:
+            if line[:7] not in index['months']: index['months'][line[:7]] = offset
+            self.note_cache_gap(index, line[:10])
+            index['max_date'] = line[:10]
+            cache_file.write(line + "\n")
+            offset += len(line) + 1
+        cache_file.flush()
+        # durable before the index says so
+        os.fsync(cache_file.fileno())
+        cache_file.close()
+        if not index['min_date']: index['min_date'] = lines[0][:10]
+        index['rows'] += len(lines)
+        self.write_cache_index(symbol, market, index)
+        return len(lines)
+
+    def replace_cache_file(self, path, lines):
+        """Writes lines to a temp file beside path and renames it over path.
+
+        """
+        temp_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path) or ".",
+            prefix="." + os.path.basename(path) + ".", delete=False)
+        try:
+            temp_file.writelines(lines)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+            temp_file.close()
+        except:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+        os.rename(temp_file.name, path)
+
+    def get_binary_cache_file_path(self, symbol, market):
+        return self.settings.cache_dir+"/"\
+               + market + u"_" + symbol + u".bin"
+
+    def convert_cache_file(self, symbol, market):
+        """Writes the binary cache file for the symbol from its csv
+        cache file. Where the csv holds several rows for a date, the
+        first one is kept, as loading from the csv does.
+
+        Returns number of records written.
+        """
+        import columnar
+        cache_file = open(self.get_cache_file_path(symbol, market))
+        columns = columnar.parse_csv(cache_file.read())
+        cache_file.close()
+        records = columnar.to_records(columns)
+        columnar.write_records(self.get_binary_cache_file_path(symbol, market), records)
+        return len(records)
+
+    def convert_cache(self):
+        """Builds binary cache files for all stocks from their csv caches,
+        for migrating an existing cache to settings.binary_cache.
+
+        Returns number of records written.
+        """
+        return sum([self.convert_cache_file(stock.symbol, stock.market)
+                    for stock in self.stocks])
+
+    def read_cache_slice(self, symbol, market, start_date, end_date):
+        """Returns the records dated start_date to end_date inclusive
+        from the binary cache file, as a view onto the memory mapped file.
+        Returns None if there is no binary cache file or it is older
+        than the csv cache file.
+
+        """
+        binary_path = self.get_binary_cache_file_path(symbol, market)
+        if not os.path.exists(binary_path): return None
+        path = self.get_cache_file_path(symbol, market)
+        if os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(binary_path):
+            return None
+        import columnar
+        records = columnar.open_records(binary_path)
+        return columnar.date_slice(records, start_date, end_date)
+
+    def log_report(self):
+        """Logs the run report as json, and writes the profile of
+        settings.profile_stage to settings.profile_file if there is one.
+
+        Returns the run report.
+        """
+        report = self.run_report()
+        log.info(u"run report: %s", json.dumps(report, sort_keys=True))
+        if self.stats.dump_profile(self.settings.profile_file):
+            log.info(u"profile of stage %s written to %s",
+                     self.settings.profile_stage, self.settings.profile_file)
+        return report
+
+    def compose_yahoo_url(self, symbol, startdate, enddate):
+        a = unicode(startdate.month - 1)
+        b = unicode(startdate.day)
+        c = unicode(startdate.year)
+        d = unicode(enddate.month - 1)
+        e = unicode(enddate.day)
+        f = unicode(enddate.year)
+        url = self.settings.yahoo_url + u"?s=" +\
+              symbol + "&a=" + \
+              a + "&b=" + b + "&c=" + c + "&d=" + \
+              d + "&e=" + e + "&f=" + f + "&g=d&ignore=.csv"
+        return url
+
+    def fetch_missing(self, symbol, market, start_date, end_date,
+                      last_cache_update=None):
+        """Fetches the parts of the date range missing from the cache
+        file, as planned by missing_date_ranges. The days of
+        get_adjustment_window are fetched again along with them; if
+        their adjustment factor has changed, the cache file is rebuilt
+        instead, see rebuild_cache_file.
+
+        Returns False in case of failure, number of rows appended if success.
+        """
+        self.fetch_errors.pop(self.get_state_key(symbol, market), None)
+        plan = self.missing_date_ranges(symbol, market, start_date, end_date,
+                                        last_cache_update)
+        window = self.get_adjustment_window(symbol, market, plan)
+        if window: plan = fetchplan.union(plan + [window])
+        num_appended = 0
+        for [first, last] in plan:
+            lines = self.fetch_rows(symbol, market, first, last)
+            if lines is False: return False
+            if window and first <= window[1] and last >= window[0]:
+                cached = self.read_window_rows(symbol, market, window)
+                if self.adjustment_changed(lines, cached):
+                    return self.rebuild_cache_file(symbol, market, start_date, end_date)
+                # only the dates cached already; a hole in the cache may
+                # end inside the window
+                cached_dates = set(d.isoformat() for d in cached)
+                lines = [line for line in lines if line[:10] not in cached_dates]
+            num_appended += self.add_fetched_rows(symbol, market, first, last, lines)
+        return num_appended
+
+    def fetch_date_range(self, symbol, market, start_date, end_date):
+        """Fetches the csv for the symbol and date range and adds it
+        to the cache file with no respect for dupes.
+
+        Returns False in case of failure, number of rows appended if success.
+        """
+        lines = self.fetch_rows(symbol, market, start_date, end_date)
+        if lines is False: return False
+        return self.add_fetched_rows(symbol, market, start_date, end_date, lines)
+
+    def fetch_rows(self, symbol, market, start_date, end_date):
+        """Fetches the csv for the symbol and date range. Failures, malformed
+        rows included, are kept in fetch_errors, keyed by get_state_key,
+        for the failure ledger.
+
+        Returns its rows, without the header, False in case of failure.
+        """
+        url = self.compose_yahoo_url(symbol, start_date, end_date)
+        try:
+            data = self.fetch_url(url, symbol)
+            lines = data.split("\n")[1:-1]
+            self.check_fetched_rows(lines)
+        except FETCH_ERRORS + (ValueError,), e:
+            self.stats.count(symbol, 'fetch_failed')
+            self.fetch_errors[self.get_state_key(symbol, market)] = \
+                u"%s: %s" % (e.__class__.__name__, e)
+            return False
+        self.stats.count(symbol, 'fetched', len(lines))
+        return lines
+
+    def check_fetched_rows(self, lines):
+        """Raises ValueError on the first of the fetched lines that
+        parse_csv_row cannot read, so malformed rows never reach the
+        cache file.
+
+        """
+        for line in lines:
+            if not line.strip(): continue
+            try:
+                self.parse_csv_row(line)
+            except (ValueError, IndexError):
+                raise ValueError(u"malformed row %r" % line)
+
+    def add_fetched_rows(self, symbol, market, start_date, end_date, lines):
+        """Adds rows fetched for the date range to the cache file with no
+        respect for dupes, and records the range as fetched. Safe to call
+        from several threads as long as each handles its own symbol.
+
+        Returns number of rows appended.
+        """
+        with self.stats.stage('cache_append'):
+            num_appended = self.append_cache_rows(symbol, market, lines)
+            self.record_fetched_range(symbol, market, start_date, end_date)
+        self.stats.count(symbol, 'appended', num_appended)
+        return num_appended
+
+    def get_adjustment_window(self, symbol, market, plan):
+        """Returns the date range of the last settings.adjustment_check_days
+        of cached rows, to fetch again with the fetches in plan, or None
+        if there is nothing to fetch, nothing cached or the check is off.
+
+        """
+        if not (plan and self.settings.adjustment_check_days): return None
+        index = self.get_cache_index(symbol, market)
+        if not index['rows']: return None
+        last = self.parse_iso_date(index['max_date'])
+        return [last - timedelta(days=self.settings.adjustment_check_days), last]
+
+    def read_window_rows(self, symbol, market, window):
+        """Returns the cached rows dated within the [start, end] window
+        as a dict of CacheRows by date.
+
+        """
+        index = self.get_cache_index(symbol, market)
+        return dict((row.date, row) for row in self.iter_cache_rows(
+            symbol, market, window[0], window[1], date_sorted=True,
+            offset=self.get_cache_offset(index, window[0]) or 0))
+
+    def adjustment_changed(self, lines, cached):
+        """Compares the ratio of adj_close to close of the fetched rows
+        with that of the rows in cached, see read_window_rows, of the
+        same dates. A change beyond what rounding to cents explains
+        means the price server has readjusted the stock's history for
+        a split or dividend since it was cached.
+
+        Returns whether the adjustment factor changed.
+        """
+        for line in lines:
+            if not line.strip(): continue
+            fresh = self.parse_csv_row(line)
+            old = cached.get(fresh.date)
+            if old is None or not (old.close and fresh.close): continue
+            # the adj_close of either row may be off by half a cent
+            if abs(fresh.adj_close * old.close - old.adj_close * fresh.close) >\
+               fresh.close + old.close:
+                return True
+        return False
+
+    def rebuild_cache_file(self, symbol, market, start_date, end_date):
+        """Refetches the stock's history, from start_date or the first
+        cached date if earlier, to end_date in one request and replaces
+        the cache file with it. The index is marked for the stock's
+        datapoints to be restated, see StockCollection.update_stock_in_db.
+
+        Returns False in case of failure, number of rows written if success.
+        """
+        index = self.get_cache_index(symbol, market)
+        if index['rows']:
+            start_date = min(start_date, self.parse_iso_date(index['min_date']))
+        lines = self.fetch_rows(symbol, market, start_date, end_date)
+        if lines is False: return False
+        lines = sorted([line + "\n" for line in lines if line.strip()],
+                       key=lambda line: line[:10])
+        with self.stats.stage('cache_append'):
+            self.replace_cache_file(self.get_cache_file_path(symbol, market), lines)
+            self.index_cache_file(symbol, market)
+            self.record_fetched_range(symbol, market, start_date, end_date)
+            index = self.get_cache_index(symbol, market)
+            index['restate'] = True
+            self.write_cache_index(symbol, market, index)
+        self.stats.count(symbol, 'adjusted')
+        self.stats.count(symbol, 'appended', len(lines))
+        return len(lines)
+
+    def fetch_url(self, url, symbol=None):
+        """Fetches url, honouring the request rate limit, the per host
+        limit on requests in flight and the host's circuit breaker.
+        Transient failures, see fetcher.is_transient, are retried up to
+        settings.fetch_retries times after backoff_delay. Retries are
+        counted against symbol.
+
+        Returns the response body. Raises one of fetcher.FETCH_ERRORS
+        on failure.
+        """
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            if not self.breaker.allow(host):
+                raise CircuitOpenError(u"circuit open for %s" % host)
+            try:
+                body = self.fetch_once(url)
+            except FETCH_ERRORS, e:
+                if not is_transient(e):
+                    # the host answered, so it is up
+                    if isinstance(e, HTTPError): self.breaker.succeeded(host)
+                    raise
+                self.breaker.failed(host)
+                attempt += 1
+                if attempt > self.settings.fetch_retries: raise
+                if symbol: self.stats.count(symbol, 'retried')
+                with self.stats.stage('fetch_wait'):
+                    time.sleep(backoff_delay(attempt, self.settings.fetch_backoff,
+                                             self.settings.fetch_backoff_cap))
+                continue
+            self.breaker.succeeded(host)
+            return body
+
+    def fetch_once(self, url):
+        """Sends one request for url once the rate and per host limits
+        allow.
+
+        Returns the response body.
+        """
+        with self.stats.stage('fetch_wait'):
+            if self.rate_limiter: self.rate_limiter.acquire()
+            slot = self.host_limiter.slot(urlparse(url).netloc)
+            slot.acquire()
+        started = time.time()
+        try:
+            with self.stats.stage('http'):
+                return self.http.get(url)
+        finally:
+            self.stats.observe('http', time.time() - started)
+            slot.release()
+
+    def dedupe(self, symbol, market, mode=None):
+        """removes duplicates from the cache file. Modes are
+        'line': drops repeats of an identical line,
+        'date': keeps the first row seen for each date,
+        'newest': keeps the last row appended for each date, which
+        picks up restated adj_close values.
+        mode defaults to settings.dedupe_mode.
+
+        The deduped file is streamed to a temp file which is renamed over
+        the cache file, so a crash leaves the original in place.
+        Returns int with number of dupes found.
+        """
+        with self.stats.stage('dedupe'):
+            if not mode: mode = self.settings.dedupe_mode
+            if mode not in ('line', 'date', 'newest'):
+                raise ValueError(u"unknown dedupe mode %s" % mode)
+            path = self.get_cache_file_path(symbol, market)
+            if mode == 'newest':
+                # first pass finds the line number of the last row per date
+                last_seen = {}
+                cache_file = open(path, 'r')
+                for i, line in enumerate(cache_file): last_seen[line[:10]] = i
+                cache_file.close()
+            seen = set()
+            dupes_found = 0
+            cache_file = open(path, 'r')
+            temp_file = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(path) or ".",
+                prefix="." + os.path.basename(path) + ".", delete=False)
+            try:
+                for i, line in enumerate(cache_file):
+                    if mode == 'line': key = line
+                    else: key = line[:10]
+                    if mode == 'newest': is_dupe = last_seen[key] != i
+                    else: is_dupe = key in seen
+                    if is_dupe:
+                        dupes_found += 1
+                        continue
+                    if mode != 'newest': seen.add(key)
+                    temp_file.write(line)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+                temp_file.close()
+                cache_file.close()
+                if dupes_found: os.rename(temp_file.name, path)
+                else: os.remove(temp_file.name)
+            except:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+        self.stats.count(symbol, 'deduped', dupes_found)
+        return dupes_found
@@ -17,258 +17,978 @@
 # You should have received a copy of the GNU General Public License
 # along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
 
-import hashlib
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+import logging
 import os
+import multiprocessing
+import sys
 from sqlalchemy import *
 from sqlalchemy.orm import *
 from sqlalchemy.exc import IntegrityError
 from model import Stock, Day, Datapoint, init_model
+from model import datapoint_table, datapoint_revision_table, day_table, stock_table
+import model
+from cStringIO import StringIO
+import columnar
+import npzexport
+from StockCache import StockCache
+from lrucache import LRUCache
+from registry import SymbolRegistry
 import pdb
-import urllib2
-from urllib2 import HTTPError
 
-class StockCollection(object):
+log = logging.getLogger(__name__)
+
+DATAPOINT_COLUMNS = ('stock_id', 'day_id', 'date', 'open_val', 'high',
+                     'low', 'close', 'volume', 'adj_close', 'valid_from')
+
+class StockCollection(StockCache):
 
     def __init__(self, settings):
-        self.settings = settings
-        self.engine = create_engine(self.settings.db_url)
-        self.Session = scoped_session(sessionmaker(bind=self.engine))
-        self.stocks = []
-        meta = MetaData(self.engine)
-        meta.reflect()
-        if len(meta.tables) == 0: self.create_db()
-        session = self.Session()
-        for stock in session.query(Stock): self.stocks.append(stock)
-
-    def validate_symbol(self, symbol):
-        if "." in symbol:
-            # some stocks with . in name cannot be looked up UGLYHACK
-            return [symbol, False]
-        if "-" in symbol:
-            [lhs, rhs] = symbol.split("-")
-            cleaned_symbol = lhs + "-P" + rhs
-            # UGLYHACK the url doesn't work and y! has no data for
-            # this stock even after fixing the symbol
-            return [cleaned_symbol, False]
-        else:
-            return [symbol, True]
+        StockCache.__init__(self, settings)
+        # the db is connected to on first use, see connect
+        self.db_engine = None
+        self.db_session = None
+        self.schema_checked = False
+        self.registry = SymbolRegistry(lambda: self.Session())
+        self.day_ids = {}
+        self.day_lock = None
+        self.query_cache = LRUCache(self.settings.query_cache_size)
+
+    @property
+    def engine(self):
+        return self.connect()
+
+    @property
+    def Session(self):
+        self.connect()
+        return self.db_session
+
+    def connect(self, check_schema=True):
+        """Creates the one engine, from settings.db_url, and the session
+        factory, on first use. Then, unless check_schema is off, checks
+        the db schema once and loads the day index.
+
+        Returns the engine.
+        """
+        if self.db_engine is None:
+            self.db_engine = create_engine(self.settings.db_url)
+            self.db_session = scoped_session(sessionmaker(bind=self.db_engine))
+        if check_schema and not self.schema_checked:
+            self.schema_checked = True
+            try:
+                self.check_schema()
+            except:
+                self.schema_checked = False
+                raise
+            self.load_day_index()
+        return self.db_engine
+
+    def check_schema(self):
+        """Checks the db against its schema version marker, which costs
+        one catalog lookup and one single row query. An empty db gets the
+        schema created. A db created before the marker existed is
+        checked by reflecting datapoint. Older schemas are upgraded.
+
+        Raises ValueError if the db schema is too old to upgrade or newer
+        than this code.
+        """
+        connection = self.db_engine.connect()
+        try:
+            version = model.get_schema_version(connection)
+            if version is None:
+                if not connection.dialect.has_table(connection, 'stock'):
+                    self.create_db()
+                    return
+                meta = MetaData()
+                meta.reflect(connection, only=['datapoint'])
+                if 'date' not in meta.tables['datapoint'].c:
+                    model.upgrade_schema(self.db_engine, 0)
+                elif 'valid_from' in meta.tables['datapoint'].c:
+                    model.stamp_schema_version(self.db_engine)
+                else: model.upgrade_schema(self.db_engine, 1)
+            elif 1 <= version < model.SCHEMA_VERSION:
+                model.upgrade_schema(self.db_engine, version)
+            elif version != model.SCHEMA_VERSION:
+                raise ValueError(u"db schema is version %s, expected %s; recreate it"
+                                 % (version, model.SCHEMA_VERSION))
+        finally:
+            connection.close()
+
+    @property
+    def stocks(self):
+        """All stocks registered in the db, read on first use.
+
+        """
+        return self.registry.all()
 
     def load_symbols(self, settings):
-        for symbols_file in settings.symbols_files:
-            input_file = open(symbols_file[u'file'])
-            market = symbols_file[u'name']
-            lines = iter(input_file)
-            lines.next()
-            for line in lines:
-                [symbol, name] = line.split(u"\t")
-                [symbol,  symbol_is_valid] = self.validate_symbol(symbol)
-                if symbol_is_valid:
-                    if name[:-2] == "": name=None
-                    else: name=name[:-2]
-                    self.add_stock(unicode(symbol), unicode(name), unicode(market))
-                else:
-                    # discarding symbol, couldn't validate
-                    pass
-            input_file.close()
-
-    def update_db(self):
-        for stock in self.stocks:
-            self.update_stock_in_db(stock)
-
-    def ensure_day_in_db(self, date):
-        session = self.Session()
+        """Registers the stocks in the symbols files, in one bulk
+        upsert, and creates their cache files.
+
+        Returns number of stocks added.
+        """
+        rows = self.read_symbols(settings)
+        num_added = self.registry.upsert(rows)
+        for [symbol, name, market] in rows:
+            self.ensure_cache_file_exists(symbol, market)
+        return num_added
+
+    def update_db(self, assume_unique=None):
+        """Brings the db up to date against the cache for all stocks,
+        on settings.load_workers processes if more than one.
+        assume_unique, defaulting to settings.assume_datapoints_unique,
+        is passed on to update_stock_in_db.
+
+        Returns a dict with the total rows inserted and skipped, and
+        under 'workers' the stocks, rows inserted and rows skipped
+        per process id.
+        """
+        if self.settings.assume_days_prepopulated is False:
+            # each stock from the date it loads from
+            dates = set()
+            for stock in self.stocks:
+                start = (stock.last_db_update + timedelta(days=1)
+                         if stock.last_db_update else self.settings.start_date)
+                dates.update(self.read_cache_dates(stock, start,
+                                                   self.settings.today))
+            self.ensure_days_in_db(dates)
+            self.Session().commit()
+        if self.settings.datapoint_partitioning and self.is_partitioned():
+            model.create_datapoint_partitions(self.engine,
+                                              self.settings.datapoint_partitioning,
+                                              self.settings.start_date,
+                                              self.get_partitions_end())
+        if self.settings.load_workers > 1:
+            results = self.update_db_parallel(assume_unique)
+        else:
+            results = [[os.getpid()] + self.update_stock_in_db(stock,
+                                                               assume_unique=assume_unique)
+                       for stock in self.stocks]
+        report = {'inserted': 0, 'skipped': 0, 'workers': {}}
+        for [pid, inserted, skipped] in results:
+            worker = report['workers'].setdefault(pid, {'stocks': 0,
+                                                        'inserted': 0,
+                                                        'skipped': 0})
+            worker['stocks'] += 1
+            worker['inserted'] += inserted
+            worker['skipped'] += skipped
+            report['inserted'] += inserted
+            report['skipped'] += skipped
+        return report
+
+    def update_db_parallel(self, assume_unique=None):
+        """Spreads update_stock_in_db over the stocks across a pool of
+        settings.load_workers processes, each with its own engine.
+        Workers take a shared lock to create days, so two never try
+        to insert the same date.
+
+        Returns a [process id, rows inserted, rows skipped] list per stock.
+        The workers' run statistics are merged into self.stats.
+        """
+        stock_ids = [stock.id for stock in self.stocks]
+        # connections must not be shared with the forked workers
+        self.Session.remove()
+        self.engine.dispose()
+        pool = multiprocessing.Pool(self.settings.load_workers,
+                                    init_load_worker,
+                                    (self.settings, multiprocessing.Lock(),
+                                     assume_unique))
         try:
-            day = session.query(Day).filter(Day.date == date).one()
+            results = pool.map(load_stock, stock_ids, chunksize=1)
+            pool.close()
+            for result in results: self.stats.merge(result.pop())
+            self.query_cache.clear()
         except:
-            day = Day(date)
-            session.add(day)
-            session.commit()
-        return day
-
-    def parse_csv_line(self, line):
-        """Takes as input a line of text formatted like
-        from Yahoo finance. Example:
-        2011-11-14,63.44,63.54,62.93,63.05,6832800,63.05
-
-        Returns a dict with the parsed values.
-
-        """
-        def dollah_to_cents(s):
-            [lhs, rhs] = s.split(".")
-            return (int(lhs)*100)+int(rhs)
-        result = {}
-        vals = line.split(",")
-        result['open_val'] = dollah_to_cents(vals[1])
-        result['high'] = dollah_to_cents(vals[2])
-        result['low'] = dollah_to_cents(vals[3])
-        result['close'] = dollah_to_cents(vals[4])
-        result['volume'] = int(vals[5])
-        result['adj_close'] = dollah_to_cents(vals[6])
-        result['date'] = date(year=int(vals[0][:4]),
-                              month=int(vals[0][5:7]),
-                              day=int(vals[0][-2:]))
-        return result
-
-    def update_stock_in_db(self, stock, start_date=None, end_date=None):
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self.registry.reset()
+        self.load_day_index()
+        return results
+
+    def load_day_index(self):
+        """(Re)loads the date to day id map shared by all stocks.
+
+        """
+        session = self.Session()
+        query = select([day_table.c.id, day_table.c.date])
+        self.day_ids = dict((row.date, row.id) for row in session.execute(query))
+
+    def begin_load(self, session, stock):
+        """Marks the stock as being loaded, in a transaction of its own,
+        so that export_datapoints knows rows valid from before its start
+        may still be committed. The load clears the mark as it commits;
+        one that fails leaves it, holding exports back to its start
+        until the stock is loaded again.
+
+        Returns the time for the load's rows to be valid from, taken
+        once the mark is committed.
+        """
+        stock.loading_since = datetime.utcnow()
+        session.commit()
+        return datetime.utcnow()
+
+    def rollback_load(self, session):
+        """Rolls back a failed load and reloads the day index, which
+        may hold the ids of days inserted by the rolled back transaction.
+
+        """
+        session.rollback()
+        self.load_day_index()
+
+    def ensure_days_in_db(self, dates):
+        """Inserts day records for those of the dates missing from
+        the day index, in one batch, and adds them to the index.
+        Does not commit, so a caller rolling back must reload the index,
+        see rollback_load, unless running as a parallel load worker:
+        then the day lock is held while the index is refreshed from the
+        db, the days still missing are inserted and committed.
+
+        Returns number of days inserted.
+        """
+        missing = sorted(set([d for d in dates if d not in self.day_ids]))
+        if not missing: return 0
+        session = self.Session()
+        query = select([day_table.c.id, day_table.c.date],
+                       and_(day_table.c.date >= missing[0],
+                            day_table.c.date <= missing[-1]))
+        if self.day_lock: self.day_lock.acquire()
+        try:
+            if self.day_lock:
+                for row in session.execute(query): self.day_ids[row.date] = row.id
+                missing = [d for d in missing if d not in self.day_ids]
+            if missing:
+                session.execute(day_table.insert(), [{'date': d} for d in missing])
+                for row in session.execute(query): self.day_ids[row.date] = row.id
+                if self.day_lock: session.commit()
+        finally:
+            if self.day_lock: self.day_lock.release()
+        return len(missing)
+
+    def populate_days(self, start_date=None, end_date=None, stocks=None):
+        """The day population function. Ensures there is a day record
+        for every trading day from start_date to end_date inclusive,
+        a trading day being a date with a row in the cache file of one
+        of stocks, which defaults to all stocks. Weekdays without data,
+        such as exchange holidays, get no record. Existing day records
+        are preserved.
+
+        Returns number of days inserted.
+        """
+        if not start_date: start_date = self.settings.start_date
+        if not end_date: end_date = self.settings.today
+        if stocks is None: stocks = self.stocks
+        dates = set()
+        for stock in stocks:
+            dates.update(self.read_cache_dates(stock, start_date, end_date))
+        num_inserted = self.ensure_days_in_db(dates)
+        self.Session().commit()
+        return num_inserted
+
+    def read_cache_dates(self, stock, start_date, end_date):
+        """Returns the set of dates from start_date to end_date inclusive
+        with a row in the stock's cache file.
+
+        """
+        dates = set()
+        index = self.get_cache_index(stock.symbol, stock.market)
+        offset = self.get_cache_offset(index, start_date)
+        if offset is None: return dates
+        for columns in self.iter_cache_batches(stock.symbol, stock.market,
+                                               start_date, end_date, offset):
+            dates.update(columns['date'].tolist())
+        return dates
+
+    def update_stock_in_db(self, stock, start_date=None, end_date=None,
+                           assume_unique=None):
         """Brings the data base for the symbol
         up to date against local cache.
 
         To maintain integrity, incremental updating is assumed.
         To update incrementally, omit the start_date and end_date
-        parameters.
+        parameters. If the cache file was rebuilt for readjusted prices,
+        the stock's whole history is restated instead.
+
+        Rows are loaded as valid from the start of the load, see
+        begin_load and get_series. With
+        assume_unique, which defaults to settings.assume_datapoints_unique,
+        rows are not checked against the datapoints already loaded.
 
+        Returns [rows inserted, rows skipped as already loaded].
         """
+        if assume_unique is None:
+            assume_unique = self.settings.assume_datapoints_unique
         session = self.Session()
-        datapoint_queue = []
         if not start_date:
             if not stock.last_db_update:
                 start_date = self.settings.start_date
             else:
                 start_date = stock.last_db_update + timedelta(days=1)
         if not end_date: end_date = self.settings.today
-        cache_file = open(self.get_cache_file_path(stock.symbol, stock.market))
-        for line in cache_file.read().split("\n"):
-            if line == "": continue
-            values = self.parse_csv_line(line)
-            if start_date <= values['date'] <= end_date:
-                datapoint_queue.append(values)
-        for dp in datapoint_queue:
-            if self.settings.assume_days_prepopulated is False:
-                day = self.ensure_day_in_db(dp['date'])
-            else: day = session.query(Day).filter_by(date=values['date']).one()
-            d = Datapoint(stock_id = stock.id,
-                          day_id = day.id,
-                          open_val = dp["open_val"],
-                          high = dp["high"],
-                          low = dp["low"],
-                          close = dp["close"],
-                          volume = dp["volume"],
-                          adj_close = dp["adj_close"])
-            session.add(d)
-            if self.settings.assume_datapoints_unique == False:
-                try:
+        try:
+            index = self.get_cache_index(stock.symbol, stock.market)
+            if index.get('restate'):
+                # the price server readjusted the stock's history and the
+                # cache file was refetched, see StockCache.rebuild_cache_file
+                [num_restated, num_inserted] = self.restate_stock_in_db(
+                    stock, end_date=end_date)
+                index['restate'] = False
+                self.write_cache_index(stock.symbol, stock.market, index)
+                stock.last_db_update = end_date
+                session.commit()
+                return [num_inserted, 0]
+            valid_from = self.begin_load(session, stock)
+            offset = self.get_cache_offset(index, start_date)
+            num_inserted = 0
+            num_skipped = 0
+            if offset is None or index['min_date'] > end_date.isoformat():
+                # the cache holds nothing in range
+                pass
+            elif self.settings.bulk_load:
+                batches = self.iter_cache_batches(stock.symbol, stock.market,
+                                                  start_date, end_date, offset)
+                batches = self.stats.timed_iter('parse', batches)
+                [num_inserted, num_skipped] = self.bulk_load_datapoints(
+                    session, stock, batches, start_date, end_date, valid_from,
+                    assume_unique)
+            else:
+                rows = self.iter_cache_rows(stock.symbol, stock.market,
+                                            start_date, end_date,
+                                            date_sorted=True, offset=offset)
+                rows = self.stats.timed_iter('parse', rows)
+                [num_inserted, num_skipped] = self.load_datapoints(
+                    session, stock, rows, valid_from, assume_unique)
+            stock.last_db_update = end_date
+            stock.loading_since = None
+            with self.stats.stage('commit'):
+                session.commit()
+        except:
+            self.rollback_load(session)
+            raise
+        self.query_cache.invalidate(stock.id)
+        self.stats.count(stock.symbol, 'inserted', num_inserted)
+        self.stats.count(stock.symbol, 'conflicted', num_skipped)
+        return [num_inserted, num_skipped]
+
+    def load_datapoints(self, session, stock, rows, valid_from=None,
+                        assume_unique=False):
+        """Loads CacheRows for the stock one row at a time, as core
+        inserts rather than mapped Datapoint instances.
+
+        Unless assume_unique, each row is committed
+        on its own and rows conflicting with a loaded datapoint are
+        rolled back and skipped. Otherwise rows are written in batches
+        of settings.bulk_batch_size.
+
+        Returns [rows inserted, rows skipped].
+        """
+        num_inserted = 0
+        num_skipped = 0
+        batch = []
+        for row in rows:
+            with self.stats.stage('day_lookup'):
+                if self.settings.assume_days_prepopulated is False:
+                    if self.ensure_days_in_db([row.date]): session.commit()
+                values = (stock.id, self.day_ids[row.date]) + row + (valid_from,)
+            if assume_unique:
+                batch.append(values)
+                if len(batch) >= self.settings.bulk_batch_size:
+                    num_inserted += self.bulk_insert_datapoints(session, batch)
+                    batch = []
+                continue
+            try:
+                with self.stats.stage('db_insert'):
+                    session.execute(datapoint_table.insert(),
+                                    dict(zip(DATAPOINT_COLUMNS, values)))
+                with self.stats.stage('commit'):
                     session.commit()
-                except IntegrityError:
-                    session.rollback()
-        stock.last_db_update = end_date
-        session.commit()
-        cache_file.close()
+                num_inserted += 1
+            except IntegrityError:
+                session.rollback()
+                num_skipped += 1
+        num_inserted += self.bulk_insert_datapoints(session, batch)
+        return [num_inserted, num_skipped]
 
-    def add_stock(self, symbol, name, market):
-        stock_registered = False
-        stock = Stock(symbol=symbol, name=name, market=market)
+    def get_loaded_day_ids(self, session, stock, start_date, end_date):
+        """Returns the set of day ids for which the stock already
+        has a datapoint in the db, within the date range.
+
+        """
+        query = select([datapoint_table.c.day_id],
+                       and_(datapoint_table.c.stock_id == stock.id,
+                            datapoint_table.c.day_id == day_table.c.id,
+                            day_table.c.date >= start_date,
+                            day_table.c.date <= end_date))
+        with self.stats.stage('db_query'):
+            return set(row[0] for row in session.execute(query))
+
+    def bulk_insert_datapoints(self, session, rows):
+        """Writes a batch of datapoints, given as a list of tuples
+        in DATAPOINT_COLUMNS order, in one statement.
+        Uses COPY FROM STDIN when the engine is psycopg2,
+        an executemany insert otherwise.
+
+        Returns number of rows written.
+        """
+        if not rows: return 0
+        with self.stats.stage('db_insert'):
+            connection = session.connection()
+            if self.engine.dialect.driver == 'psycopg2':
+                buf = StringIO()
+                for row in rows:
+                    buf.write("\t".join([r"\N" if value is None else str(value)
+                                         for value in row]))
+                    buf.write("\n")
+                buf.seek(0)
+                cursor = connection.connection.cursor()
+                cursor.copy_from(buf, 'datapoint', columns=DATAPOINT_COLUMNS)
+                cursor.close()
+            else:
+                connection.execute(datapoint_table.insert(),
+                                   [dict(zip(DATAPOINT_COLUMNS, row)) for row in rows])
+        return len(rows)
+
+    def iter_cache_batches(self, symbol, market, start_date, end_date, offset=0):
+        """Yields the date sorted cache file's rows dated from start_date
+        to end_date inclusive as column batches (see columnar.parse_csv)
+        of about settings.bulk_batch_size rows. The csv is read from byte
+        offset up to the first batch reaching past end_date.
+
+        With settings.binary_cache on and a binary cache file at least as
+        new as the csv, the rows are views onto the memory mapped binary
+        file rather than parsed from the csv.
+        """
+        if self.settings.binary_cache:
+            records = self.read_cache_slice(symbol, market, start_date, end_date)
+            if records is not None:
+                size = self.settings.bulk_batch_size
+                for i in xrange(0, len(records), size):
+                    yield columnar.records_to_columns(records[i:i+size])
+                return
+        path = self.get_cache_file_path(symbol, market)
+        for columns in columnar.iter_csv_chunks(path, self.settings.bulk_batch_size,
+                                                offset):
+            past_end = len(columns['date']) and\
+                       columns['date'][-1] > columnar.np.datetime64(end_date, 'D')
+            columns = columnar.select(columns, columnar.date_window(columns,
+                                                                    start_date,
+                                                                    end_date))
+            if len(columns['date']): yield columns
+            if past_end: break
+
+    def bulk_load_datapoints(self, session, stock, batches,
+                             start_date, end_date, valid_from=None,
+                             assume_unique=False):
+        """Loads column batches of datapoints for the stock, as yielded
+        by iter_cache_batches, one batch at a time.
+
+        Unless assume_unique, days the stock already
+        has a datapoint for are looked up in one query and skipped,
+        instead of attempting each row and rolling back on conflict.
+        Day ids come from the day index; days missing from it are
+        inserted once per batch unless assume_days_prepopulated is set.
+
+        Returns [rows written, rows skipped].
+        """
+        if assume_unique:
+            loaded = set()
+        else:
+            loaded = self.get_loaded_day_ids(session, stock, start_date, end_date)
+        num_written = 0
+        num_skipped = 0
+        for columns in batches:
+            written = self.flush_datapoints(session, stock, columns, loaded,
+                                            valid_from)
+            num_written += written
+            num_skipped += len(columns['date']) - written
+        return [num_written, num_skipped]
+
+    def flush_datapoints(self, session, stock, columns, loaded, valid_from=None):
+        """Resolves day ids for a column batch of datapoints and
+        writes the rows whose day id is not in the set loaded.
+        loaded is updated with the day ids written.
+
+        Returns number of rows written.
+        """
+        dates = columns['date'].tolist()
+        with self.stats.stage('day_lookup'):
+            if self.settings.assume_days_prepopulated is False:
+                self.ensure_days_in_db(dates)
+            day_ids = []
+            keep = []
+            for i, d in enumerate(dates):
+                day_id = self.day_ids[d]
+                if day_id in loaded: continue
+                loaded.add(day_id)
+                day_ids.append(day_id)
+                keep.append(i)
+        rows = zip([stock.id] * len(keep), day_ids, [dates[i] for i in keep],
+                   *[columns[field][keep].tolist() for field in columnar.FIELDS] +
+                   [[valid_from] * len(keep)])
+        return self.bulk_insert_datapoints(session, rows)
+
+    def restate_stock_in_db(self, stock, start_date=None, end_date=None):
+        """Diffs the stock's cache against its datapoints dated start_date
+        to end_date, which default to settings.start_date and
+        settings.today, and stores the cached values of every datapoint
+        that differs as its new version, valid from now. The values
+        replaced go to datapoint_revision, so get_series as_of earlier
+        still sees them. Cached dates with no datapoint are loaded as
+        update_stock_in_db would. The cache is taken to be deduped.
+
+        Returns [rows restated, rows inserted].
+        """
         session = self.Session()
-        session.add(stock)
+        valid_from = self.begin_load(session, stock)
+        if not start_date: start_date = self.settings.start_date
+        if not end_date: end_date = self.settings.today
+        fields = columnar.FIELDS
+        query = select([datapoint_table.c.date, datapoint_table.c.valid_from] +
+                       [datapoint_table.c[field] for field in fields],
+                       and_(datapoint_table.c.stock_id == stock.id,
+                            datapoint_table.c.date >= start_date,
+                            datapoint_table.c.date <= end_date))
+        query = query.order_by(datapoint_table.c.date)
+        with self.stats.stage('db_query'):
+            rows = session.execute(query).fetchall()
+        stored_dates = columnar.np.array([row[0] for row in rows], dtype='datetime64[D]')
+        stored = dict((field, columnar.np.array([row[i+2] for row in rows],
+                                                dtype=columnar.np.int64))
+                      for i, field in enumerate(fields))
         try:
-            session.commit()
-        except IntegrityError:
-            session.rollback()
-        for s in self.stocks:
-            if s.symbol == stock.symbol and s.market == stock.market: stock_registered = True
-        if not stock_registered: self.stocks.append(stock)
-        self.ensure_cache_file_exists(symbol, market)
+            num_restated = 0
+            num_inserted = 0
+            batches = self.iter_cache_batches(stock.symbol, stock.market,
+                                              start_date, end_date)
+            for columns in self.stats.timed_iter('parse', batches):
+                at = columnar.np.searchsorted(stored_dates, columns['date'])
+                found = at < len(stored_dates)
+                found[found] = stored_dates[at[found]] == columns['date'][found]
+                changed = columnar.np.zeros(len(at), dtype=bool)
+                for field in fields:
+                    changed[found] |= stored[field][at[found]] != columns[field][found]
+                revisions = []
+                updates = []
+                for i in columnar.np.flatnonzero(changed).tolist():
+                    row = rows[at[i]]
+                    revision = dict(zip(fields, row[2:]))
+                    revision.update(stock_id=stock.id, date=row[0],
+                                    valid_from=row[1], valid_to=valid_from)
+                    revisions.append(revision)
+                    update = dict((field, int(columns[field][i])) for field in fields)
+                    update.update(b_stock_id=stock.id, b_date=row[0])
+                    updates.append(update)
+                if revisions:
+                    with self.stats.stage('db_insert'):
+                        session.execute(datapoint_revision_table.insert(), revisions)
+                        session.execute(datapoint_table.update().
+                                        where(and_(datapoint_table.c.stock_id == bindparam('b_stock_id'),
+                                                   datapoint_table.c.date == bindparam('b_date'))).
+                                        values(valid_from=valid_from), updates)
+                num_restated += len(revisions)
+                num_inserted += self.flush_datapoints(session, stock,
+                                                      columnar.select(columns, ~found),
+                                                      set(), valid_from)
+            stock.loading_since = None
+            with self.stats.stage('commit'):
+                session.commit()
+        except:
+            self.rollback_load(session)
+            raise
+        self.query_cache.invalidate(stock.id)
+        self.stats.count(stock.symbol, 'restated', num_restated)
+        self.stats.count(stock.symbol, 'inserted', num_inserted)
+        return [num_restated, num_inserted]
 
-    def ensure_cache_file_exists(self, symbol, market):
-        if not os.path.exists(self.get_cache_file_path(symbol, market)):
-            _ = open(self.get_cache_file_path(symbol, market), 'w').close()
-        try:
-            _ = open(self.get_cache_file_path(symbol, market), mode='r')
-        except IOError:
-            _ = open(self.get_cache_file_path(symbol, market), mode='a')
+    def get_stock(self, symbol, market):
+        stock = self.registry.get(symbol, market)
+        if stock is None: raise ValueError(u"no stock %s on %s" % (symbol, market))
+        return stock
+
+    def get_series(self, symbol, market, start_date=None, end_date=None,
+                   fields=None, as_of=None):
+        """Returns the stock's datapoints dated start_date to end_date
+        inclusive, in date order, as a dict of read only numpy arrays:
+        'date' as datetime64[D] and int64 for each of fields, which
+        defaults to all of columnar.FIELDS. The dates default to
+        settings.start_date and settings.today.
+
+        With as_of, a utc datetime, or a date for the end of that day,
+        gives the datapoints as they were loaded at that time, leaving
+        out later loads and restatements.
+
+        Results are cached until update_stock_in_db loads the stock.
+        """
+        fields = self.query_fields(fields)
+        stock = self.get_stock(symbol, market)
+        if not start_date: start_date = self.settings.start_date
+        if not end_date: end_date = self.settings.today
+        if as_of is not None and not isinstance(as_of, datetime):
+            as_of = datetime.combine(as_of + timedelta(days=1), datetime.min.time())
+        key = ('series', stock.id, start_date, end_date, fields, as_of)
+        columns = self.query_cache.get(key)
+        if columns is None:
+            query = select([datapoint_table.c.date] +
+                           [datapoint_table.c[field] for field in fields],
+                           and_(datapoint_table.c.stock_id == stock.id,
+                                datapoint_table.c.date >= start_date,
+                                datapoint_table.c.date <= end_date))
+            if as_of is not None:
+                # the version valid at as_of is either the datapoint row
+                # or one of its revisions, never both
+                revisions = datapoint_revision_table
+                query = union_all(
+                    query.where(or_(datapoint_table.c.valid_from == None,
+                                    datapoint_table.c.valid_from <= as_of)),
+                    select([revisions.c.date] + [revisions.c[field] for field in fields],
+                           and_(revisions.c.stock_id == stock.id,
+                                revisions.c.date >= start_date,
+                                revisions.c.date <= end_date,
+                                or_(revisions.c.valid_from == None,
+                                    revisions.c.valid_from <= as_of),
+                                revisions.c.valid_to > as_of)))
+                query = query.order_by('date')
+            else: query = query.order_by(datapoint_table.c.date)
+            columns = self.query_columns(query, ('date',) + fields)
+            self.query_cache.put(key, columns, set([stock.id]))
+        return columns
+
+    def get_cross_section(self, day, symbols=None, fields=None):
+        """Returns the datapoints dated day of the stocks in symbols,
+        or of all stocks, in symbol order, as a dict of read only numpy
+        arrays: 'symbol' as objects and int64 for each of fields, which
+        defaults to all of columnar.FIELDS. Stocks without a datapoint
+        that day are left out.
 
-    def get_cache_file_path(self, symbol, market):
-        return self.settings.cache_dir+"/"\
-               + market + u"_" + symbol + u".csv"
+        Results are cached until update_stock_in_db loads one of the stocks.
+        """
+        fields = self.query_fields(fields)
+        condition = and_(datapoint_table.c.stock_id == stock_table.c.id,
+                         datapoint_table.c.date == day)
+        if symbols is None:
+            key = ('cross_section', day, None, fields)
+            tags = None
+        else:
+            symbols = tuple(sorted(set(symbols)))
+            tags = set()
+            for symbol in symbols:
+                stock = self.registry.get(symbol)
+                if stock is None: raise ValueError(u"no stock %s" % symbol)
+                tags.add(stock.id)
+            key = ('cross_section', day, symbols, fields)
+            condition = and_(condition, datapoint_table.c.stock_id.in_(tags))
+        columns = self.query_cache.get(key)
+        if columns is None:
+            query = select([stock_table.c.symbol] +
+                           [datapoint_table.c[field] for field in fields],
+                           condition).order_by(stock_table.c.symbol)
+            columns = self.query_columns(query, ('symbol',) + fields)
+            self.query_cache.put(key, columns, tags)
+        return columns
+
+    def query_fields(self, fields):
+        if fields is None: return columnar.FIELDS
+        fields = tuple(fields)
+        for field in fields:
+            if field not in columnar.FIELDS:
+                raise ValueError(u"unknown field %s" % field)
+        return fields
+
+    def query_columns(self, query, names):
+        """Runs query, its columns being names, on a connection of its
+        own. Returns the rows as a dict of read only arrays.
+
+        """
+        rows = self.engine.execute(query).fetchall()
+        values = zip(*rows) or [()] * len(names)
+        columns = {}
+        for name, column in zip(names, values):
+            if name == 'date': dtype = 'datetime64[D]'
+            elif name == 'symbol': dtype = object
+            else: dtype = columnar.np.int64
+            columns[name] = columnar.np.array(column, dtype=dtype)
+            columns[name].flags.writeable = False
+        return columns
+
+    def add_stock(self, symbol, name, market):
+        if self.registry.get(symbol, market) is None:
+            stock = Stock(symbol=symbol, name=name, market=market)
+            session = self.Session()
+            session.add(stock)
+            try:
+                session.commit()
+                self.registry.add(stock)
+            except IntegrityError:
+                session.rollback()
+        self.ensure_cache_file_exists(symbol, market)
 
     def wipe(self):
-        session = self.Session()
-        for stock in self.stocks:
+        """Drops all tables and removes the cache files of the stocks
+        registered, the cache state file, the failure ledger and
+        any run checkpoint. Works on a db of any schema version.
+
+        """
+        engine = self.connect(check_schema=False)
+        if engine.has_table('stock'):
+            stocks = engine.execute(select([stock_table.c.symbol,
+                                            stock_table.c.market])).fetchall()
+        else: stocks = []
+        for [symbol, market] in stocks:
             try:
-                os.remove(self.get_cache_file_path(stock.symbol, stock.market))
+                os.remove(self.get_cache_file_path(symbol, market))
             except OSError:
                 # TODO WE SHOULDN'T GET HERE. Log it at least
                 pass
-            session.delete(stock)
-        self.stocks = []
-        session.close_all()
-        meta = MetaData(self.engine)
+            for path in [self.get_binary_cache_file_path(symbol, market),
+                         self.get_cache_index_path(symbol, market)]:
+                if os.path.exists(path): os.remove(path)
+        for path in [self.get_state_path(), self.get_failures_path(),
+                     self.get_checkpoint_path()]:
+            if os.path.exists(path): os.remove(path)
+        self.registry.reset()
+        self.day_ids = {}
+        self.query_cache.clear()
+        self.db_session.close_all()
+        # a partitioned datapoint is not seen by reflection; dropping
+        # it takes its partitions with it
+        datapoint_table.drop(engine, checkfirst=True)
+        meta = MetaData(engine)
         meta.reflect()
         meta.drop_all()
+        self.schema_checked = False
 
     def create_db(self):
-        init_model(self.engine)
+        init_model(self.connect(check_schema=False),
+                   self.settings.datapoint_partitioning,
+                   self.settings.start_date, self.get_partitions_end())
+
+    def is_partitioned(self):
+        return model.datapoint_is_partitioned(self.engine)
+
+    def get_partitions_end(self):
+        """Partitions are kept created through the end of next year.
+
+        """
+        return date(year=self.settings.today.year + 1, month=12, day=31)
+
+    def seed_db(self):
+        """Runs update_db into an empty datapoint table with its unique
+        and foreign key constraints and its indexes dropped, adding them
+        back once the load is done. Loading skips the check for rows already loaded.
+        If the load fails, its error is raised even if the constraints
+        then cannot be added back, which is logged.
+        Without PostgreSQL this is just update_db.
 
-    def update_cache(self, start_date=None, end_date=None):
-        """updates the cache on all stocks contained
+        Returns update_db's report.
+        """
+        if self.engine.dialect.name != 'postgresql': return self.update_db()
+        session = self.Session()
+        if session.query(Datapoint).first():
+            raise ValueError(u"seed_db needs an empty datapoint table")
+        session.commit()
+        partitioned = self.is_partitioned()
+        model.drop_datapoint_constraints(self.engine)
+        model.drop_datapoint_indexes(self.engine)
+        try:
+            report = self.update_db(assume_unique=True)
+        except:
+            error = sys.exc_info()
+            self.Session().rollback()
+            try:
+                model.add_datapoint_constraints(self.engine, partitioned)
+                model.create_datapoint_indexes(self.engine)
+            except Exception, e:
+                log.error(u"seed_db failed and the datapoint constraints could "
+                          u"not be added back: %s", e)
+            raise error[0], error[1], error[2]
+        self.Session().commit()
+        model.add_datapoint_constraints(self.engine, partitioned)
+        model.create_datapoint_indexes(self.engine)
+        return report
+
+    def update_cache(self, start_date=None, end_date=None, failed_only=False):
+        """updates the cache on all stocks contained, saving
+        last_cache_update in the db. With failed_only, only the stocks
+        in the failure ledger are fetched. An interrupted run is
+        resumed, see open_checkpoint.
 
+        Returns the http client's request, connection and byte counters,
+        bytes_wire being body bytes as received and bytes_decoded the
+        same after gunzipping.
         """
         if not start_date: start_date = self.settings.start_date
         if not end_date: end_date = self.settings.today
-        for stock in self.stocks:
-            self.load_date_range(stock, start_date, end_date)
-            self.dedupe(stock.symbol, stock.market)
-
-    def compose_yahoo_url(self, symbol, startdate, enddate):
-        a = unicode(startdate.month - 1)
-        b = unicode(startdate.day)
-        c = unicode(startdate.year)
-        d = unicode(enddate.month - 1)
-        e = unicode(enddate.day)
-        f = unicode(enddate.year)
-        url = u"http://ichart.finance.yahoo.com/table.csv?s=" +\
-              symbol + "&a=" + \
-              a + "&b=" + b + "&c=" + c + "&d=" + \
-              d + "&e=" + e + "&f=" + f + "&g=d&ignore=.csv"
-        return url
+        # stock attributes are read here, in the session's thread, so
+        # the workers only ever touch the network and the cache files
+        stocks = self.stocks
+        if failed_only: stocks = self.select_failed(stocks)
+        jobs = [(stock.symbol, stock.market, stock.last_cache_update)
+                for stock in stocks]
+        checkpoint = self.open_checkpoint(u"update_cache", start_date, end_date,
+                                          failed_only)
+        results = self.refresh_caches(jobs, start_date, end_date,
+                                      checkpoint=checkpoint)
+        for stock, num_appended in zip(stocks, results):
+            if num_appended is not False: stock.last_cache_update = end_date
+        self.Session().commit()
+        if checkpoint: checkpoint.finish()
+        return self.http.stats()
+
+    def run_report(self):
+        """Returns StockCache.run_report with the query cache's
+        counters under 'query_cache'.
+
+        """
+        report = StockCache.run_report(self)
+        report['query_cache'] = self.query_cache.stats()
+        return report
+
+    def export_datapoints(self, out_dir=None, full=False):
+        """Exports the datapoints to NPZ files under out_dir, defaulting
+        to settings.export_dir, one per market and year, see npzexport.
+        The first export, or one with full, writes every partition.
+        Later ones rewrite only the partitions holding datapoints loaded
+        or restated since the last export's watermark, and in them only
+        the rows of the stocks concerned. The manifest is written last.
+
+        The watermark is when the export started, or the start of the
+        oldest load still in progress then, see begin_load, if earlier.
+        The rows of such a load are not visible until it commits, but
+        they are valid from its start, so the next export picks them up.
+
+        Returns the names of the partitions written.
+        """
+        if out_dir is None: out_dir = self.settings.export_dir
+        if not os.path.isdir(out_dir): os.makedirs(out_dir)
+        started = datetime.utcnow()
+        loading_since = self.engine.execute(
+            select([func.min(stock_table.c.loading_since)])).scalar()
+        watermark = min(started, loading_since or started)
+        manifest = None if full else npzexport.read_manifest(out_dir)
+        if manifest is None:
+            manifest = npzexport.new_manifest()
+            changes = self.get_export_changes(None)
+        else:
+            since = datetime.strptime(manifest['watermark'], "%Y-%m-%dT%H:%M:%S.%f")
+            changes = self.get_export_changes(since)
+        written = []
+        for (market, year), stock_ids in sorted(changes.items()):
+            name = npzexport.partition_name(market, year)
+            path = os.path.join(out_dir, name + ".npz")
+            with self.stats.stage('export_query'):
+                columns = self.query_export(market, year, stock_ids)
+            if stock_ids is not None and name in manifest['partitions']:
+                columns = npzexport.merge_columns(npzexport.read_partition(path),
+                                                  columns)
+            elif not len(columns['date']): continue
+            with self.stats.stage('export_write'):
+                entry = npzexport.write_partition(path, columns)
+            entry['path'] = name + ".npz"
+            manifest['partitions'][name] = entry
+            written.append(name)
+        manifest['exported_at'] = started.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        manifest['watermark'] = watermark.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        npzexport.write_manifest(out_dir, manifest)
+        return written
+
+    def get_export_changes(self, since):
+        """Returns the partitions to export as a dict from (market, year)
+        to the ids of the stocks with datapoints in it loaded after since,
+        or to None, meaning all stocks, if since is None.
+
+        """
+        query = select([datapoint_table.c.stock_id, stock_table.c.market,
+                        func.min(datapoint_table.c.date),
+                        func.max(datapoint_table.c.date)],
+                       datapoint_table.c.stock_id == stock_table.c.id)
+        if since is not None:
+            query = query.where(datapoint_table.c.valid_from > since)
+        query = query.group_by(datapoint_table.c.stock_id, stock_table.c.market)
+        changes = {}
+        for [stock_id, market, min_date, max_date] in self.engine.execute(query):
+            # sqlite hands aggregated dates back as strings
+            min_date = self.parse_iso_date(str(min_date))
+            max_date = self.parse_iso_date(str(max_date))
+            for year in xrange(min_date.year, max_date.year + 1):
+                if since is None: changes[(market, year)] = None
+                else: changes.setdefault((market, year), set()).add(stock_id)
+        return changes
+
+    def query_export(self, market, year, stock_ids=None):
+        """Returns the datapoints of the market's stocks, or of those in
+        stock_ids, dated in year, sorted by symbol then date, as
+        npzexport columns. Rows are streamed from a server side cursor
+        settings.export_batch_size at a time, so only the partition's
+        arrays are ever held whole.
+
+        """
+        condition = and_(datapoint_table.c.stock_id == stock_table.c.id,
+                         stock_table.c.market == market,
+                         datapoint_table.c.date >= date(year, 1, 1),
+                         datapoint_table.c.date <= date(year, 12, 31))
+        if stock_ids is not None:
+            condition = and_(condition, datapoint_table.c.stock_id.in_(stock_ids))
+        query = select([stock_table.c.symbol, datapoint_table.c.date] +
+                       [datapoint_table.c[field] for field in columnar.FIELDS],
+                       condition).order_by(stock_table.c.symbol,
+                                           datapoint_table.c.date)
+        connection = self.engine.connect().execution_options(stream_results=True)
+        chunks = []
+        try:
+            result = connection.execute(query)
+            while True:
+                rows = result.fetchmany(self.settings.export_batch_size)
+                if not rows: break
+                chunks.append(npzexport.rows_to_columns(rows))
+        finally:
+            connection.close()
+        return npzexport.concat_columns(chunks)
 
     def load_date_range(self, stock, start_date=None, end_date=None):
         """ fetches the csv for the date range starting from settings.start_date
         inclusive and ending in the parameter end_date
-        appends it to the cache file with no respect for dupes.
+        adds it to the cache file with no respect for dupes.
+        Only the parts of the range not already cached are fetched,
+        and last_cache_update is saved to the db.
 
         Returns False in case of failure, number of rows appended if success.
         """
         if not start_date:
-            if not self.stock.last_cache_update:
+            if not stock.last_cache_update:
                 start_date = self.settings.start_date
             else:
                 start_date = stock.last_cache_update + timedelta(days=1)
         if not end_date: end_date = self.settings.today
-        url = self.compose_yahoo_url(stock.symbol, start_date, end_date)
-        num_appended = 0
-        cache_file = open(self.get_cache_file_path(stock.symbol, stock.market), 'a')
-        try:
-            data = urllib2.urlopen(url).read()
-        except HTTPError:
-            return False
-        lines = data.split("\n")[1:-1]
-        for line in lines:
-            line += "\n"
-            cache_file.write(line)
-            num_appended += 1
-        cache_file.flush()
-        cache_file.close()
-        stock.last_cache_update = end_date
+        self.ensure_cache_file_exists(stock.symbol, stock.market)
+        num_appended = self.fetch_missing(stock.symbol, stock.market,
+                                          start_date, end_date,
+                                          stock.last_cache_update)
+        if num_appended is not False:
+            stock.last_cache_update = end_date
+            self.Session().commit()
         return num_appended
 
-    def dedupe(self, symbol, market):
-        """removes duplicates
-        uses sha1 sums to detect duplicates.
-        Returns int with number of dupes found.
-        """
-        hashes = []
-        unique_lines = []
-        dupes_found = 0
-        cache_file = open(self.get_cache_file_path(symbol, market), 'r')
-        for line in cache_file:
-            h = hashlib.sha1(line).hexdigest()
-            if h not in hashes:
-                hashes.append(h)
-                unique_lines.append(line)
-            else: dupes_found += 1
-        cache_file.close()
-        cache_file = open(self.get_cache_file_path(symbol, market), 'w')
-        for i in unique_lines: cache_file.write(i)
-        cache_file.close()
-        return dupes_found
+# the StockCollection of a parallel load worker process
+worker_collection = None
+
+# and update_db's assume_unique
+worker_assume_unique = None
+
+def init_load_worker(settings, day_lock, assume_unique=None):
+    global worker_collection, worker_assume_unique
+    worker_collection = StockCollection(settings)
+    worker_collection.day_lock = day_lock
+    worker_assume_unique = assume_unique
+
+def load_stock(stock_id):
+    """Runs update_stock_in_db for one stock in a load worker.
+    Returns [process id, rows inserted, rows skipped, run statistics].
+
+    """
+    session = worker_collection.Session()
+    stock = session.query(Stock).get(stock_id)
+    worker_collection.stats.reset()
+    result = worker_collection.update_stock_in_db(stock,
+                                                  assume_unique=worker_assume_unique)
+    return [os.getpid()] + result + [worker_collection.stats.report()]
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+from optparse import OptionParser
+from timeit import default_timer
+
+import sqlalchemy
+from sqlalchemy import create_engine
+
+import columnar
+from StockCollection import StockCollection
+from fakeyahoo import start_fake_yahoo
+from model import datapoint_table, stock_table
+import settings
+
+# Benchmarks for the parse, dedupe, fetch and db load paths, run against
+# synthetic data. Results are written as json, one record per benchmark,
+# so runs of different versions can be compared.
+
+RESULTS_FORMAT = 1
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def synthetic_symbols(num_symbols):
+    """Returns num_symbols made up ticker symbols.
+
+    """
+    symbols = []
+    for i in xrange(num_symbols):
+        symbol = ""
+        while True:
+            symbol = chr(ord('A') + i % 26) + symbol
+            i = i / 26 - 1
+            if i < 0: break
+        symbols.append(u"Q" + symbol)
+    return symbols
+
+
+def write_symbols_file(path, symbols):
+    """Writes a symbols file in the format load_symbols reads.
+
+    """
+    symbols_file = open(path, 'w')
+    symbols_file.write("Symbol\tDescription\r\n")
+    for symbol in symbols:
+        symbols_file.write("%s\t%s Inc\r\n" % (symbol, symbol))
+    symbols_file.close()
+
+
+def synthetic_history(symbol, start_date, end_date, seed=0):
+    """Returns Yahoo format csv rows, without the header, for every
+    weekday from start_date to end_date in ascending date order. Prices
+    follow a random walk; the same symbol and seed give the same rows.
+
+    """
+    rand = random.Random(seed * 1000003 + zlib.crc32(symbol.encode('ascii')))
+    price = rand.uniform(5, 200)
+    lines = []
+    day = start_date
+    while day <= end_date:
+        if day.weekday() < 5:
+            open_val = price
+            close = max(0.01, open_val * (1 + rand.gauss(0, 0.02)))
+            high = max(open_val, close) * (1 + rand.random() * 0.01)
+            low = min(open_val, close) * (1 - rand.random() * 0.01)
+            lines.append("%s,%.2f,%.2f,%.2f,%.2f,%d,%.2f" %
+                         (day.isoformat(), open_val, high, low, close,
+                          rand.randint(10000, 10000000), close))
+            price = close
+        day += ONE_DAY
+    return lines
+
+
+class BenchSettings(object):
+    """A copy of the settings module with overrides, so benchmarks
+    leave the real settings alone.
+
+    """
+    def __init__(self, **overrides):
+        for name in dir(settings):
+            if not name.startswith('_'): setattr(self, name, getattr(settings, name))
+        for name, value in overrides.items(): setattr(self, name, value)
+
+
+class Workload(object):
+    """Synthetic symbols and their histories in a scratch directory.
+    pg_url names a postgresql db to load into besides sqlite.
+
+    """
+    def __init__(self, num_symbols, years, seed=0, pg_url=None):
+        self.pg_url = pg_url
+        self.end_date = datetime.date(year=2012, month=12, day=31)
+        self.start_date = datetime.date(year=self.end_date.year - years + 1,
+                                        month=1, day=1)
+        self.symbols = synthetic_symbols(num_symbols)
+        self.histories = dict((symbol, synthetic_history(symbol, self.start_date,
+                                                         self.end_date, seed))
+                              for symbol in self.symbols)
+        self.num_rows = sum([len(lines) for lines in self.histories.values()])
+        self.workdir = tempfile.mkdtemp(prefix="sdc-bench-")
+        self.symbols_path = os.path.join(self.workdir, "symbols.txt")
+        write_symbols_file(self.symbols_path, self.symbols)
+
+    def settings(self, name, db_url=None, **overrides):
+        """Returns BenchSettings with a cache dir of its own under the
+        scratch directory, and an sqlite db there unless db_url is given.
+
+        """
+        path = os.path.join(self.workdir, name)
+        os.mkdir(path)
+        if db_url is None: db_url = "sqlite:///" + os.path.join(path, "bench.db")
+        options = {'db_url': db_url,
+                   'cache_dir': os.path.join(path, "cache"),
+                   'start_date': self.start_date,
+                   'today': self.end_date,
+                   'symbols_files': [{u'name': u'BENCH', u'file': self.symbols_path}],
+                   'fetch_rate': None}
+        options.update(overrides)
+        os.mkdir(options['cache_dir'])
+        return BenchSettings(**options)
+
+    def collection(self, name, db_url=None, **overrides):
+        """Returns a StockCollection over a fresh db holding the
+        workload's symbols.
+
+        """
+        stock_collection = StockCollection(self.settings(name, db_url, **overrides))
+        stock_collection.wipe()
+        stock_collection.create_db()
+        stock_collection = StockCollection(stock_collection.settings)
+        stock_collection.load_symbols(stock_collection.settings)
+        return stock_collection
+
+    def write_caches(self, stock_collection, duplicate_fraction=0.0):
+        """Writes each symbol's history to its cache file, with the
+        last duplicate_fraction of rows written out a second time.
+
+        """
+        for stock in stock_collection.stocks:
+            lines = self.histories[stock.symbol]
+            lines = lines + lines[len(lines) - int(len(lines) * duplicate_fraction):]
+            path = stock_collection.get_cache_file_path(stock.symbol, stock.market)
+            cache_file = open(path, 'w')
+            cache_file.write("".join([line + "\n" for line in lines]))
+            cache_file.close()
+            index_path = stock_collection.get_cache_index_path(stock.symbol, stock.market)
+            if os.path.exists(index_path): os.remove(index_path)
+
+    def close(self):
+        shutil.rmtree(self.workdir, True)
+
+
+def measure(name, num_rows, repeat, run, setup=None, **labels):
+    """Times run repeat times, calling setup untimed before each run.
+
+    Returns a result record.
+    """
+    timings = []
+    for foo in xrange(repeat):
+        if setup: setup()
+        started = default_timer()
+        run()
+        timings.append(default_timer() - started)
+    timings.sort()
+    result = {'benchmark': name,
+              'rows': num_rows,
+              'repeat': repeat,
+              'best': timings[0],
+              'median': timings[len(timings) / 2],
+              'rows_per_sec': num_rows / max(timings[0], 1e-9)}
+    result.update(labels)
+    return result
+
+
+def bench_parse(workload, repeat):
+    lines = [line for lines in workload.histories.values() for line in lines]
+    stock_collection = StockCollection(workload.settings("parse"))
+    text = "".join([line + "\n" for line in lines])
+
+    def parse_lines():
+        for line in lines: stock_collection.parse_csv_line(line)
+
+    def parse_rows():
+        for line in lines: stock_collection.parse_csv_row(line)
+
+    return [measure("parse_csv_line", len(lines), repeat, parse_lines),
+            measure("parse_csv_row", len(lines), repeat, parse_rows),
+            measure("columnar.parse_csv", len(lines), repeat,
+                    lambda: columnar.parse_csv(text))]
+
+
+def bench_dedupe(workload, repeat):
+    stock_collection = workload.collection("dedupe")
+    duplicate_fraction = 0.25
+    num_rows = int(workload.num_rows * (1 + duplicate_fraction))
+
+    def setup():
+        workload.write_caches(stock_collection, duplicate_fraction)
+
+    results = []
+    for mode in ['line', 'date', 'newest']:
+        def run():
+            for stock in stock_collection.stocks:
+                stock_collection.dedupe(stock.symbol, stock.market, mode)
+        results.append(measure("dedupe", num_rows, repeat, run, setup, mode=mode))
+    return results
+
+
+def bench_fetch(workload, repeat):
+    server = start_fake_yahoo(workload.histories)
+    stock_collection = workload.collection("fetch", yahoo_url=server.url)
+
+    def setup():
+        for stock in stock_collection.stocks:
+            open(stock_collection.get_cache_file_path(stock.symbol, stock.market), 'w').close()
+            index_path = stock_collection.get_cache_index_path(stock.symbol, stock.market)
+            if os.path.exists(index_path): os.remove(index_path)
+            stock.last_cache_update = None
+        stock_collection.Session().commit()
+
+    def run():
+        for stock in stock_collection.stocks:
+            if stock_collection.load_date_range(stock) is False:
+                raise RuntimeError(u"fetching %s failed" % stock.symbol)
+
+    try:
+        return [measure("load_date_range", workload.num_rows, repeat, run, setup)]
+    finally:
+        stock_collection.http.close()
+        server.shutdown()
+
+
+def bench_load(workload, repeat):
+    backends = [["sqlite", None]]
+    if workload.pg_url: backends.append(["postgresql", workload.pg_url])
+    results = []
+    for [backend, db_url] in backends:
+        for bulk_load in [True, False]:
+            name = "load-%s-%s" % (backend, bulk_load and "bulk" or "rows")
+            stock_collection = workload.collection(name, db_url, bulk_load=bulk_load)
+            workload.write_caches(stock_collection)
+
+            def setup():
+                session = stock_collection.Session()
+                session.execute(datapoint_table.delete())
+                session.execute(stock_table.update().values(last_db_update=None))
+                session.commit()
+                session.expire_all()
+
+            def run():
+                report = stock_collection.update_db()
+                if report['inserted'] != workload.num_rows:
+                    raise RuntimeError(u"loaded %s rows, expected %s"
+                                       % (report['inserted'], workload.num_rows))
+
+            results.append(measure("update_stock_in_db", workload.num_rows,
+                                   repeat, run, setup, backend=backend,
+                                   bulk_load=bulk_load))
+            if db_url: stock_collection.wipe()
+            stock_collection.Session().close_all()
+            stock_collection.engine.dispose()
+    return results
+
+
+BENCHMARKS = [['parse', bench_parse],
+              ['dedupe', bench_dedupe],
+              ['fetch', bench_fetch],
+              ['load', bench_load]]
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(num_symbols, years, repeat=3, seed=0, only=None, pg_url=None):
+    """Runs the benchmarks named in only, or all of them, over a
+    workload of num_symbols symbols with years of history each.
+
+    Returns a dict of the run's environment and its result records.
+    """
+    workload = Workload(num_symbols, years, seed, pg_url)
+    try:
+        results = []
+        for [name, bench] in BENCHMARKS:
+            if only and name not in only: continue
+            results.extend(bench(workload, repeat))
+    finally:
+        workload.close()
+    return {'format': RESULTS_FORMAT,
+            'revision': git_revision(),
+            'started': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'numpy': columnar.np.__version__,
+            'platform': platform.platform(),
+            'workload': {'symbols': num_symbols,
+                         'years': years,
+                         'seed': seed,
+                         'rows': workload.num_rows},
+            'results': results}
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--symbols", type="int", dest="symbols", default=20,
+                      help="number of synthetic symbols")
+    parser.add_option("-y", "--years", type="int", dest="years", default=5,
+                      help="years of daily history per symbol")
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                      help="timed runs per benchmark, the best is reported")
+    parser.add_option("--seed", type="int", dest="seed", default=0,
+                      help="seed for the synthetic prices")
+    parser.add_option("--only", action="append", dest="only", default=[],
+                      help="run only this benchmark: %s. May be repeated"
+                      % ", ".join([name for [name, bench] in BENCHMARKS]))
+    parser.add_option("--pg-url", dest="pg_url", default=None,
+                      help="also load into this postgresql db. Its tables are dropped!")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write json results here rather than to stdout")
+    (options, args) = parser.parse_args()
+    report = run_benchmarks(options.symbols, options.years, options.repeat,
+                            options.seed, options.only, options.pg_url)
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write("\n")
+    if options.output: output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+
+class Checkpoint(object):
+    """Durable log of the items a run has finished, so that a run
+    interrupted part way can be resumed without redoing them. The log's
+    first line names the run, and a log left by any other run is
+    discarded. Each item is fsynced as it is marked; a last line torn
+    by a crash is ignored. Safe to mark items from several threads.
+
+    """
+    def __init__(self, path, run_id):
+        self.path     = path
+        self.run_id   = run_id
+        self.lock     = threading.Lock()
+        self.log_file = None
+        self.done     = self.read()
+
+    def read(self):
+        if not os.path.exists(self.path): return set()
+        log_file = open(self.path)
+        try:
+            # whatever follows the last newline is torn
+            lines = log_file.read().split("\n")[:-1]
+        finally:
+            log_file.close()
+        if not lines or lines[0] != self.run_id: return set()
+        return set(lines[1:])
+
+    def __contains__(self, item):
+        return item in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def mark(self, item):
+        """Records item as done, durably.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.log_file is None:
+                # rewritten first, so a torn line isn't appended to
+                temp_file = open(self.path + ".tmp", 'w')
+                temp_file.write("".join([line + "\n" for line
+                                         in [self.run_id] + sorted(self.done)]))
+                temp_file.close()
+                os.rename(self.path + ".tmp", self.path)
+                self.log_file = open(self.path, 'a')
+            self.log_file.write(item + "\n")
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.done.add(item)
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        """Removes the log, the run being complete.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.log_file: self.log_file.close()
+            self.log_file = None
+            if os.path.exists(self.path): os.remove(self.path)
+        finally:
+            self.lock.release()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import string
+import numpy as np
+
+FIELDS = ('open_val', 'high', 'low', 'close', 'volume', 'adj_close')
+
+# a cache row holds 14 integers once the separators are blanked out:
+# year month day, then lhs and rhs of each price, volume being whole
+INTS_PER_ROW = 14
+PRICE_COLUMNS = {'open_val': 3, 'high': 5, 'low': 7, 'close': 9, 'adj_close': 12}
+VOLUME_COLUMN = 11
+
+SEPARATORS = string.maketrans(",-.\n\r", "     ")
+
+
+def parse_csv(text):
+    """Parses Yahoo format csv rows, without the header, into columns.
+    Gives the same values as StockCollection.parse_csv_line, prices
+    being int64 cents computed as int(lhs)*100 + int(rhs).
+
+    Returns a dict of numpy arrays: 'date' as datetime64[D] and
+    int64 arrays for each of FIELDS.
+    """
+    if isinstance(text, unicode): text = text.encode('ascii')
+    ints = np.fromstring(text.translate(SEPARATORS), dtype=np.int64, sep=" ")
+    if len(ints) % INTS_PER_ROW:
+        raise ValueError(u"malformed csv: %s values do not make whole rows"
+                         % len(ints))
+    ints = ints.reshape(-1, INTS_PER_ROW)
+    months = (ints[:, 0] - 1970) * 12 + ints[:, 1] - 1
+    columns = {}
+    columns['date'] = months.astype('datetime64[M]').astype('datetime64[D]') +\
+                      (ints[:, 2] - 1).astype('timedelta64[D]')
+    for field, i in PRICE_COLUMNS.items():
+        columns[field] = ints[:, i] * 100 + ints[:, i+1]
+    columns['volume'] = ints[:, VOLUME_COLUMN].copy()
+    return columns
+
+
+def iter_csv_chunks(path, chunk_rows=100000, offset=0):
+    """Parses the cache file at path from byte offset in chunks of about
+    chunk_rows rows, yielding a dict of columns per chunk as parse_csv does.
+
+    """
+    # cache rows run to about 50 bytes
+    size_hint = chunk_rows * 50
+    csv_file = open(path)
+    csv_file.seek(offset)
+    try:
+        while True:
+            lines = csv_file.readlines(size_hint)
+            if not lines: break
+            yield parse_csv("".join(lines))
+    finally:
+        csv_file.close()
+
+
+def select(columns, mask):
+    """Returns the rows of columns where mask is true.
+
+    """
+    return dict((name, column[mask]) for name, column in columns.items())
+
+
+def date_window(columns, start_date, end_date):
+    """Returns a boolean mask of rows dated start_date to end_date inclusive.
+
+    """
+    dates = columns['date']
+    return (dates >= np.datetime64(start_date, 'D')) &\
+           (dates <= np.datetime64(end_date, 'D'))
+
+
+# Binary cache files are a header followed by fixed width records, one
+# per date in ascending date order, so they can be memory mapped and
+# date ranges found by binary search.
+MAGIC = "SDCB"
+FORMAT_VERSION = 1
+HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('rows', '<u8')])
+HEADER_SIZE = 64
+RECORD = np.dtype([('date', '<M8[D]')] + [(field, '<i8') for field in FIELDS])
+
+
+def to_records(columns):
+    """Packs columns into a record array sorted by date, keeping
+    only the first row of any repeated date, as loading from the csv
+    does.
+
+    """
+    order = np.argsort(columns['date'], kind='mergesort')
+    dates = columns['date'][order]
+    first = np.ones(len(dates), dtype=bool)
+    first[1:] = dates[1:] != dates[:-1]
+    order = order[first]
+    records = np.zeros(len(order), dtype=RECORD)
+    records['date'] = columns['date'][order]
+    for field in FIELDS: records[field] = columns[field][order]
+    return records
+
+
+def write_records(path, records):
+    """Writes a binary cache file through a temp file and rename.
+
+    """
+    header = np.zeros(1, dtype=HEADER)
+    header['magic'] = MAGIC
+    header['version'] = FORMAT_VERSION
+    header['rows'] = len(records)
+    temp_path = path + ".tmp"
+    out_file = open(temp_path, 'wb')
+    try:
+        out_file.write(header.tostring().ljust(HEADER_SIZE, "\0"))
+        out_file.write(records.tostring())
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    finally:
+        out_file.close()
+    os.rename(temp_path, path)
+
+
+def open_records(path):
+    """Memory maps a binary cache file read only.
+
+    Returns its record array.
+    """
+    header = np.fromfile(path, dtype=HEADER, count=1)
+    if len(header) != 1 or header['magic'][0] != MAGIC:
+        raise ValueError(u"%s is not a binary cache file" % path)
+    if header['version'][0] != FORMAT_VERSION:
+        raise ValueError(u"%s has unsupported format version %s"
+                         % (path, header['version'][0]))
+    rows = int(header['rows'][0])
+    if rows == 0: return np.zeros(0, dtype=RECORD)
+    return np.memmap(path, dtype=RECORD, mode='r',
+                     offset=HEADER_SIZE, shape=(rows,))
+
+
+def date_slice(records, start_date, end_date):
+    """Returns the records dated start_date to end_date inclusive, found
+    by binary search, as a view onto records.
+
+    """
+    dates = records['date']
+    first = np.searchsorted(dates, np.datetime64(start_date, 'D'), 'left')
+    last = np.searchsorted(dates, np.datetime64(end_date, 'D'), 'right')
+    return records[first:last]
+
+
+def records_to_columns(records):
+    """Returns a dict of column views onto records, keyed as parse_csv does.
+
+    """
+    return dict((name, records[name]) for name in RECORD.names)
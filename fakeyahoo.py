@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import gzip
+import socket
+import sys
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from urlparse import urlparse, parse_qs
+
+# a stand in for the Yahoo price server, for tests and benchmarks
+
+
+class FakeYahooHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves csv for compose_yahoo_url style requests from rows, a
+    dict of cache lines per symbol, newest row first like Yahoo does.
+    Unknown symbols get a 404. Keeps connections alive and gzips the
+    body when asked to. The addresses of clients are noted in clients.
+
+    Errors are injected through faults, a dict of lists per symbol:
+    each request for the symbol takes the first fault off its list,
+    either an http status to answer with, 'drop' to close the
+    connection without answering, 'malformed' to add a row that does
+    not parse or 'truncate' to send only the first half of the gzipped
+    body. Every response is held back by
+    latency seconds.
+
+    """
+    protocol_version = 'HTTP/1.1'
+    rows = {}
+    clients = set()
+    faults = {}
+    latency = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        symbol = query['s'][0]
+        if self.latency: time.sleep(self.latency)
+        self.lock.acquire()
+        try:
+            faults = self.faults.get(symbol)
+            if faults: fault = faults.pop(0)
+            else: fault = None
+        finally:
+            self.lock.release()
+        if fault == 'drop':
+            self.close_connection = 1
+            return
+        if fault and fault not in ('malformed', 'truncate'):
+            self.send_error(fault)
+            return
+        if symbol not in self.rows:
+            self.send_error(404)
+            return
+        start_date = datetime.date(year=int(query['c'][0]),
+                                   month=int(query['a'][0])+1,
+                                   day=int(query['b'][0]))
+        end_date = datetime.date(year=int(query['f'][0]),
+                                 month=int(query['d'][0])+1,
+                                 day=int(query['e'][0]))
+        lines = [line for line in self.rows[symbol]
+                 if start_date.isoformat() <= line[:10] <= end_date.isoformat()]
+        lines.sort(reverse=True)
+        body = "Date,Open,High,Low,Close,Volume,Adj Close\n"
+        body += "".join([line + "\n" for line in lines])
+        if fault == 'malformed': body += "2012-03-2,44.87,45.12\n"
+        self.clients.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+            gzip_file.write(body)
+            gzip_file.close()
+            body = buf.getvalue()
+            if fault == 'truncate': body = body[:len(body) // 2]
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeYahooServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that timed out leave broken pipes behind
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+def start_fake_yahoo(rows, handler=FakeYahooHandler):
+    """Starts a fake Yahoo server serving rows on a free local port.
+    Returns the server; its url is server.url and its handler class,
+    holding rows, clients, faults and latency, is server.handler.
+
+    """
+    class ServerHandler(handler):
+        pass
+    ServerHandler.rows = rows
+    ServerHandler.clients = set()
+    ServerHandler.faults = {}
+    ServerHandler.lock = threading.Lock()
+    server = FakeYahooServer(('127.0.0.1', 0), ServerHandler)
+    server.handler = ServerHandler
+    server.url = u"http://127.0.0.1:%s/table.csv" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
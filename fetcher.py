@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import httplib
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+from Queue import Queue, Empty
+from urllib2 import HTTPError
+from urlparse import urlparse
+
+# what a failed fetch can raise: socket errors and timeouts, HTTPError,
+# CircuitOpenError and, for broken responses, httplib's exceptions and
+# BadResponseError
+FETCH_ERRORS = (IOError, httplib.HTTPException)
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of sending a request to a host whose circuit
+    breaker is open.
+
+    """
+
+
+class BadResponseError(httplib.HTTPException):
+    """Raised for a response body that cannot be decoded, such as a
+    corrupt or truncated gzip stream.
+
+    """
+
+
+def is_transient(error):
+    """Returns whether a failed fetch is worth retrying: connection
+    errors, timeouts, broken responses and 429 or 5xx statuses.
+
+    """
+    if isinstance(error, CircuitOpenError): return False
+    if isinstance(error, HTTPError): return error.code == 429 or error.code >= 500
+    return isinstance(error, FETCH_ERRORS)
+
+
+def backoff_delay(attempt, base, cap):
+    """Returns the seconds to wait before retry number attempt, counting
+    from 1: exponential backoff from base, capped at cap, with full
+    jitter so that retrying clients spread out.
+
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter.
+    Tokens accrue at rate per second, up to capacity.
+
+    """
+    def __init__(self, rate, capacity):
+        self.rate     = float(rate)
+        self.capacity = float(capacity)
+        self.tokens   = float(capacity)
+        self.stamp    = time.time()
+        self.lock     = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it.
+
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+
+class HostLimiter(object):
+    """Hands out one semaphore per host, capping the number of
+    requests in flight against any single host.
+
+    """
+    def __init__(self, limit):
+        self.limit      = limit
+        self.semaphores = {}
+        self.lock       = threading.Lock()
+
+    def slot(self, host):
+        self.lock.acquire()
+        try:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+        finally:
+            self.lock.release()
+
+
+class CircuitBreaker(object):
+    """Per host circuit breaker. After threshold consecutive failed
+    requests to a host its circuit opens, and requests to it are
+    refused for reset_seconds. Then one trial request is let through;
+    its success closes the circuit and its failure opens it again.
+    A threshold of 0 or None never opens.
+
+    """
+    def __init__(self, threshold, reset_seconds):
+        self.threshold     = threshold
+        self.reset_seconds = reset_seconds
+        self.failures      = {}
+        self.opened        = {}
+        self.trials        = set()
+        self.lock          = threading.Lock()
+
+    def allow(self, host):
+        """Returns whether a request to host may be sent.
+
+        """
+        self.lock.acquire()
+        try:
+            opened = self.opened.get(host)
+            if opened is None: return True
+            if host in self.trials or time.time() < opened + self.reset_seconds:
+                return False
+            self.trials.add(host)
+            return True
+        finally:
+            self.lock.release()
+
+    def succeeded(self, host):
+        self.lock.acquire()
+        try:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+            self.trials.discard(host)
+        finally:
+            self.lock.release()
+
+    def failed(self, host):
+        self.lock.acquire()
+        try:
+            self.trials.discard(host)
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.threshold and self.failures[host] >= self.threshold:
+                self.opened[host] = time.time()
+        finally:
+            self.lock.release()
+
+
+class FetchPool(object):
+    """Runs a function over a list of items on a pool of worker threads.
+    With a single worker, runs inline in the calling thread.
+
+    """
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+
+    def map(self, func, items):
+        """Returns the results of func for each item, in item order.
+        If any call raised, the first such exception is re-raised once
+        all workers are done.
+
+        """
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            return [func(item) for item in items]
+        results = [None] * len(items)
+        errors = []
+        queue = Queue()
+        for i, item in enumerate(items): queue.put((i, item))
+
+        def work():
+            while True:
+                try:
+                    i, item = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except Exception, e:
+                    errors.append((i, e))
+
+        threads = [threading.Thread(target=work)
+                   for _ in xrange(min(self.workers, len(items)))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if errors:
+            errors.sort()
+            raise errors[0][1]
+        return results
+
+
+class HTTPClient(object):
+    """Thread safe HTTP GET client keeping a pool of idle keep-alive
+    connections per host. Asks for gzip and decompresses as the body
+    streams in. Counts body bytes as received on the wire and after
+    decoding.
+
+    """
+    chunk_size = 16384
+
+    def __init__(self, connect_timeout, read_timeout, gzip=True):
+        self.connect_timeout = connect_timeout
+        self.read_timeout    = read_timeout
+        self.gzip            = gzip
+        self.idle            = {}
+        self.lock            = threading.Lock()
+        self.requests        = 0
+        self.connections     = 0
+        self.bytes_wire      = 0
+        self.bytes_decoded   = 0
+
+    def checkout(self, scheme, netloc, fresh=False):
+        """Returns an idle connection to the host, or a new one, always
+        a new one with fresh. Second value tells whether the connection
+        was reused.
+
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle.get((scheme, netloc))
+            if idle and not fresh: return [idle.pop(), True]
+            self.connections += 1
+        finally:
+            self.lock.release()
+        if scheme == 'https': connection_class = httplib.HTTPSConnection
+        else: connection_class = httplib.HTTPConnection
+        connection = connection_class(netloc, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return [connection, False]
+
+    def checkin(self, scheme, netloc, connection):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+        finally:
+            self.lock.release()
+
+    def get(self, url):
+        """Fetches url. Raises HTTPError on a non 200 response.
+
+        Returns the decoded response body.
+        """
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query: path += '?' + parsed.query
+        headers = {'Connection': 'keep-alive'}
+        if self.gzip: headers['Accept-Encoding'] = 'gzip'
+        [connection, reused] = self.checkout(parsed.scheme, parsed.netloc)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused: raise
+            # the server dropped an idle connection, try once on a new
+            # one, the other idle ones being likely dropped too
+            [connection, reused] = self.checkout(parsed.scheme, parsed.netloc,
+                                                 fresh=True)
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        try:
+            [body, num_wire] = self.read_body(response)
+        except:
+            connection.close()
+            raise
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.bytes_wire += num_wire
+            self.bytes_decoded += len(body)
+        finally:
+            self.lock.release()
+        if response.will_close: connection.close()
+        else: self.checkin(parsed.scheme, parsed.netloc, connection)
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, None)
+        return body
+
+    def read_body(self, response):
+        """Reads the response body, decompressing it chunk by chunk
+        if gzipped. Returns the body and the number of bytes read.
+        Raises BadResponseError if the gzip stream is corrupt, or ends
+        before its trailer's length is reached.
+
+        """
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else: decoder = None
+        parts = []
+        num_wire = 0
+        # the last 8 bytes of a gzip stream are its crc and length
+        trailer = ""
+        try:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk: break
+                num_wire += len(chunk)
+                if decoder:
+                    trailer = (trailer + chunk)[-8:]
+                    chunk = decoder.decompress(chunk)
+                parts.append(chunk)
+            if decoder: parts.append(decoder.flush())
+        except zlib.error, e:
+            raise BadResponseError(u"corrupt gzip body: %s" % e)
+        body = "".join(parts)
+        if decoder and (len(trailer) < 8 or
+                        struct.unpack("<I", trailer[4:])[0] != len(body) & 0xffffffff):
+            raise BadResponseError(u"truncated gzip body")
+        return [body, num_wire]
+
+    def stats(self):
+        """Returns request, connection and byte counters.
+
+        """
+        self.lock.acquire()
+        try:
+            return {'requests': self.requests,
+                    'connections': self.connections,
+                    'bytes_wire': self.bytes_wire,
+                    'bytes_decoded': self.bytes_decoded}
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection in connections: connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
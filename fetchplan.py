@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+
+# date range arithmetic for planning fetches. A range is a
+# [start, end] pair of dates, both inclusive.
+
+ONE_DAY = timedelta(days=1)
+
+
+def union(ranges):
+    """Returns ranges sorted, with overlapping and touching ranges joined.
+
+    """
+    result = []
+    for [start, end] in sorted([list(r) for r in ranges]):
+        if start > end: continue
+        if result and start <= result[-1][1] + ONE_DAY:
+            if end > result[-1][1]: result[-1][1] = end
+        else: result.append([start, end])
+    return result
+
+
+def subtract(start_date, end_date, ranges):
+    """Returns the parts of start_date to end_date not in ranges.
+
+    """
+    result = []
+    cursor = start_date
+    for [start, end] in union(ranges):
+        if end < cursor: continue
+        if start > end_date: break
+        if start > cursor: result.append([cursor, start - ONE_DAY])
+        cursor = end + ONE_DAY
+    if cursor <= end_date: result.append([cursor, end_date])
+    return result
+
+
+def plan_fetches(start_date, end_date, covered, merge_days):
+    """Returns the date ranges to request to fill start_date to end_date,
+    given the ranges already covered. Ranges no more than merge_days
+    apart are merged into one request, refetching what lies between.
+
+    """
+    plan = []
+    for [start, end] in subtract(start_date, end_date, covered):
+        if plan and (start - plan[-1][1]).days <= merge_days:
+            plan[-1][1] = end
+        else: plan.append([start, end])
+    return plan
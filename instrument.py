@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the latency histogram buckets. A last
+# bucket takes everything slower
+LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Stats(object):
+    """Thread safe run statistics: time spent per stage, counters per
+    symbol and latency histograms. Stage times are summed over threads,
+    so concurrent stages can add up to more than the run took.
+
+    If profile_stage names a stage, that stage runs under cProfile,
+    in one thread at a time.
+    """
+    def __init__(self, profile_stage=None):
+        self.profile_stage = profile_stage
+        self.profiler      = None
+        self.profile_lock  = threading.Lock()
+        self.lock          = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.started    = time.time()
+            self.stages     = {}
+            self.symbols    = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as a call of the stage name.
+
+        """
+        profiling = name == self.profile_stage and self.profile_lock.acquire(False)
+        if profiling:
+            if self.profiler is None: self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started)
+            if profiling:
+                self.profiler.disable()
+                self.profile_lock.release()
+
+    def timed_iter(self, name, iterable):
+        """Yields the items of iterable, timing the wait for each
+        as a call of the stage name.
+
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+    def add_time(self, name, seconds, calls=1):
+        self.lock.acquire()
+        try:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stage['calls'] += calls
+            stage['seconds'] += seconds
+        finally:
+            self.lock.release()
+
+    def count(self, symbol, name, n=1):
+        """Adds n to the symbol's counter name.
+
+        """
+        self.lock.acquire()
+        try:
+            counters = self.symbols.setdefault(symbol, {})
+            counters[name] = counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def observe(self, name, seconds):
+        """Adds a latency to the histogram name.
+
+        """
+        bucket = 0
+        while bucket < len(LATENCY_BOUNDS) and seconds > LATENCY_BOUNDS[bucket]:
+            bucket += 1
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = {'bounds': list(LATENCY_BOUNDS),
+                             'counts': [0] * (len(LATENCY_BOUNDS) + 1),
+                             'count': 0,
+                             'seconds': 0.0}
+                self.histograms[name] = histogram
+            histogram['counts'][bucket] += 1
+            histogram['count'] += 1
+            histogram['seconds'] += seconds
+        finally:
+            self.lock.release()
+
+    def merge(self, report):
+        """Adds in the stages, counters and histograms of a report
+        from another Stats, as from a worker process.
+
+        """
+        for name, stage in report['stages'].items():
+            self.add_time(name, stage['seconds'], stage['calls'])
+        for symbol, counters in report['symbols'].items():
+            for name, n in counters.items(): self.count(symbol, name, n)
+        self.lock.acquire()
+        try:
+            for name, other in report['histograms'].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = dict(other, counts=list(other['counts']))
+                    continue
+                histogram['counts'] = [a + b for a, b in zip(histogram['counts'],
+                                                             other['counts'])]
+                histogram['count'] += other['count']
+                histogram['seconds'] += other['seconds']
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """Returns the statistics as a dict of plain values, with
+        counters also summed over all symbols under 'totals'.
+
+        """
+        self.lock.acquire()
+        try:
+            totals = {}
+            for counters in self.symbols.values():
+                for name, n in counters.items(): totals[name] = totals.get(name, 0) + n
+            return {'elapsed': time.time() - self.started,
+                    'stages': dict((name, dict(stage))
+                                   for name, stage in self.stages.items()),
+                    'symbols': dict((symbol, dict(counters))
+                                    for symbol, counters in self.symbols.items()),
+                    'totals': totals,
+                    'histograms': dict((name, dict(histogram, counts=list(histogram['counts'])))
+                                       for name, histogram in self.histograms.items())}
+        finally:
+            self.lock.release()
+
+    def dump_profile(self, path):
+        """Writes the profile of profile_stage to path, for pstats.
+
+        Returns True if there was a profile to write.
+        """
+        if self.profiler is None: return False
+        self.profiler.dump_stats(path)
+        return True
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe cache of at most capacity values, dropping the least
+    recently used first. Each value is stored with the set of tags it
+    depends on, or None for depending on everything, so invalidating
+    a tag drops just the values depending on it.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries  = OrderedDict()
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, key):
+        """Returns the value cached for key, or None.
+
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, tags=None):
+        if self.capacity < 1: return
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, tags)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, tag):
+        """Drops the values depending on tag.
+
+        """
+        self.lock.acquire()
+        try:
+            for key, (value, tags) in self.entries.items():
+                if tags is None or tag in tags: del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns hit, miss and size counters.
+
+        """
+        self.lock.acquire()
+        try:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries)}
+        finally:
+            self.lock.release()
@@ -18,8 +18,9 @@
 # along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
 
 from optparse import OptionParser
-from StockCollection import StockCollection
 import datetime
+import json
+import logging
 import settings
 
 def main():
@@ -42,19 +43,96 @@ def main():
                       dest="update",
                       default=False,
                       help="update the data for all registered symbols")
+    parser.add_option("-C",
+                      "--update-cache",
+                      action="store_true",
+                      dest="update_cache",
+                      default=False,
+                      help="update the cache files of the listed symbols, "
+                      "without the db")
+    parser.add_option("-F",
+                      "--retry-failed",
+                      action="store_true",
+                      dest="retry_failed",
+                      default=False,
+                      help="with --update or --update-cache, fetch only the "
+                      "symbols whose last fetch failed")
+    parser.add_option("-W",
+                      "--work",
+                      action="store_true",
+                      dest="work",
+                      default=False,
+                      help="update the cache files of the listed symbols a "
+                      "shard at a time from the work queue, alongside other "
+                      "workers")
+    parser.add_option("-L",
+                      "--load",
+                      action="store_true",
+                      dest="load",
+                      default=False,
+                      help="register the listed symbols and load their "
+                      "cache files into the db")
+    parser.add_option("-E",
+                      "--export",
+                      action="store_true",
+                      dest="export",
+                      default=False,
+                      help="export the datapoints changed since the last "
+                      "export to NPZ files under settings.export_dir")
     parser.add_option("-D",
                       "--deduplicate",
                       action="store_true",
                       dest="dedupe",
                       default=False,
-                      help="ticker symbol for the stock")
+                      help="remove duplicate rows from the cache files")
+    parser.add_option("-r",
+                      "--report",
+                      dest="report",
+                      default=None,
+                      help="write the run report as json to this file")
     (options, args) = parser.parse_args()
-    s = StockCollection(settings)
-    if options.recreate_db: s.recreate_db()
-    elif options.populate_symbols: s.populate_symbols()
-    elif options.update: s.update_data()
-    elif options.dedupe: print s.dedupe()
-    else: parser.print_usage()
+    logging.basicConfig(filename=settings.logfile, level=logging.INFO,
+                        format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    uses_db = (options.recreate_db or options.populate_symbols or
+               options.update or options.load or options.export)
+    if not (uses_db or options.update_cache or options.work or options.dedupe):
+        parser.print_usage()
+        return
+    # imported here so --help, usage errors and cache only runs don't
+    # pay for loading SQLAlchemy and NumPy
+    if uses_db:
+        from StockCollection import StockCollection
+        s = StockCollection(settings)
+    else:
+        from StockCache import StockCache
+        s = StockCache(settings)
+    if options.recreate_db:
+        s.wipe()
+        s.create_db()
+    elif options.populate_symbols: print s.load_symbols(settings)
+    elif options.update:
+        s.update_cache(failed_only=options.retry_failed)
+        s.update_db()
+    elif options.load:
+        s.load_symbols(settings)
+        s.update_db()
+    elif options.export: print s.export_datapoints()
+    elif options.update_cache: s.update_cache(failed_only=options.retry_failed)
+    elif options.work:
+        import workqueue
+        if settings.work_queue_file:
+            queue = workqueue.FileLeaseQueue(settings.work_queue_file)
+        else:
+            from sqlalchemy import create_engine
+            queue = workqueue.DBLeaseQueue(create_engine(settings.db_url))
+        print s.update_cache_shards(queue)
+    elif options.dedupe:
+        print sum([s.dedupe(stock.symbol, stock.market) for stock in s.stocks])
+    report = s.log_report()
+    if options.report:
+        report_file = open(options.report, 'w')
+        json.dump(report, report_file, indent=2, sort_keys=True)
+        report_file.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import numpy as np
+from columnar import FIELDS
+
+# Exports are directories of NPZ files, one per market and year at
+# MARKET/YEAR.npz, each holding the columns 'symbol', 'date' and FIELDS
+# of the datapoints of that market and year sorted by symbol then date,
+# and a manifest.json describing them.
+
+MANIFEST_VERSION = 1
+
+
+def partition_name(market, year):
+    return u"%s/%04d" % (market, year)
+
+
+def new_manifest():
+    return {'version': MANIFEST_VERSION, 'exported_at': None, 'watermark': None,
+            'columns': ['symbol', 'date'] + list(FIELDS), 'partitions': {}}
+
+
+def read_manifest(out_dir):
+    """Returns the export's manifest, None if there is none or it is
+    of another version.
+
+    """
+    path = os.path.join(out_dir, "manifest.json")
+    if not os.path.exists(path): return None
+    manifest_file = open(path)
+    try:
+        manifest = json.load(manifest_file)
+    finally:
+        manifest_file.close()
+    if manifest.get('version') != MANIFEST_VERSION: return None
+    return manifest
+
+
+def write_manifest(out_dir, manifest):
+    """Writes the manifest through a temp file and rename.
+
+    """
+    path = os.path.join(out_dir, "manifest.json")
+    manifest_file = open(path + ".tmp", 'w')
+    try:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    finally:
+        manifest_file.close()
+    os.rename(path + ".tmp", path)
+
+
+def rows_to_columns(rows):
+    """Returns (symbol, date, FIELDS...) rows as a dict of arrays.
+
+    """
+    values = zip(*rows) or [()] * (len(FIELDS) + 2)
+    columns = {'symbol': np.array(values[0], dtype=np.unicode_),
+               'date': np.array(values[1], dtype='datetime64[D]')}
+    for field, column in zip(FIELDS, values[2:]):
+        columns[field] = np.array(column, dtype=np.int64)
+    return columns
+
+
+def concat_columns(parts):
+    """Joins dicts of arrays end to end.
+
+    """
+    if not parts: return rows_to_columns([])
+    return dict((name, np.concatenate([part[name] for part in parts]))
+                for name in parts[0])
+
+
+def merge_columns(old, new):
+    """Returns old with the rows of the symbols in new replaced by
+    new's, sorted by symbol then date.
+
+    """
+    keep = ~np.in1d(old['symbol'], np.unique(new['symbol']))
+    columns = concat_columns([dict((name, column[keep]) for name, column in old.items()),
+                              new])
+    order = np.lexsort((columns['date'], columns['symbol']))
+    return dict((name, column[order]) for name, column in columns.items())
+
+
+def read_partition(path):
+    partition = np.load(path)
+    try:
+        return dict((name, partition[name]) for name in partition.files)
+    finally:
+        partition.close()
+
+
+def write_partition(path, columns):
+    """Writes columns to the NPZ file at path through a temp file and
+    rename, so readers never see a partial file.
+
+    Returns the partition's manifest entry.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory): os.makedirs(directory)
+    out_file = open(path + ".tmp", 'wb')
+    try:
+        np.savez_compressed(out_file, **columns)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    finally:
+        out_file.close()
+    os.rename(path + ".tmp", path)
+    dates = columns['date']
+    return {'rows': len(dates),
+            'symbols': len(np.unique(columns['symbol'])),
+            'min_date': str(dates.min()) if len(dates) else None,
+            'max_date': str(dates.max()) if len(dates) else None}
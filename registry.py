@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import select, and_, bindparam
+from model import Stock, stock_table
+
+
+class SymbolRegistry(object):
+    """The stocks known to the db, keyed by (market, symbol).
+
+    Stocks are read from the db as they are asked for. The full list
+    is only read when iterated over, after which lookups need no query.
+    """
+    def __init__(self, Session):
+        self.Session   = Session
+        self.by_key    = {}
+        self.by_symbol = {}
+        self.ordered   = []
+        self.complete  = False
+
+    def reset(self):
+        """Forgets the stocks read so far, to be read again as needed.
+
+        """
+        self.by_key    = {}
+        self.by_symbol = {}
+        self.ordered   = []
+        self.complete  = False
+
+    def add(self, stock):
+        self.by_key[(stock.market, stock.symbol)] = stock
+        self.by_symbol[stock.symbol] = stock
+        if self.complete: self.ordered.append(stock)
+
+    def get(self, symbol, market=None):
+        """Returns the stock, or None. Without a market, returns the
+        stock with the symbol on any market.
+
+        """
+        if market is None: stock = self.by_symbol.get(symbol)
+        else: stock = self.by_key.get((market, symbol))
+        if stock is not None or self.complete: return stock
+        query = self.Session().query(Stock).filter(Stock.symbol == symbol)
+        if market is not None: query = query.filter(Stock.market == market)
+        stock = query.first()
+        if stock is not None: self.add(stock)
+        return stock
+
+    def all(self):
+        """Returns all stocks, in the order they were added.
+
+        """
+        if not self.complete:
+            self.ordered = self.Session().query(Stock).order_by(Stock.id).all()
+            for stock in self.ordered: self.add(stock)
+            self.complete = True
+        return list(self.ordered)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self.all())
+
+    def upsert(self, rows):
+        """Adds stocks from (symbol, name, market) rows in bulk, updating
+        the names of those already in the db. Rows whose symbol is in
+        the db under another market, or repeated, are ignored. Commits.
+
+        Returns number of stocks added.
+        """
+        unique_rows = []
+        seen = set()
+        for row in rows:
+            if row[0] in seen: continue
+            seen.add(row[0])
+            unique_rows.append(row)
+        if not unique_rows: return 0
+        session = self.Session()
+        connection = session.connection()
+        if connection.dialect.name == 'postgresql':
+            num_added = self.upsert_postgresql(connection, unique_rows)
+        else:
+            existing = dict((row[0], row[1:]) for row in connection.execute(
+                select([stock_table.c.symbol, stock_table.c.market, stock_table.c.name])))
+            new_rows = [dict(symbol=symbol, name=name, market=market)
+                        for [symbol, name, market] in unique_rows
+                        if symbol not in existing]
+            changed_rows = [dict(b_symbol=symbol, b_market=market, name=name)
+                            for [symbol, name, market] in unique_rows
+                            if symbol in existing and
+                            existing[symbol][0] == market and
+                            existing[symbol][1] != name]
+            if new_rows: connection.execute(stock_table.insert(), new_rows)
+            if changed_rows:
+                connection.execute(stock_table.update().where(and_(
+                    stock_table.c.symbol == bindparam('b_symbol'),
+                    stock_table.c.market == bindparam('b_market'))), changed_rows)
+            num_added = len(new_rows)
+        session.commit()
+        self.reset()
+        return num_added
+
+    def upsert_postgresql(self, connection, rows):
+        """Upserts in a single INSERT ... ON CONFLICT statement.
+
+        Returns number of stocks added.
+        """
+        cursor = connection.connection.cursor()
+        values = ",".join([cursor.mogrify("(%s, %s, %s)", row) for row in rows])
+        cursor.execute("INSERT INTO stock (symbol, name, market) VALUES " + values +
+                       " ON CONFLICT (symbol) DO UPDATE SET name = EXCLUDED.name"
+                       " WHERE stock.market = EXCLUDED.market"
+                       " AND stock.name IS DISTINCT FROM EXCLUDED.name"
+                       " RETURNING (xmax = 0)")
+        num_added = len([row for row in cursor.fetchall() if row[0]])
+        cursor.close()
+        return num_added
@@ -29,8 +29,27 @@ start_date = datetime.date(year=2012, month=1, day=1)
 # true gives about 20% faster loading, but is potentially unsafe
 assume_datapoints_unique=False
 
+# load datapoints in batches (COPY on postgresql, executemany otherwise)
+# rather than one ORM object and commit per row. The assume_* settings
+# keep their meaning in this mode.
+bulk_load=True
+
+# number of rows sent to the db per batch when bulk_load is on
+bulk_batch_size=5000
+
+# number of processes update_db loads stocks on, each with its own db
+# connection. 1 loads in this process
+load_workers=1
+
+# on postgresql, range partition the datapoint table by date, 'yearly' or
+# 'monthly'. None for a single table. Takes effect when the db is created;
+# after that, update_db adds partitions as needed to a db created
+# partitioned, and it is the catalog that says whether it was
+datapoint_partitioning=None
+
 # preload days so we don't need to check for their existence?
-# If we turn this on, we need to run the day population function before adding data.
+# If we turn this on, we need to run the day population function
+# (StockCollection.populate_days) before adding data.
 # running the day population function is relatively safe; preserves existing day records
 assume_days_prepopulated=False
 
@@ -44,5 +63,102 @@ symbols_files=[{u'name':u'NYSE', u'file':u"data/NYSE_full.txt"}]
 # for testing purposes. Needs to be set to today() otherwise
 today=datetime.date.today()
 
+# where price csvs are fetched from. compose_yahoo_url appends the query
+yahoo_url=u"http://ichart.finance.yahoo.com/table.csv"
+
+# number of symbols update_cache fetches concurrently. 1 fetches serially
+fetch_workers=8
+
+# most requests allowed in flight against any one host
+fetch_per_host_limit=4
+
+# token bucket limit on requests: fetch_rate requests per second sustained,
+# bursts of up to fetch_burst. Set fetch_rate to None for no limit
+fetch_rate=10.0
+fetch_burst=10
+
+# fetches failing on connection errors, timeouts or 429 and 5xx responses
+# are retried up to fetch_retries times, waiting a random time of up to
+# fetch_backoff seconds, doubled on each retry and capped at
+# fetch_backoff_cap. Symbols still failing go in the failure ledger,
+# failures.json in the cache dir, for main.py --retry-failed
+fetch_retries=3
+fetch_backoff=0.5
+fetch_backoff_cap=30
+
+# after fetch_breaker_threshold failed requests in a row to a host,
+# requests to it are refused for fetch_breaker_reset seconds before one
+# is let through to try it again. 0 turns the breaker off
+fetch_breaker_threshold=5
+fetch_breaker_reset=60
+
+# seconds to wait for a connection to the price server, and for each read
+http_connect_timeout=10
+http_read_timeout=30
+
+# ask the price server for gzipped responses
+http_gzip=True
+
+# how dedupe spots duplicate cache rows. 'line' drops repeated identical
+# lines, 'date' keeps the first row per date and 'newest' keeps the last
+# fetched row per date, so restated adj_close values replace old ones
+dedupe_mode='line'
+
+# keep a binary copy of each cache file (see columnar.py) beside the csv,
+# rebuilt by update_cache. update_stock_in_db memory maps it instead of
+# parsing the csv. StockCollection.convert_cache builds the binary copies
+# for an existing csv cache
+binary_cache=False
+
+# consecutive cached rows more than this many days apart are taken as a
+# hole in the cache, to be fetched unless the range was fetched before
+cache_gap_days=7
+
+# update_cache merges missing date ranges no more than this many days apart
+# into a single request
+fetch_merge_days=14
+
+# along with a stock's new rows, update_cache refetches its last
+# adjustment_check_days of cached rows. If the ratio of adj_close to close
+# on those days has moved, a split or dividend was applied since they were
+# cached: the stock's cache file is refetched whole, and its datapoints
+# restated on the next load. 0 turns the check off
+adjustment_check_days=5
+
+# update_cache logs each symbol it finishes to checkpoint.log in the cache
+# dir, fsynced, so a run that dies part way is resumed by the next run
+# with the same dates, which skips the symbols already done
+checkpoint_runs=True
+
+# StockCache.update_cache_shards splits the symbols into this many shards,
+# claimed by workers from a work queue. A worker's claim on a shard lapses
+# fetch_lease_seconds after its last renewal, so a crashed worker's shards
+# are taken up by others. The lease is renewed every third of that
+fetch_shards=64
+fetch_lease_seconds=300
+
+# main.py --work takes shards from a queue kept in this file, locked with
+# flock, which serves workers on one machine. None keeps the queue in the
+# db's fetch_lease table
+work_queue_file=None
+
+# number of results of StockCollection.get_series and get_cross_section
+# kept cached. 0 turns the cache off
+query_cache_size=128
+
+# StockCollection times these stages of a run: fetch_wait, http,
+# cache_append, dedupe, convert, parse, day_lookup, db_query, db_insert,
+# commit, export_query and export_write. Naming one here runs it under
+# cProfile, and StockCollection.log_report writes the profile to
+# profile_file
+profile_stage=None
+profile_file="stage.prof"
+
+# StockCollection.export_datapoints writes NPZ files, one per market and
+# year, and their manifest.json under export_dir, reading the db
+# export_batch_size rows at a time from a server side cursor
+export_dir="export"
+export_batch_size=10000
+
 # following path can be relative or absolute but MUST
 cache_dir="cache"
@@ -22,13 +22,29 @@ import unittest
 from sqlalchemy.orm import *
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import *
+from sqlalchemy.exc import IntegrityError
 import os
+import shutil
+import socket
 import datetime
 import hashlib
+import json
+import time
+import threading
+from urlparse import urlparse
 from nose.tools import with_setup
 
 from StockCollection import StockCollection
-from model import Datapoint, Stock, Day
+from StockCache import StockCache
+from model import Datapoint, Stock, Day, partition_bounds
+import model
+from fetcher import TokenBucket, HTTPClient, CircuitBreaker, backoff_delay
+from instrument import Stats
+from lrucache import LRUCache
+from workqueue import FileLeaseQueue, DBLeaseQueue
+from fakeyahoo import start_fake_yahoo
+import benchmark
+import columnar
 import settings
 
 dp_A_20120323=[u'NYSE', u"A", u"2012-03-23,43.57,44.30,43.15,44.30,3369400,44.20"]
@@ -44,6 +60,27 @@ dp_AAN_20120326=[u'NYSE', u"AAN", u"2012-03-26,25.92,26.33,25.90,26.17,537400,26
 dp_AAN_20120327=[u'NYSE', u"AAN", u"2012-03-27,26.12,26.50,26.05,26.06,609900,26.06"]
 
 
+canned_rows = {}
+for dp in [dp_A_20120323, dp_A_20120326, dp_A_20120327, dp_A_20120328,
+           dp_AA_20120323, dp_AA_20120326, dp_AA_20120327, dp_AA_20120328,
+           dp_AAN_20120323, dp_AAN_20120326, dp_AAN_20120327]:
+    canned_rows.setdefault(dp[1], []).append(dp[2])
+
+
+# the settings tests change, put back after each test so that no test
+# depends on the ones run before it
+CHANGED_SETTINGS = ['start_date', 'today', 'symbols_files', 'bulk_load', 'binary_cache',
+                    'cache_gap_days', 'datapoint_partitioning', 'load_workers',
+                    'fetch_workers', 'fetch_backoff', 'fetch_retries', 'fetch_merge_days',
+                    'fetch_shards', 'http_read_timeout', 'yahoo_url']
+
+def save_settings():
+    return dict((name, getattr(settings, name)) for name in CHANGED_SETTINGS)
+
+def restore_settings(saved):
+    for name, value in saved.items(): setattr(settings, name, value)
+
+
 class testValidation(unittest.TestCase):
 
     def setUp(self):
@@ -71,10 +108,41 @@ class testValidation(unittest.TestCase):
                (result[0], result[1])
 
 
+class testColumnar(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = settings
+        self.stock_collection = StockCollection(self.settings)
+
+    def testParseCsvMatchesParseCsvLine(self):
+        """Testing the columnar parser agrees with parse_csv_line
+
+        """
+        lines = [dp[2] for dp in [dp_A_20120323, dp_AA_20120326, dp_AAN_20120327]]
+        lines.append(u"2000-02-29,0.5,10.1,9.99,1000.05,0,7.10")
+        columns = columnar.parse_csv("\n".join(lines) + "\n")
+        for i, line in enumerate(lines):
+            expected = self.stock_collection.parse_csv_line(line)
+            assert columns['date'][i].tolist() == expected['date'],\
+                   'date mismatch on %s' % line
+            for field in columnar.FIELDS:
+                assert columns[field][i] == expected[field],\
+                       '%s mismatch on %s: %s' % (field, line, columns[field][i])
+        assert str(columns['date'].dtype) == 'datetime64[D]', 'dates not datetime64[D]'
+        assert columns['volume'].dtype == columnar.np.int64, 'volume not int64'
+
+    def testParseCsvRejectsPartialRows(self):
+        """Testing the columnar parser rejects malformed rows
+
+        """
+        self.assertRaises(ValueError, columnar.parse_csv, u"2012-03-23,43.57,44.30\n")
+
+
 class testSymbolLoading(object):
 
     def setUp(self):
         self.settings = settings
+        self.saved_settings = save_settings()
         self.engine = create_engine(settings.db_url)
         self.Session = sessionmaker(bind=self.engine)
         self.stock_collection = StockCollection(self.settings)
@@ -82,6 +150,7 @@ class testSymbolLoading(object):
         self.stock_collection.create_db()
 
     def tearDown(self):
+        restore_settings(self.saved_settings)
         cache_file_paths = []
         for stock in self.stock_collection.stocks:
             cache_file_paths.append(self.stock_collection.get_cache_file_path(stock.symbol, stock.market))
@@ -270,6 +339,7 @@ class testCache(unittest.TestCase):
 
     def setUp(self):
         self.settings = settings
+        self.saved_settings = save_settings()
         self.engine = create_engine(settings.db_url)
         self.Session = sessionmaker(bind=self.engine)
         self.stock_collection = StockCollection(self.settings)
@@ -277,6 +347,7 @@ class testCache(unittest.TestCase):
         self.stock_collection.create_db()
 
     def tearDown(self):
+        restore_settings(self.saved_settings)
         cache_file_paths = []
         for stock in self.stock_collection.stocks:
             cache_file_paths.append(self.stock_collection.get_cache_file_path(stock.symbol, stock.market))
@@ -326,7 +397,7 @@ class testCache(unittest.TestCase):
         cache_contents = cache_file.read()
         cache_file.close()
         assert hashlib.sha1(cache_contents).\
-               hexdigest() == "d304d9962bc0c95ced93fe9826ed12b965d398b5",\
+               hexdigest() == "844465fffecaf747c25083bb6d7f4f1d8a363182",\
                "cache file has wrong sha1 hexdigest after initial data load"
         # 4. update the db from cache
         self.stock_collection.update_db()
@@ -341,7 +412,7 @@ class testCache(unittest.TestCase):
         cache_contents = cache_file.read()
         cache_file.close()
         assert hashlib.sha1(cache_contents).\
-               hexdigest() == "033aaa5c736c9f44074dfd4d2657b0c44c406793",\
+               hexdigest() == "4cf97ad024e573cfe8ac8f4aebd95ce9bf132e10",\
                "cache file has wrong sha1 hexdigest after first cache update"
         self.stock_collection.update_db()
         num_dps = len(session.query(Datapoint).all())
@@ -369,6 +440,674 @@ class testCache(unittest.TestCase):
                                    dp_AA_20120323, dp_AA_20120326, dp_AA_20120327, dp_AA_20120328],\
                                   to_exclusion=True), 'didn\'t find all the db entries we expected'
 
+    def testBulkLoadSkipsLoadedDays(self):
+        """Testing bulk loading skips rows already in the db
+
+        """
+        session = self.Session()
+        self.stock_collection.settings.bulk_load = True
+        self.stock_collection.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.stock_collection.settings.today = datetime.date(year=2012, month=3, day=27)
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        cache_file = open(self.stock_collection.get_cache_file_path(stock.symbol, stock.market), 'w')
+        for dp in [dp_A_20120326, dp_A_20120323, dp_A_20120323]:
+            cache_file.write(dp[2] + "\n")
+        cache_file.close()
+        self.stock_collection.update_stock_in_db(stock)
+        num_dps = len(session.query(Datapoint).all())
+        assert num_dps == 2, 'expected 2 datapoints, found %s' % num_dps
+        cache_file = open(self.stock_collection.get_cache_file_path(stock.symbol, stock.market), 'a')
+        cache_file.write(dp_A_20120327[2] + "\n")
+        cache_file.close()
+        self.stock_collection.update_stock_in_db(stock, start_date=self.settings.start_date)
+        num_dps = len(session.query(Datapoint).all())
+        assert num_dps == 3, 'expected 3 datapoints, found %s' % num_dps
+        assert self.dps_are_in_db([dp_A_20120323, dp_A_20120326, dp_A_20120327], to_exclusion=True),\
+               'didn\'t find all the db entries we expected'
+
+    def testFailedLoadDayIndex(self):
+        """Testing a failed load leaves no rolled back days in the day index
+
+        """
+        self.stock_collection.settings.bulk_load = True
+        self.stock_collection.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.stock_collection.settings.today = datetime.date(year=2012, month=3, day=27)
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        def fail(session, rows): raise IOError("lost the db")
+        self.stock_collection.bulk_insert_datapoints = fail
+        try:
+            self.stock_collection.update_stock_in_db(stock)
+            assert False, 'failing load did not raise'
+        except IOError:
+            pass
+        finally:
+            del self.stock_collection.bulk_insert_datapoints
+        day_ids = dict((row.date, row.id) for row in
+                       self.engine.execute(select([model.day_table.c.id,
+                                                   model.day_table.c.date])))
+        assert self.stock_collection.day_ids == day_ids,\
+               'day index %s does not match the db %s' % (self.stock_collection.day_ids, day_ids)
+        cache_file = open(self.stock_collection.get_cache_file_path(u"A", u"NYSE"), 'w')
+        cache_file.write(dp_A_20120327[2].replace("2012-03-27", "2012-03-24") + "\n")
+        cache_file.close()
+        self.stock_collection.index_cache_file(u"A", u"NYSE")
+        self.stock_collection.update_stock_in_db(stock)
+        dates = self.engine.execute(select([model.datapoint_table.c.date, model.day_table.c.date],
+                                           model.datapoint_table.c.day_id ==
+                                           model.day_table.c.id)).fetchall()
+        assert dates == [(datetime.date(year=2012, month=3, day=24),) * 2],\
+               'datapoints attached to the wrong days: %s' % dates
+
+    def testAssumeUnique(self):
+        """Testing a load told to assume unique rows skips the check without the setting
+
+        """
+        self.stock_collection.settings.bulk_load = True
+        self.stock_collection.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.stock_collection.settings.today = datetime.date(year=2012, month=3, day=26)
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        self.stock_collection.update_db()
+        self.assertRaises(IntegrityError, self.stock_collection.update_stock_in_db, stock,
+                          start_date=self.settings.start_date, assume_unique=True)
+        assert self.settings.assume_datapoints_unique is False, 'assume_unique changed the setting'
+        result = self.stock_collection.update_stock_in_db(stock, start_date=self.settings.start_date)
+        assert result == [0, 2], 'expected the loaded rows skipped, got %s' % result
+
+    def testRowLoad(self):
+        """Testing the row at a time load path
+
+        """
+        session = self.Session()
+        self.stock_collection.settings.bulk_load = False
+        self.stock_collection.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.stock_collection.settings.today = datetime.date(year=2012, month=3, day=27)
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        cache_file = open(self.stock_collection.get_cache_file_path(stock.symbol, stock.market), 'w')
+        for dp in [dp_A_20120323, dp_A_20120323, dp_A_20120326]:
+            cache_file.write(dp[2] + "\n")
+        cache_file.close()
+        result = self.stock_collection.update_stock_in_db(stock)
+        self.stock_collection.settings.bulk_load = True
+        assert result == [2, 1], 'expected 2 rows inserted and 1 skipped, got %s' % result
+        num_dps = len(session.query(Datapoint).all())
+        assert num_dps == 2, 'expected 2 datapoints, found %s' % num_dps
+        assert self.dps_are_in_db([dp_A_20120323, dp_A_20120326], to_exclusion=True),\
+               'didn\'t find all the db entries we expected'
+
+    def testIterCacheRows(self):
+        """Testing cache rows are read within the date window
+
+        """
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        cache_file = open(self.stock_collection.get_cache_file_path(u"A", u"NYSE"), 'w')
+        for dp in [dp_A_20120323, dp_A_20120326, dp_A_20120328, dp_A_20120327]:
+            cache_file.write(dp[2] + "\n")
+        cache_file.close()
+        start_date = datetime.date(year=2012, month=3, day=26)
+        end_date = datetime.date(year=2012, month=3, day=27)
+        rows = list(self.stock_collection.iter_cache_rows(u"A", u"NYSE", start_date, end_date))
+        expected = [self.stock_collection.parse_csv_row(dp[2])
+                    for dp in [dp_A_20120326, dp_A_20120327]]
+        assert rows == expected, 'expected rows %s, got %s' % (expected, rows)
+        rows = list(self.stock_collection.iter_cache_rows(u"A", u"NYSE", start_date, end_date,
+                                                          date_sorted=True))
+        assert rows == expected[:1], 'expected reading to stop after end_date, got %s' % rows
+
+    def testDedupeModes(self):
+        """Testing the dedupe modes
+
+        """
+        restated = u"2012-03-26,44.87,45.12,44.63,45.05,3467100,44.90"
+        lines = [dp_A_20120327[2], dp_A_20120326[2], dp_A_20120327[2],
+                 restated, dp_A_20120323[2]]
+        expectations = [['line', 1, [dp_A_20120327[2], dp_A_20120326[2], restated, dp_A_20120323[2]]],
+                        ['date', 2, [dp_A_20120327[2], dp_A_20120326[2], dp_A_20120323[2]]],
+                        ['newest', 2, [dp_A_20120327[2], restated, dp_A_20120323[2]]]]
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        path = self.stock_collection.get_cache_file_path(u"A", u"NYSE")
+        for [mode, expected_dupes, expected_lines] in expectations:
+            cache_file = open(path, 'w')
+            for line in lines: cache_file.write(line + "\n")
+            cache_file.close()
+            dupes = self.stock_collection.dedupe(u"A", u"NYSE", mode)
+            assert dupes == expected_dupes,\
+                   'mode %s: expected %s dupes, found %s' % (mode, expected_dupes, dupes)
+            cache_file = open(path)
+            deduped = cache_file.read().split("\n")[:-1]
+            cache_file.close()
+            assert deduped == expected_lines,\
+                   'mode %s: expected %s, got %s' % (mode, expected_lines, deduped)
+        leftovers = [f for f in os.listdir(os.path.dirname(path) or ".")
+                     if f.startswith("." + os.path.basename(path))]
+        assert leftovers == [], 'temp files left behind: %s' % leftovers
+
+    def testBinaryCache(self):
+        """Testing conversion to and loading from the binary cache
+
+        """
+        session = self.Session()
+        restated = u"2012-03-26,44.87,45.12,44.63,45.05,3467100,44.90"
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        cache_file = open(self.stock_collection.get_cache_file_path(u"A", u"NYSE"), 'w')
+        for line in [dp_A_20120323[2], dp_A_20120326[2], restated, dp_A_20120327[2], dp_A_20120328[2]]:
+            cache_file.write(line + "\n")
+        cache_file.close()
+        num_records = self.stock_collection.convert_cache()
+        assert num_records == 4, 'expected 4 records, wrote %s' % num_records
+        records = self.stock_collection.read_cache_slice(u"A", u"NYSE",
+                                                         datetime.date(year=2012, month=3, day=24),
+                                                         datetime.date(year=2012, month=3, day=27))
+        dates = records['date'].tolist()
+        assert dates == [datetime.date(year=2012, month=3, day=26), datetime.date(year=2012, month=3, day=27)],\
+               'unexpected slice dates %s' % dates
+        assert records['adj_close'][0] == 4495, 'expected the first row of the date to win'
+        self.stock_collection.settings.binary_cache = True
+        self.stock_collection.update_stock_in_db(stock, datetime.date(year=2012, month=3, day=23),
+                                                 datetime.date(year=2012, month=3, day=27))
+        self.stock_collection.settings.binary_cache = False
+        num_dps = len(session.query(Datapoint).all())
+        assert num_dps == 3, 'expected 3 datapoints, found %s' % num_dps
+        assert self.dps_are_in_db([dp_A_20120323, dp_A_20120326, dp_A_20120327],
+                                  to_exclusion=True), 'didn\'t find all the db entries we expected'
+
+    def testDuplicateDatesLoadAlike(self):
+        """Testing the csv and binary load paths keep the same row of a repeated date
+
+        """
+        restated = u"2012-03-26,44.87,45.12,44.63,45.05,3467100,44.90"
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        cache_file = open(self.stock_collection.get_cache_file_path(u"A", u"NYSE"), 'w')
+        for line in [dp_A_20120323[2], dp_A_20120326[2], restated, dp_A_20120327[2]]:
+            cache_file.write(line + "\n")
+        cache_file.close()
+        self.stock_collection.convert_cache()
+        start_date = datetime.date(year=2012, month=3, day=23)
+        end_date = datetime.date(year=2012, month=3, day=27)
+        saved = [self.settings.binary_cache, self.settings.bulk_load]
+        loaded = []
+        try:
+            for binary_cache, bulk_load in [(True, True), (False, True), (False, False)]:
+                self.settings.binary_cache = binary_cache
+                self.settings.bulk_load = bulk_load
+                self.engine.execute(model.datapoint_table.delete())
+                self.stock_collection.update_stock_in_db(stock, start_date, end_date)
+                rows = self.engine.execute(select([model.datapoint_table.c.date,
+                                                   model.datapoint_table.c.adj_close]).
+                                           order_by(model.datapoint_table.c.date)).fetchall()
+                loaded.append([tuple(row) for row in rows])
+        finally:
+            [self.settings.binary_cache, self.settings.bulk_load] = saved
+        assert loaded[0] == loaded[1] == loaded[2], 'load paths disagree: %s' % loaded
+        assert loaded[0][1] == (datetime.date(year=2012, month=3, day=26), 4495),\
+               'expected the first row of the date loaded, got %s' % (loaded[0],)
+
+    def testCacheIndex(self):
+        """Testing cache files are kept sorted and indexed
+
+        """
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        path = self.stock_collection.get_cache_file_path(u"A", u"NYSE")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", [dp_A_20120326[2], dp_A_20120323[2]])
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", [dp_A_20120328[2]])
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", [dp_A_20120327[2]])
+        cache_file = open(path)
+        lines = cache_file.read().split("\n")[:-1]
+        cache_file.close()
+        expected = [dp[2] for dp in [dp_A_20120323, dp_A_20120326, dp_A_20120327, dp_A_20120328]]
+        assert lines == expected, 'expected sorted cache %s, got %s' % (expected, lines)
+        index = self.stock_collection.get_cache_index(u"A", u"NYSE")
+        assert index['rows'] == 4, 'expected 4 rows indexed, found %s' % index['rows']
+        assert index['min_date'] == u"2012-03-23" and index['max_date'] == u"2012-03-28",\
+               'wrong date bounds %s %s' % (index['min_date'], index['max_date'])
+        assert index['months'] == {u"2012-03": 0}, 'wrong month offsets %s' % index['months']
+        self.settings.fetch_merge_days = 0
+        ranges = self.stock_collection.missing_date_ranges(u"A", u"NYSE",
+                                                           datetime.date(year=2012, month=3, day=20),
+                                                           datetime.date(year=2012, month=4, day=2))
+        expected_ranges = [[datetime.date(year=2012, month=3, day=20), datetime.date(year=2012, month=3, day=22)],
+                           [datetime.date(year=2012, month=3, day=29), datetime.date(year=2012, month=4, day=2)]]
+        assert ranges == expected_ranges, 'expected missing ranges %s, got %s' % (expected_ranges, ranges)
+        self.settings.fetch_merge_days = 14
+        cache_file = open(path, 'a')
+        cache_file.write(u"2012-04-02,45.00,45.10,44.00,44.50,3000000,44.40\n")
+        cache_file.close()
+        index = self.stock_collection.get_cache_index(u"A", u"NYSE")
+        assert index['rows'] == 5 and index['months'][u"2012-04"] == len("\n".join(expected)) + 1,\
+               'stale index was not rebuilt: %s' % index
+
+    def testFetchPlan(self):
+        """Testing fetches are planned around cached and fetched dates
+
+        """
+        def d(month, day):
+            return datetime.date(year=2012, month=month, day=day)
+        self.settings.cache_gap_days = 7
+        self.settings.fetch_merge_days = 2
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        rows = [u"2012-01-%02d,1.00,1.00,1.00,1.00,100,1.00" % day for day in [2, 3, 4]]
+        rows += [u"2012-02-%02d,1.00,1.00,1.00,1.00,100,1.00" % day for day in [1, 2, 3]]
+        rows += [u"2012-03-%02d,1.00,1.00,1.00,1.00,100,1.00" % day for day in [1, 2]]
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", rows)
+        plan = self.stock_collection.missing_date_ranges(u"A", u"NYSE", d(1, 1), d(3, 31))
+        expected = [[d(1, 1), d(1, 1)], [d(1, 5), d(1, 31)], [d(2, 4), d(2, 29)], [d(3, 3), d(3, 31)]]
+        assert plan == expected, 'expected plan %s, got %s' % (expected, plan)
+        self.stock_collection.record_fetched_range(u"A", u"NYSE", d(1, 5), d(1, 31))
+        plan = self.stock_collection.missing_date_ranges(u"A", u"NYSE", d(1, 1), d(3, 31),
+                                                         last_cache_update=d(3, 10))
+        expected = [[d(1, 1), d(1, 1)], [d(2, 4), d(2, 29)], [d(3, 11), d(3, 31)]]
+        assert plan == expected, 'expected plan %s, got %s' % (expected, plan)
+        self.settings.fetch_merge_days = 14
+        plan = self.stock_collection.missing_date_ranges(u"A", u"NYSE", d(2, 1), d(3, 31),
+                                                         last_cache_update=d(3, 10))
+        expected = [[d(2, 4), d(3, 31)]]
+        assert plan == expected, 'expected merged plan %s, got %s' % (expected, plan)
+
+    def testParallelLoad(self):
+        """Testing parallel loading matches the expected db contents
+
+        """
+        session = self.Session()
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=28)
+        saturday = u"2012-03-24,10.00,10.00,10.00,10.00,100,10.00"
+        dps = {u"A": [dp_A_20120323, dp_A_20120326, dp_A_20120327, dp_A_20120328],
+               u"AA": [dp_AA_20120323, dp_AA_20120326, dp_AA_20120327, dp_AA_20120328],
+               u"AAN": [dp_AAN_20120323, dp_AAN_20120326, dp_AAN_20120327]}
+        for symbol in [u"A", u"AA", u"AAN"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+            self.stock_collection.append_cache_rows(symbol, u"NYSE",
+                                                    [dp[2] for dp in dps[symbol]] + [saturday])
+        self.settings.load_workers = 3
+        report = self.stock_collection.update_db()
+        self.settings.load_workers = 1
+        assert report['inserted'] == 14, 'expected 14 rows inserted, report says %s' % report
+        assert report['skipped'] == 0, 'expected no rows skipped, report says %s' % report
+        assert sum([w['stocks'] for w in report['workers'].values()]) == 3,\
+               'expected 3 stocks across workers, report says %s' % report
+        num_dps = len(session.query(Datapoint).all())
+        assert num_dps == 14, 'expected 14 datapoints, found %s' % num_dps
+        assert self.dps_are_in_db(dps[u"A"] + dps[u"AA"] + dps[u"AAN"]),\
+               'didn\'t find all the db entries we expected'
+        num_saturdays = session.query(Day).filter(Day.date == datetime.date(year=2012, month=3, day=24)).count()
+        assert num_saturdays == 1, 'expected 1 day for the saturday, found %s' % num_saturdays
+        for stock in self.stock_collection.stocks:
+            assert stock.last_db_update == self.settings.today,\
+                   'last_db_update not saved for %s' % stock.symbol
+
+    def testSeedPartitionedDb(self):
+        """Testing seeding a yearly partitioned db
+
+        """
+        session = self.Session()
+        self.settings.datapoint_partitioning = u"yearly"
+        self.settings.start_date = datetime.date(year=2011, month=12, day=29)
+        self.settings.today = datetime.date(year=2012, month=3, day=28)
+        self.stock_collection.wipe()
+        self.stock_collection.create_db()
+        self.stock_collection.add_stock(u"A", u"Agilent Technologies", u"NYSE")
+        old_row = u"2011-12-30,40.00,40.50,39.50,40.10,3000000,40.00"
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [old_row, dp_A_20120323[2], dp_A_20120326[2]])
+        report = self.stock_collection.seed_db()
+        self.settings.datapoint_partitioning = None
+        assert report['inserted'] == 3, 'expected 3 rows seeded, report says %s' % report
+        assert self.dps_are_in_db([[u"NYSE", u"A", old_row], dp_A_20120323, dp_A_20120326],
+                                  to_exclusion=True), 'didn\'t find all the db entries we expected'
+        stock = self.stock_collection.stocks[0]
+        day_id = self.stock_collection.day_ids[datetime.date(year=2012, month=3, day=23)]
+        session.add(Datapoint(stock.id, day_id, 1, 1, 1, 1, 1, 1,
+                              date=datetime.date(year=2012, month=3, day=23)))
+        self.assertRaises(IntegrityError, session.commit)
+        session.rollback()
+
+    def testPartitionBounds(self):
+        """Testing yearly and monthly partition bounds
+
+        """
+        start_date = datetime.date(year=2011, month=11, day=15)
+        end_date = datetime.date(year=2012, month=2, day=1)
+        bounds = partition_bounds(u"yearly", start_date, end_date)
+        assert [b[0] for b in bounds] == ['datapoint_y2011', 'datapoint_y2012'],\
+               'unexpected yearly partitions %s' % bounds
+        bounds = partition_bounds(u"monthly", start_date, end_date)
+        assert bounds[0] == ('datapoint_m201111', datetime.date(year=2011, month=11, day=1),
+                             datetime.date(year=2011, month=12, day=1)),\
+               'unexpected first monthly partition %s' % (bounds[0],)
+        assert bounds[1][2] == datetime.date(year=2012, month=1, day=1),\
+               'december partition should end at new year, got %s' % (bounds[1],)
+        assert len(bounds) == 4, 'expected 4 monthly partitions, got %s' % len(bounds)
+
+    def testQueries(self):
+        """Testing series and cross section queries and their cache
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol, dps in [[u"A", [dp_A_20120323, dp_A_20120326]],
+                            [u"AA", [dp_AA_20120323, dp_AA_20120326, dp_AA_20120327]]]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+            self.stock_collection.append_cache_rows(symbol, u"NYSE", [dp[2] for dp in dps])
+        self.stock_collection.update_db()
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['close', 'volume'])
+        assert sorted(series.keys()) == ['close', 'date', 'volume'],\
+               'unexpected columns %s' % series.keys()
+        assert series['date'].tolist() == [datetime.date(year=2012, month=3, day=23),
+                                           datetime.date(year=2012, month=3, day=26)],\
+               'unexpected dates %s' % series['date']
+        assert series['close'].tolist() == [4430, 4505], 'unexpected closes %s' % series['close']
+        self.assertRaises(ValueError, series['close'].__setitem__, 0, 1)
+        again = self.stock_collection.get_series(u"A", u"NYSE", fields=['close', 'volume'])
+        assert again is series, 'repeated query was not served from the cache'
+        section = self.stock_collection.get_cross_section(datetime.date(year=2012, month=3, day=26))
+        assert section['symbol'].tolist() == [u"A", u"AA"] and\
+               section['adj_close'].tolist() == [4495, 1019],\
+               'unexpected cross section %s' % section
+        section = self.stock_collection.get_cross_section(datetime.date(year=2012, month=3, day=27),
+                                                          [u"A", u"AA"], ['open_val'])
+        assert section['symbol'].tolist() == [u"AA"] and section['open_val'].tolist() == [1025],\
+               'unexpected cross section %s' % section
+        self.assertRaises(ValueError, self.stock_collection.get_series, u"A", u"NYSE",
+                          None, None, ['foo'])
+        self.assertRaises(ValueError, self.stock_collection.get_cross_section,
+                          datetime.date(year=2012, month=3, day=27), [u"ZZZZ"])
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", [dp_A_20120327[2]])
+        stock = self.stock_collection.get_stock(u"A", u"NYSE")
+        self.stock_collection.update_stock_in_db(stock, start_date=self.settings.start_date)
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['close', 'volume'])
+        assert series['close'].tolist() == [4430, 4505, 4567],\
+               'cached series not refreshed after a load: %s' % series['close']
+        section = self.stock_collection.get_cross_section(datetime.date(year=2012, month=3, day=27),
+                                                          [u"A", u"AA"], ['open_val'])
+        assert section['symbol'].tolist() == [u"A", u"AA"],\
+               'cached cross section not refreshed after a load: %s' % section
+        stats = self.stock_collection.run_report()['query_cache']
+        assert stats['hits'] == 1 and stats['misses'] == 5, 'unexpected cache stats %s' % stats
+
+    def testRestatement(self):
+        """Testing restated rows are stored as new versions with as of queries
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        self.stock_collection.update_db()
+        before = datetime.datetime.utcnow()
+        restated = dp_A_20120326[2][:-5] + "44.50"
+        cache_file = open(self.stock_collection.get_cache_file_path(u"A", u"NYSE"), 'w')
+        cache_file.write(dp_A_20120323[2] + "\n" + restated + "\n" + dp_A_20120327[2] + "\n")
+        cache_file.close()
+        stock = self.stock_collection.get_stock(u"A", u"NYSE")
+        result = self.stock_collection.restate_stock_in_db(stock)
+        assert result == [1, 1], 'expected 1 row restated and 1 inserted, got %s' % result
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['adj_close'])
+        assert series['adj_close'].tolist() == [4420, 4450, 4557],\
+               'restatement not stored: %s' % series['adj_close']
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['adj_close'],
+                                                  as_of=before)
+        assert series['date'].tolist() == [datetime.date(year=2012, month=3, day=23),
+                                           datetime.date(year=2012, month=3, day=26)] and\
+               series['adj_close'].tolist() == [4420, 4495],\
+               'unexpected series as of before the restatement: %s' % series
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['adj_close'],
+                                                  as_of=datetime.datetime.utcnow())
+        assert series['adj_close'].tolist() == [4420, 4450, 4557],\
+               'unexpected series as of now: %s' % series['adj_close']
+        result = self.stock_collection.restate_stock_in_db(stock)
+        assert result == [0, 0], 'unchanged cache restated %s' % result
+        num_revisions = self.engine.execute(
+            select([func.count()], from_obj=model.datapoint_revision_table)).scalar()
+        assert num_revisions == 1, 'expected 1 revision, got %s' % num_revisions
+
+    def testExport(self):
+        """Testing datapoints export to NPZ partitions, incrementally after the first
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=26)
+        out_dir = self.settings.cache_dir + "/export"
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        self.stock_collection.add_stock(u"AA", None, u"NYSE")
+        self.stock_collection.add_stock(u"AAN", None, u"NASDAQ")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        self.stock_collection.append_cache_rows(u"AA", u"NYSE",
+                                                [dp_AA_20120323[2], dp_AA_20120326[2]])
+        self.stock_collection.append_cache_rows(u"AAN", u"NASDAQ", [dp_AAN_20120323[2]])
+        self.stock_collection.update_db()
+        try:
+            written = self.stock_collection.export_datapoints(out_dir)
+            assert written == [u"NASDAQ/2012", u"NYSE/2012"],\
+                   'unexpected partitions written %s' % written
+            manifest = json.load(open(out_dir + "/manifest.json"))
+            entry = manifest['partitions'][u"NYSE/2012"]
+            assert [entry['rows'], entry['symbols'], entry['min_date'], entry['max_date']] ==\
+                   [4, 2, u"2012-03-23", u"2012-03-26"], 'unexpected manifest entry %s' % entry
+            written = self.stock_collection.export_datapoints(out_dir)
+            assert written == [], 'unchanged datapoints exported again: %s' % written
+            self.stock_collection.append_cache_rows(u"AA", u"NYSE", [dp_AA_20120327[2]])
+            self.settings.today = datetime.date(year=2012, month=3, day=27)
+            self.stock_collection.update_db()
+            written = self.stock_collection.export_datapoints(out_dir)
+            assert written == [u"NYSE/2012"], 'unexpected partitions written %s' % written
+            partition = columnar.np.load(out_dir + "/NYSE/2012.npz")
+            assert partition['symbol'].tolist() == [u"A", u"A", u"AA", u"AA", u"AA"],\
+                   'unexpected symbols %s' % partition['symbol']
+            assert partition['adj_close'].tolist() == [4420, 4495, 1008, 1019, 1003],\
+                   'unexpected adj_close %s' % partition['adj_close']
+            assert str(partition['date'][-1]) == "2012-03-27",\
+                   'unexpected last date %s' % partition['date'][-1]
+            partition.close()
+            manifest = json.load(open(out_dir + "/manifest.json"))
+            assert manifest['partitions'][u"NYSE/2012"]['rows'] == 5 and\
+                   manifest['partitions'][u"NASDAQ/2012"]['rows'] == 1,\
+                   'unexpected manifest %s' % manifest['partitions']
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def testExportDuringLoad(self):
+        """Testing rows of a load uncommitted during an export go in the next export
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=26)
+        out_dir = self.settings.cache_dir + "/export"
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        stock = self.stock_collection.stocks[0]
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        exporter = StockCollection(self.settings)
+        exported = []
+        bulk_insert_datapoints = self.stock_collection.bulk_insert_datapoints
+        def insert_then_export(session, rows):
+            num_rows = bulk_insert_datapoints(session, rows)
+            exported.append(exporter.export_datapoints(out_dir))
+            return num_rows
+        try:
+            exporter.export_datapoints(out_dir)
+            self.stock_collection.bulk_insert_datapoints = insert_then_export
+            self.stock_collection.update_stock_in_db(stock)
+            del self.stock_collection.bulk_insert_datapoints
+            assert exported == [[]], 'exported uncommitted rows: %s' % exported
+            written = exporter.export_datapoints(out_dir)
+            assert written == [u"NYSE/2012"], 'rows committed after an export missed: %s' % written
+            manifest = json.load(open(out_dir + "/manifest.json"))
+            assert manifest['partitions'][u"NYSE/2012"]['rows'] == 2,\
+                   'unexpected manifest %s' % manifest['partitions']
+            assert exporter.export_datapoints(out_dir) == [], 'export not caught up'
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def testSymbolRegistry(self):
+        """Testing the symbol registry loads lazily and upserts in bulk
+
+        """
+        session = self.Session()
+        self.settings.symbols_files = [{u'name':u'NYSE', u'file':u"data/NYSE_test2.txt"}]
+        num_added = self.stock_collection.load_symbols(self.settings)
+        assert num_added == 2, 'expected 2 stocks added, got %s' % num_added
+        assert self.stock_collection.load_symbols(self.settings) == 0,\
+               'reloading the symbols file added stocks'
+        stock_collection = StockCollection(self.settings)
+        registry = stock_collection.registry
+        assert not registry.complete and not registry.by_key, 'registry not loaded lazily'
+        stock = stock_collection.get_stock(u"AA", u"NYSE")
+        assert stock.name == u"Alcoa Inc.", 'unexpected stock %s' % stock
+        assert registry.by_key.keys() == [(u"NYSE", u"AA")], 'looked up more than asked for'
+        assert registry.get(u"AA", u"NASDAQ") is None, 'found AA on the wrong market'
+        assert [s.symbol for s in stock_collection.stocks] == [u"A", u"AA"],\
+               'unexpected stocks %s' % stock_collection.stocks
+        num_added = registry.upsert([(u"AA", u"Alcoa", u"NYSE"),
+                                     (u"AA", u"Alcoa again", u"NYSE"),
+                                     (u"A", u"Agilent", u"NASDAQ"),
+                                     (u"AAN", u"Aaron's Inc.", u"NYSE")])
+        assert num_added == 1, 'expected 1 stock added, got %s' % num_added
+        names = dict((s.symbol, [s.market, s.name]) for s in session.query(Stock))
+        assert names == {u"A": [u"NYSE", u"Agilent Technologies"],
+                         u"AA": [u"NYSE", u"Alcoa"],
+                         u"AAN": [u"NYSE", u"Aaron's Inc."]},\
+               'unexpected stocks after upsert %s' % names
+        assert len(stock_collection.stocks) == 3, 'registry not refreshed after upsert'
+        stock_collection.http.close()
+
+    def testSchemaVersion(self):
+        """Testing startup checks the schema version marker
+
+        """
+        stock_collection = StockCollection(self.settings)
+        assert stock_collection.db_engine is None, 'connected to the db on construction'
+        self.stock_collection.wipe()
+        assert stock_collection.stocks == [], 'expected no stocks'
+        version = self.engine.execute(select([model.schema_version_table.c.version])).scalar()
+        assert version == model.SCHEMA_VERSION, 'empty db not created with a marker: %s' % version
+        self.engine.execute(model.schema_version_table.update().values(version=0))
+        stock_collection = StockCollection(self.settings)
+        self.assertRaises(ValueError, stock_collection.connect)
+        self.engine.execute(model.schema_version_table.delete())
+        stock_collection = StockCollection(self.settings)
+        stock_collection.connect()
+        version = self.engine.execute(select([model.schema_version_table.c.version])).scalar()
+        assert version == model.SCHEMA_VERSION, 'current db without a marker not stamped'
+        # a version 1 db, from before datapoint versions, is upgraded
+        stock_collection.wipe()
+        meta = MetaData()
+        for table in [model.schema_version_table, model.day_table]: table.tometadata(meta)
+        Table('stock', meta, *[column.copy() for column in model.stock_table.c
+                               if column.name != 'loading_since'])
+        Table('datapoint', meta, *[column.copy() for column in model.datapoint_table.c
+                                   if column.name != 'valid_from'])
+        meta.create_all(self.engine)
+        model.stamp_schema_version(self.engine, 1)
+        stock_collection = StockCollection(self.settings)
+        stock_collection.connect()
+        version = self.engine.execute(select([model.schema_version_table.c.version])).scalar()
+        assert version == model.SCHEMA_VERSION, 'version 1 db not upgraded: %s' % version
+        meta = MetaData(bind=self.engine)
+        meta.reflect()
+        assert 'valid_from' in meta.tables['datapoint'].c and\
+               'datapoint_revision' in meta.tables, 'upgrade did not add datapoint versions'
+        # a db from before the marker and datapoint.date, with its data, is upgraded
+        stock_collection.wipe()
+        meta = MetaData()
+        model.day_table.tometadata(meta)
+        Table('stock', meta, *[column.copy() for column in model.stock_table.c
+                               if column.name != 'loading_since'])
+        Table('datapoint', meta, *[column.copy() for column in model.datapoint_table.c
+                                   if column.name not in ('date', 'valid_from')])
+        meta.create_all(self.engine)
+        self.engine.execute(model.stock_table.insert(), id=1, symbol=u"A", market=u"NYSE")
+        self.engine.execute(model.day_table.insert(), id=1,
+                            date=datetime.date(year=2012, month=3, day=23))
+        self.engine.execute(meta.tables['datapoint'].insert(), stock_id=1, day_id=1,
+                            open_val=4357, high=4430, low=4315, close=4430,
+                            volume=3369400, adj_close=4420)
+        stock_collection = StockCollection(self.settings)
+        stock_collection.connect()
+        version = self.engine.execute(select([model.schema_version_table.c.version])).scalar()
+        assert version == model.SCHEMA_VERSION, 'unmarked db not upgraded: %s' % version
+        series = stock_collection.get_series(u"A", u"NYSE", datetime.date(year=2012, month=3, day=23),
+                                             datetime.date(year=2012, month=3, day=23))
+        assert series['adj_close'].tolist() == [4420],\
+               'datapoint not dated by the upgrade: %s' % series
+
+    def testLRUCache(self):
+        """Testing the LRU cache evicts and invalidates
+
+        """
+        cache = LRUCache(2)
+        cache.put('a', 1, set([1]))
+        cache.put('b', 2, set([2]))
+        assert cache.get('a') == 1, 'lost a'
+        cache.put('c', 3, None)
+        assert cache.get('b') is None, 'expected b, the least recently used, evicted'
+        assert cache.get('a') == 1 and cache.get('c') == 3, 'evicted the wrong entry'
+        cache.invalidate(1)
+        assert cache.get('a') is None, 'a not invalidated'
+        cache.put('a', 1, set([1]))
+        cache.invalidate(2)
+        assert cache.get('a') == 1 and cache.get('c') is None,\
+               'invalidating a tag should drop only entries with it, and untagged ones'
+
+    def testPopulateDays(self):
+        """Testing the day population function inserts the trading days in the caches
+
+        """
+        session = self.Session()
+        start_date = datetime.date(year=2012, month=3, day=23)
+        end_date = datetime.date(year=2012, month=3, day=28)
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        self.stock_collection.add_stock(u"AA", None, u"NYSE")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        self.stock_collection.append_cache_rows(u"AA", u"NYSE",
+                                                [dp_AA_20120326[2], dp_AA_20120328[2]])
+        self.stock_collection.ensure_days_in_db([datetime.date(year=2012, month=3, day=26)])
+        self.stock_collection.Session().commit()
+        num_inserted = self.stock_collection.populate_days(start_date, end_date)
+        assert num_inserted == 2, 'expected 2 days inserted, got %s' % num_inserted
+        days = [day.date for day in session.query(Day).order_by(Day.date)]
+        # no stock has a row on the 27th, so it is not taken as a trading day
+        expected_days = [datetime.date(year=2012, month=3, day=d) for d in [23, 26, 28]]
+        assert days == expected_days, 'expected days %s, found %s' % (expected_days, days)
+        for day in session.query(Day):
+            assert self.stock_collection.day_ids[day.date] == day.id,\
+                   'day index out of step with db for %s' % day.date
+        assert self.stock_collection.populate_days(start_date, end_date) == 0,\
+               'expected existing days to be preserved'
+
+    def testUpdateDbDays(self):
+        """Testing update_db adds days only from the dates each stock loads from
+
+        """
+        session = self.Session()
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=28)
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        self.stock_collection.add_stock(u"AA", None, u"NYSE")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE",
+                                                [dp_A_20120323[2], dp_A_20120326[2]])
+        self.stock_collection.append_cache_rows(u"AA", u"NYSE",
+                                                [dp_AA_20120326[2], dp_AA_20120328[2]])
+        stock = [s for s in self.stock_collection.stocks if s.symbol == u"A"][0]
+        stock.last_db_update = datetime.date(year=2012, month=3, day=26)
+        self.stock_collection.Session().commit()
+        self.stock_collection.update_db()
+        days = [day.date for day in session.query(Day).order_by(Day.date)]
+        # A is loaded to the 26th, so its row on the 23rd is not loaded again
+        expected_days = [datetime.date(year=2012, month=3, day=d) for d in [26, 28]]
+        assert days == expected_days, 'expected days %s, found %s' % (expected_days, days)
+
     def dps_are_in_db(self, dps, to_exclusion=False):
         session = self.Session()
         parsed_dps = []
@@ -399,3 +1138,565 @@ class testCache(unittest.TestCase):
             for dp in parsed_dps:
                 if dp not in existing_dps: return False
         return True
+
+
+class testFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = settings
+        self.saved_settings = save_settings()
+        self.server = start_fake_yahoo(canned_rows)
+        self.settings.yahoo_url = self.server.url
+        self.stock_collection = StockCollection(self.settings)
+        self.stock_collection.wipe()
+        self.stock_collection.create_db()
+
+    def tearDown(self):
+        self.stock_collection.wipe()
+        self.stock_collection.http.close()
+        self.server.shutdown()
+        restore_settings(self.saved_settings)
+
+    def read_cache_files(self):
+        contents = {}
+        for stock in self.stock_collection.stocks:
+            cache_file = open(self.stock_collection.get_cache_file_path(stock.symbol, stock.market))
+            contents[stock.symbol] = cache_file.read()
+            cache_file.close()
+        return contents
+
+    def write_symbols_file(self):
+        symbols_path = self.settings.cache_dir + "/symbols_test.txt"
+        symbols_file = open(symbols_path, 'w')
+        symbols_file.write("Symbol\tName\r\nA\tAgilent\r\nAA\tAlcoa\r\nZZZZ\t\r\n")
+        symbols_file.close()
+        self.settings.symbols_files = [{u'name':u'NYSE', u'file':symbols_path}]
+        return symbols_path
+
+    def testConcurrentFetchMatchesSerial(self):
+        """Testing concurrent cache updates give the same caches as serial ones
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol in [u"A", u"AA", u"AAN", u"ZZZZ"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+        self.settings.fetch_workers = 1
+        self.stock_collection.update_cache()
+        serial_contents = self.read_cache_files()
+        for stock in self.stock_collection.stocks:
+            open(self.stock_collection.get_cache_file_path(stock.symbol, stock.market), 'w').close()
+            os.remove(self.stock_collection.get_cache_index_path(stock.symbol, stock.market))
+            stock.last_cache_update = None
+        self.settings.fetch_workers = 4
+        self.stock_collection.update_cache()
+        concurrent_contents = self.read_cache_files()
+        assert serial_contents == concurrent_contents,\
+               'concurrent fetch gave %s, serial gave %s' % (concurrent_contents, serial_contents)
+        expected = dp_A_20120323[2] + "\n" + dp_A_20120326[2] + "\n" + dp_A_20120327[2] + "\n"
+        assert concurrent_contents[u"A"] == expected,\
+               'unexpected cache contents for A: %s' % concurrent_contents[u"A"]
+        assert concurrent_contents[u"ZZZZ"] == "", 'expected empty cache for unknown symbol'
+        for stock in self.stock_collection.stocks:
+            if stock.symbol == u"ZZZZ":
+                assert stock.last_cache_update is None, 'failed fetch marked as cached'
+            else:
+                assert stock.last_cache_update == self.settings.today,\
+                       'last_cache_update not set for %s' % stock.symbol
+
+    def testHTTPClientReusesConnections(self):
+        """Testing the http client keeps connections alive and decodes gzip
+
+        """
+        client = HTTPClient(5, 5, gzip=True)
+        start_date = datetime.date(year=2012, month=3, day=23)
+        end_date = datetime.date(year=2012, month=3, day=28)
+        bodies = []
+        for symbol in [u"A", u"AA", u"AAN"]:
+            url = self.stock_collection.compose_yahoo_url(symbol, start_date, end_date)
+            bodies.append(client.get(url))
+        client.close()
+        expected = "Date,Open,High,Low,Close,Volume,Adj Close\n" +\
+                   dp_A_20120328[2] + "\n" + dp_A_20120327[2] + "\n" +\
+                   dp_A_20120326[2] + "\n" + dp_A_20120323[2] + "\n"
+        assert bodies[0] == expected, 'unexpected body for A: %s' % bodies[0]
+        stats = client.stats()
+        assert stats['connections'] == 1, 'expected 1 connection, made %s' % stats['connections']
+        assert len(self.server.handler.clients) == 1,\
+               'server saw %s connections' % len(self.server.handler.clients)
+        assert stats['bytes_decoded'] == sum([len(b) for b in bodies]),\
+               'decoded byte count is off'
+        assert stats['bytes_wire'] != stats['bytes_decoded'], 'body was not gzipped'
+
+    def testHTTPClientStaleConnections(self):
+        """Testing a request on a dropped keep-alive connection is retried on a new one
+
+        """
+        client = HTTPClient(5, 5, gzip=True)
+        url = self.stock_collection.compose_yahoo_url(u"A", datetime.date(year=2012, month=3, day=23),
+                                                      datetime.date(year=2012, month=3, day=28))
+        netloc = urlparse(url).netloc
+        # idle connections the server has since dropped
+        stale = [client.checkout('http', netloc)[0] for _ in xrange(3)]
+        for connection in stale:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+            client.checkin('http', netloc, connection)
+        body = client.get(url)
+        client.close()
+        assert body.startswith("Date,Open"), 'unexpected body %s' % body
+        assert client.stats()['connections'] == 4,\
+               'expected 1 new connection, made %s' % (client.stats()['connections'] - 3)
+
+    def testRunReport(self):
+        """Testing the run report counts what a run did
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol in [u"A", u"AA", u"ZZZZ"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+        self.stock_collection.update_cache()
+        self.stock_collection.update_db()
+        report = self.stock_collection.run_report()
+        symbols = report['symbols']
+        assert symbols[u"A"]['fetched'] == 3 and symbols[u"A"]['appended'] == 3,\
+               'bad fetch counters for A: %s' % symbols[u"A"]
+        assert symbols[u"A"]['inserted'] == 3 and symbols[u"AA"]['inserted'] == 3,\
+               'bad insert counters: %s' % symbols
+        assert symbols[u"ZZZZ"]['fetch_failed'] == 1, 'failed fetch not counted'
+        assert report['totals']['inserted'] == 6, 'bad totals %s' % report['totals']
+        for stage in ['fetch_wait', 'http', 'cache_append', 'dedupe', 'parse',
+                      'day_lookup', 'db_insert', 'commit']:
+            assert stage in report['stages'], 'stage %s not timed' % stage
+        assert report['histograms']['http']['count'] == report['http']['requests'] == 3,\
+               'expected every request in the latency histogram, got %s'\
+               % report['histograms']['http']
+        json.dumps(report)
+
+    def testCacheOnly(self):
+        """Testing the cache can be updated from a symbols file without the db
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        symbols_files = self.settings.symbols_files
+        symbols_path = self.write_symbols_file()
+        try:
+            stock_cache = StockCache(self.settings)
+            stock_cache.update_cache()
+            state = stock_cache.read_state()
+            assert state == {u"NYSE_A": self.settings.today, u"NYSE_AA": self.settings.today},\
+                   'bad cache state %s' % state
+            cache_file = open(stock_cache.get_cache_file_path(u"A", u"NYSE"))
+            contents = cache_file.read()
+            cache_file.close()
+            expected = dp_A_20120323[2] + "\n" + dp_A_20120326[2] + "\n" + dp_A_20120327[2] + "\n"
+            assert contents == expected, 'unexpected cache contents for A: %s' % contents
+            stock_cache = StockCache(self.settings)
+            stock_cache.update_cache()
+            assert stock_cache.http.stats()['requests'] == 1,\
+                   'expected only the failed symbol refetched, made %s requests'\
+                   % stock_cache.http.stats()['requests']
+            self.stock_collection.load_symbols(self.settings)
+            self.stock_collection.update_db()
+            num_datapoints = self.stock_collection.Session().query(Datapoint).count()
+            assert num_datapoints == 6, 'expected 6 datapoints loaded, got %s' % num_datapoints
+        finally:
+            self.settings.symbols_files = symbols_files
+            os.remove(symbols_path)
+
+    def testShardedFetch(self):
+        """Testing workers sharing a work queue fetch each symbol once
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        symbols_files = self.settings.symbols_files
+        fetch_shards = self.settings.fetch_shards
+        symbols_path = self.write_symbols_file()
+        queue_path = self.settings.cache_dir + "/queue_test.json"
+        self.settings.fetch_shards = 4
+        try:
+            queue = FileLeaseQueue(queue_path)
+            workers = [StockCache(self.settings), StockCache(self.settings)]
+            completed = [None, None]
+            def work(i):
+                completed[i] = workers[i].update_cache_shards(queue, u"w%s" % i)
+            threads = [threading.Thread(target=work, args=(i,)) for i in [0, 1]]
+            for t in threads: t.start()
+            for t in threads: t.join()
+            assert sorted(completed[0] + completed[1]) == [0, 1, 2, 3],\
+                   'shards not completed once each: %s' % completed
+            requests = sum([worker.http.stats()['requests'] for worker in workers])
+            assert requests == 3, 'expected 3 requests, made %s' % requests
+            cache_file = open(workers[0].get_cache_file_path(u"A", u"NYSE"))
+            contents = cache_file.read()
+            cache_file.close()
+            expected = dp_A_20120323[2] + "\n" + dp_A_20120326[2] + "\n" + dp_A_20120327[2] + "\n"
+            assert contents == expected, 'unexpected cache contents for A: %s' % contents
+            assert workers[0].update_cache_shards(queue, u"w0") == [],\
+                   'claimed a shard already done this round'
+            for queue in [FileLeaseQueue(queue_path), DBLeaseQueue(self.stock_collection.engine)]:
+                queue.reset()
+                shard = queue.claim(u"r1", 1, u"dead", -1)
+                assert shard == 0, 'could not claim the only shard'
+                assert queue.claim(u"r1", 1, u"w1", 60) == 0, 'lapsed lease not reclaimed'
+                assert queue.claim(u"r1", 1, u"w2", 60) is None, 'leased shard claimed twice'
+                assert not queue.renew(u"r1", 0, u"dead", 60), 'renewed a lost lease'
+                assert not queue.complete(u"r1", 0, u"dead"), 'completed a lost lease'
+                assert queue.complete(u"r1", 0, u"w1"), 'could not complete shard'
+                assert queue.claim(u"r1", 1, u"w2", 60) is None, 'claimed a done shard'
+                assert queue.claim(u"r2", 1, u"w2", 60) == 0, 'shard not claimable next round'
+        finally:
+            self.settings.symbols_files = symbols_files
+            self.settings.fetch_shards = fetch_shards
+            for path in [symbols_path, queue_path, queue_path + ".lock"]:
+                if os.path.exists(path): os.remove(path)
+            for symbol in [u"A", u"AA", u"ZZZZ"]:
+                for path in [workers[0].get_cache_file_path(symbol, u"NYSE"),
+                             workers[0].get_cache_index_path(symbol, u"NYSE")]:
+                    if os.path.exists(path): os.remove(path)
+
+    def testAdjustmentRefresh(self):
+        """Testing a readjusted history is refetched and restated for that stock only
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol in [u"A", u"AA"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+        self.stock_collection.update_cache()
+        self.stock_collection.update_db()
+        before = datetime.datetime.utcnow()
+        # a 2 for 1 split: adj_close halves on all of A's rows
+        adjusted = []
+        for line in canned_rows["A"]:
+            [rest, adj_close] = line.rsplit(",", 1)
+            adjusted.append(rest + ",%.2f" % (float(adj_close) / 2))
+        self.server.handler.rows = dict(canned_rows, A=adjusted)
+        self.settings.today = datetime.date(year=2012, month=3, day=28)
+        self.stock_collection.stats.reset()
+        self.stock_collection.update_cache()
+        symbols = self.stock_collection.run_report()['symbols']
+        assert symbols[u"A"].get('adjusted') == 1 and not symbols[u"AA"].get('adjusted'),\
+               'expected only A flagged as adjusted: %s' % symbols
+        contents = self.read_cache_files()
+        assert contents[u"A"] == "".join([line + "\n" for line in sorted(adjusted)]),\
+               'A not refetched whole: %s' % contents[u"A"]
+        expected = "".join([line + "\n" for line in sorted(canned_rows["AA"])])
+        assert contents[u"AA"] == expected, 'unexpected cache contents for AA: %s' % contents[u"AA"]
+        assert self.stock_collection.get_cache_index(u"A", u"NYSE")['restate'],\
+               'A not marked for restating'
+        self.stock_collection.update_db()
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['adj_close'])
+        assert series['adj_close'].tolist() ==\
+               [self.stock_collection.parse_csv_row(line).adj_close for line in sorted(adjusted)],\
+               'A not restated: %s' % series['adj_close']
+        series = self.stock_collection.get_series(u"A", u"NYSE", fields=['adj_close'],
+                                                  as_of=before)
+        assert series['adj_close'].tolist() == [4420, 4495, 4557],\
+               'unexpected series as of before the split: %s' % series['adj_close']
+        assert not self.stock_collection.get_cache_index(u"A", u"NYSE")['restate'],\
+               'restate mark not cleared'
+        series = self.stock_collection.get_series(u"AA", u"NYSE", fields=['adj_close'])
+        assert len(series['adj_close']) == 4, 'expected 4 rows for AA: %s' % series
+
+    def testAdjustmentWindowHole(self):
+        """Testing a cache hole ending inside the adjustment window is filled
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=1)
+        self.settings.today = datetime.date(year=2012, month=3, day=12)
+        rows = [u"2012-03-%02d,43.57,44.30,43.15,44.30,3369400,44.20" % day
+                for day in [1, 2, 5, 6, 7, 8, 9, 12]]
+        self.server.handler.rows = {"A": rows}
+        self.stock_collection.add_stock(u"A", None, u"NYSE")
+        self.stock_collection.append_cache_rows(u"A", u"NYSE", [rows[0], rows[-1]])
+        self.stock_collection.update_cache()
+        contents = self.read_cache_files()[u"A"]
+        assert contents == "".join([line + "\n" for line in rows]),\
+               'hole not filled: %s' % contents
+        plan = self.stock_collection.missing_date_ranges(u"A", u"NYSE", self.settings.start_date,
+                                                         self.settings.today)
+        assert plan == [], 'unexpected plan %s' % plan
+
+    def testMissingCacheFile(self):
+        """Testing a stock whose cache file went missing is fetched anew
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol in [u"A", u"AA"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+        os.remove(self.stock_collection.get_cache_file_path(u"AA", u"NYSE"))
+        self.stock_collection.update_cache()
+        contents = self.read_cache_files()
+        assert contents[u"A"] != "" and contents[u"AA"] != "",\
+               'unexpected cache files %s' % contents
+
+    def testFetchRetries(self):
+        """Testing transient failures are retried and lasting ones kept in the ledger
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        saved = [self.settings.fetch_workers, self.settings.fetch_backoff,
+                 self.settings.fetch_retries, self.settings.http_read_timeout]
+        self.settings.fetch_workers = 1
+        self.settings.fetch_backoff = 0.001
+        try:
+            for symbol in [u"A", u"AA", u"AAN"]:
+                self.stock_collection.add_stock(symbol, None, u"NYSE")
+            self.server.handler.faults = {"A": [503, 'drop'], "AA": [503] * 10}
+            self.stock_collection.update_cache()
+            contents = self.read_cache_files()
+            expected = dp_A_20120323[2] + "\n" + dp_A_20120326[2] + "\n" + dp_A_20120327[2] + "\n"
+            assert contents[u"A"] == expected, 'A not fetched on retry: %s' % contents[u"A"]
+            symbols = self.stock_collection.run_report()['symbols']
+            assert symbols[u"A"]['retried'] == 2 and symbols[u"AA"]['retried'] == 3,\
+                   'unexpected retry counts %s' % symbols
+            failures = self.stock_collection.read_failures()
+            assert failures.keys() == [u"NYSE_AA"] and failures[u"NYSE_AA"]['runs'] == 1 and\
+                   '503' in failures[u"NYSE_AA"]['error'], 'unexpected ledger %s' % failures
+            self.server.handler.faults = {}
+            requests = self.stock_collection.http.stats()['requests']
+            self.stock_collection.update_cache(failed_only=True)
+            assert self.stock_collection.http.stats()['requests'] == requests + 1,\
+                   'expected only AA refetched'
+            assert self.stock_collection.read_failures() == {}, 'ledger not cleared'
+            assert self.read_cache_files()[u"AA"] != "", 'AA not fetched'
+            # a slow server times out every request, until the breaker opens
+            self.server.handler.latency = 0.2
+            self.settings.fetch_retries = 1
+            self.settings.http_read_timeout = 0.05
+            self.settings.today = datetime.date(year=2012, month=3, day=28)
+            stock_collection = StockCollection(self.settings)
+            stock_collection.update_cache()
+            errors = sorted([failure['error'] for failure
+                             in stock_collection.read_failures().values()])
+            assert len(errors) == 3 and errors[0].startswith(u"CircuitOpenError") and\
+                   'timed out' in errors[1], 'unexpected ledger errors %s' % errors
+        finally:
+            [self.settings.fetch_workers, self.settings.fetch_backoff,
+             self.settings.fetch_retries, self.settings.http_read_timeout] = saved
+
+    def testBadResponses(self):
+        """Testing corrupt bodies and malformed rows fail only their symbol
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        saved = [self.settings.fetch_workers, self.settings.fetch_backoff,
+                 self.settings.fetch_retries]
+        self.settings.fetch_workers = 1
+        self.settings.fetch_backoff = 0.001
+        self.settings.fetch_retries = 1
+        try:
+            for symbol in [u"A", u"AA", u"AAN"]:
+                self.stock_collection.add_stock(symbol, None, u"NYSE")
+            self.server.handler.faults = {"A": ['truncate', 'truncate'], "AA": ['malformed']}
+            self.stock_collection.update_cache()
+            contents = self.read_cache_files()
+            assert contents[u"A"] == "" and contents[u"AA"] == "" and contents[u"AAN"] != "",\
+                   'unexpected cache files %s' % contents
+            failures = self.stock_collection.read_failures()
+            assert sorted(failures.keys()) == [u"NYSE_A", u"NYSE_AA"],\
+                   'unexpected ledger %s' % failures
+            assert failures[u"NYSE_A"]['error'].startswith(u"BadResponseError") and\
+                   failures[u"NYSE_AA"]['error'].startswith(u"ValueError"),\
+                   'unexpected ledger errors %s' % failures
+            symbols = self.stock_collection.run_report()['symbols']
+            assert symbols[u"A"]['retried'] == 1, 'truncated body not retried: %s' % symbols
+            # a truncated body retried whole is fetched
+            self.server.handler.faults = {"A": ['truncate']}
+            self.stock_collection.update_cache(failed_only=True)
+            assert self.read_cache_files()[u"A"] != "", 'A not fetched on retry'
+            assert self.stock_collection.read_failures() == {}, 'ledger not cleared'
+        finally:
+            [self.settings.fetch_workers, self.settings.fetch_backoff,
+             self.settings.fetch_retries] = saved
+
+    def testFailuresPerMarket(self):
+        """Testing a symbol failing on one market is in the ledger for that market only
+
+        """
+        start_date = datetime.date(year=2012, month=3, day=23)
+        end_date = datetime.date(year=2012, month=3, day=27)
+        self.settings.fetch_workers = 1
+        self.settings.fetch_retries = 1
+        # the fetch for NYSE is malformed, the one for NASDAQ after it not
+        self.server.handler.faults = {"AA": ['malformed']}
+        try:
+            results = self.stock_collection.refresh_caches([(u"AA", u"NYSE", None),
+                                                            (u"AA", u"NASDAQ", None)],
+                                                           start_date, end_date)
+            assert results[0] is False and results[1], 'unexpected results %s' % results
+            failures = self.stock_collection.read_failures()
+            assert failures.keys() == [u"NYSE_AA"], 'unexpected ledger %s' % failures
+            assert failures[u"NYSE_AA"]['error'].startswith(u"ValueError"),\
+                   'unexpected ledger error %s' % failures
+        finally:
+            # the stocks are not registered, so wipe leaves their files
+            for market in [u"NYSE", u"NASDAQ"]:
+                for path in [self.stock_collection.get_cache_file_path(u"AA", market),
+                             self.stock_collection.get_cache_index_path(u"AA", market)]:
+                    if os.path.exists(path): os.remove(path)
+
+    def testResume(self):
+        """Testing an interrupted cache update resumes and torn appends are cut
+
+        """
+        self.settings.start_date = datetime.date(year=2012, month=3, day=23)
+        self.settings.today = datetime.date(year=2012, month=3, day=27)
+        for symbol in [u"A", u"AA", u"AAN"]:
+            self.stock_collection.add_stock(symbol, None, u"NYSE")
+        # a run that died after finishing A
+        checkpoint = self.stock_collection.open_checkpoint(
+            u"update_cache", self.settings.start_date, self.settings.today, False)
+        checkpoint.mark(u"NYSE_A")
+        log_file = open(self.stock_collection.get_checkpoint_path(), 'a')
+        log_file.write("NYSE_A")
+        log_file.close()
+        self.stock_collection.update_cache()
+        assert self.stock_collection.http.stats()['requests'] == 2,\
+               'expected A skipped, made %s requests' % self.stock_collection.http.stats()['requests']
+        assert not os.path.exists(self.stock_collection.get_checkpoint_path()),\
+               'checkpoint not removed after the run'
+        for stock in self.stock_collection.stocks:
+            assert stock.last_cache_update == self.settings.today,\
+                   'last_cache_update not set for %s' % stock.symbol
+        contents = self.read_cache_files()[u"AA"]
+        path = self.stock_collection.get_cache_file_path(u"AA", u"NYSE")
+        cache_file = open(path, 'a')
+        cache_file.write("2012-03-28,10.06,10.06,9.79\0\0\0\0\0\0")
+        cache_file.close()
+        index = self.stock_collection.get_cache_index(u"AA", u"NYSE")
+        assert self.read_cache_files()[u"AA"] == contents, 'torn row not cut'
+        assert index['rows'] == 3, 'unexpected index after repair %s' % index
+
+    def testCircuitBreaker(self):
+        """Testing the circuit breaker opens, lets a trial through and closes
+
+        """
+        breaker = CircuitBreaker(2, 0.05)
+        breaker.failed('h')
+        assert breaker.allow('h'), 'opened before the threshold'
+        breaker.failed('h')
+        assert not breaker.allow('h'), 'not opened at the threshold'
+        assert breaker.allow('other'), 'another host was refused'
+        time.sleep(0.06)
+        assert breaker.allow('h'), 'no trial let through after the reset time'
+        assert not breaker.allow('h'), 'more than one trial let through'
+        breaker.failed('h')
+        assert not breaker.allow('h'), 'failed trial did not reopen'
+        time.sleep(0.06)
+        assert breaker.allow('h'), 'no second trial'
+        breaker.succeeded('h')
+        assert breaker.allow('h') and breaker.allow('h'), 'successful trial did not close'
+        delays = [backoff_delay(attempt, 1, 4) for attempt in [1, 3, 10]]
+        assert delays[0] <= 1 and delays[1] <= 4 and delays[2] <= 4, 'bad backoff %s' % delays
+
+    def testTokenBucket(self):
+        """Testing the token bucket holds requests to its rate
+
+        """
+        bucket = TokenBucket(50, 1)
+        started = time.time()
+        for foo in xrange(11): bucket.acquire()
+        elapsed = time.time() - started
+        assert elapsed >= 0.18, 'expected 11 tokens to take 0.2s, took %s' % elapsed
+
+
+class testInstrument(unittest.TestCase):
+
+    def testStats(self):
+        """Testing stage timers, counters and histograms
+
+        """
+        stats = Stats()
+        with stats.stage('parse'):
+            time.sleep(0.01)
+        items = list(stats.timed_iter('parse', [1, 2, 3]))
+        assert items == [1, 2, 3], 'timed_iter changed the items: %s' % items
+        stats.count(u"A", 'inserted', 5)
+        stats.count(u"A", 'inserted')
+        stats.count(u"AA", 'inserted', 2)
+        stats.observe('http', 0.001)
+        stats.observe('http', 0.3)
+        stats.observe('http', 60)
+        report = stats.report()
+        assert report['stages']['parse']['calls'] == 5,\
+               'expected 5 parse calls, got %s' % report['stages']['parse']['calls']
+        assert report['stages']['parse']['seconds'] >= 0.01, 'parse stage time too short'
+        assert report['symbols'][u"A"]['inserted'] == 6, 'bad counter for A'
+        assert report['totals']['inserted'] == 8, 'bad total %s' % report['totals']
+        histogram = report['histograms']['http']
+        assert histogram['count'] == 3 and histogram['counts'][0] == 1 and\
+               histogram['counts'][6] == 1 and histogram['counts'][-1] == 1,\
+               'bad histogram %s' % histogram
+        other = Stats()
+        other.merge(report)
+        other.merge(report)
+        merged = other.report()
+        assert merged['stages']['parse']['calls'] == 10 and\
+               merged['totals']['inserted'] == 16 and\
+               merged['histograms']['http']['counts'][-1] == 2,\
+               'bad merged report %s' % merged
+        json.dumps(merged)
+
+    def testProfileStage(self):
+        """Testing a stage can be profiled
+
+        """
+        stats = Stats('parse')
+        with stats.stage('commit'):
+            pass
+        assert stats.profiler is None, 'profiled the wrong stage'
+        with stats.stage('parse'):
+            sorted(range(1000))
+        path = settings.cache_dir + "/test.prof"
+        assert stats.dump_profile(path), 'no profile written'
+        assert os.path.getsize(path) > 0, 'empty profile'
+        os.remove(path)
+
+
+class testBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = settings
+        self.stock_collection = StockCollection(self.settings)
+
+    def testSyntheticHistory(self):
+        """Testing synthetic histories are repeatable and parse
+
+        """
+        start_date = datetime.date(year=2012, month=3, day=1)
+        end_date = datetime.date(year=2012, month=3, day=31)
+        lines = benchmark.synthetic_history(u"QA", start_date, end_date, seed=1)
+        assert lines == benchmark.synthetic_history(u"QA", start_date, end_date, seed=1),\
+               'same seed gave different histories'
+        assert lines != benchmark.synthetic_history(u"QB", start_date, end_date, seed=1),\
+               'different symbols gave the same history'
+        assert len(lines) == 22, 'expected 22 weekdays, got %s' % len(lines)
+        dates = [self.stock_collection.parse_csv_row(line).date for line in lines]
+        assert dates == sorted(dates), 'history not in ascending date order'
+        for line in lines:
+            row = self.stock_collection.parse_csv_row(line)
+            assert row.low <= min(row.open_val, row.close) and\
+                   row.high >= max(row.open_val, row.close),\
+                   'prices out of the day\'s range in %s' % line
+
+    def testRunBenchmarks(self):
+        """Testing a small benchmark run reports each benchmark
+
+        """
+        report = benchmark.run_benchmarks(2, 1, repeat=1, only=['parse', 'dedupe', 'load'])
+        names = [result['benchmark'] for result in report['results']]
+        assert names == ['parse_csv_line', 'parse_csv_row', 'columnar.parse_csv',
+                         'dedupe', 'dedupe', 'dedupe',
+                         'update_stock_in_db', 'update_stock_in_db'],\
+               'unexpected benchmarks %s' % names
+        for result in report['results']:
+            assert result['rows'] >= report['workload']['rows'] and result['best'] >= 0,\
+                   'bad result record %s' % result
+        json.dumps(report)
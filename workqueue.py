@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Josef Assad
+#
+# This file is part of Stock Data Cacher.
+#
+# Stock Data Cacher is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stock Data Cacher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stock Data Cacher.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import json
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+from sqlalchemy import select, and_, or_
+from sqlalchemy.exc import IntegrityError
+from model import fetch_lease_table
+
+# Work distribution for fetching. The symbols are split into shards by
+# a hash of market and symbol, and workers claim one shard at a time
+# from a queue, holding a lease on it until the shard is done. Leases
+# are unix times from the workers' own clocks, which should be kept in
+# step. A round names one pass over all shards, a shard being done for
+# a round once completed in it.
+
+
+def shard_of(symbol, market, num_shards):
+    """Returns the shard of a stock, stable across processes and machines.
+
+    """
+    key = (market + u"_" + symbol).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % num_shards
+
+
+def default_worker_id():
+    return u"%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class FileLeaseQueue(object):
+    """Shard leases kept in a json file and updated under an flock on
+    a lock file beside it, for workers on one machine.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def lock(self):
+        lock_file = open(self.path + ".lock", 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def unlock(self, lock_file):
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def read_leases(self):
+        if not os.path.exists(self.path): return {}
+        queue_file = open(self.path)
+        try:
+            return dict((int(shard), lease) for shard, lease
+                        in json.load(queue_file).items())
+        finally:
+            queue_file.close()
+
+    def write_leases(self, leases):
+        temp_path = self.path + ".tmp"
+        queue_file = open(temp_path, 'w')
+        try:
+            json.dump(leases, queue_file, sort_keys=True)
+        finally:
+            queue_file.close()
+        os.rename(temp_path, self.path)
+
+    def claim(self, round_id, num_shards, worker, lease_seconds):
+        """Takes the lease on a shard not done for round_id and not
+        leased, or whose lease has lapsed.
+
+        Returns the shard, None if there are none left.
+        """
+        lock_file = self.lock()
+        try:
+            leases = self.read_leases()
+            now = time.time()
+            free = [shard for shard in xrange(num_shards)
+                    if leases.get(shard, {}).get('done') != round_id and
+                    leases.get(shard, {}).get('expires', 0) < now]
+            if not free: return None
+            shard = random.choice(free)
+            leases[shard] = {'worker': worker, 'expires': now + lease_seconds,
+                             'done': leases.get(shard, {}).get('done')}
+            self.write_leases(leases)
+            return shard
+        finally:
+            self.unlock(lock_file)
+
+    def renew(self, round_id, shard, worker, lease_seconds):
+        """Extends the worker's lease on shard.
+
+        Returns False if the worker no longer holds it.
+        """
+        lock_file = self.lock()
+        try:
+            leases = self.read_leases()
+            lease = leases.get(shard, {})
+            if lease.get('worker') != worker or lease.get('done') == round_id:
+                return False
+            lease['expires'] = time.time() + lease_seconds
+            self.write_leases(leases)
+            return True
+        finally:
+            self.unlock(lock_file)
+
+    def complete(self, round_id, shard, worker):
+        """Marks shard done for round_id and gives up the lease.
+
+        Returns False if the worker no longer held it.
+        """
+        lock_file = self.lock()
+        try:
+            leases = self.read_leases()
+            if leases.get(shard, {}).get('worker') != worker: return False
+            leases[shard] = {'worker': None, 'expires': 0, 'done': round_id}
+            self.write_leases(leases)
+            return True
+        finally:
+            self.unlock(lock_file)
+
+    def reset(self):
+        lock_file = self.lock()
+        try:
+            self.write_leases({})
+        finally:
+            self.unlock(lock_file)
+
+
+class DBLeaseQueue(object):
+    """Shard leases kept in the db's fetch_lease table, for workers on
+    any number of machines. Leases are taken by conditional updates,
+    so no row locks are held between calls.
+
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        fetch_lease_table.create(engine, checkfirst=True)
+
+    def ensure_shards(self, num_shards):
+        table = fetch_lease_table
+        existing = set([row[0] for row in self.engine.execute(
+            select([table.c.shard]).where(table.c.shard < num_shards))])
+        missing = [{'shard': shard} for shard in xrange(num_shards)
+                   if shard not in existing]
+        if not missing: return
+        try:
+            self.engine.execute(table.insert(), missing)
+        except IntegrityError:
+            # another worker added them first
+            pass
+
+    def claim(self, round_id, num_shards, worker, lease_seconds):
+        """Takes the lease on a shard not done for round_id and not
+        leased, or whose lease has lapsed.
+
+        Returns the shard, None if there are none left.
+        """
+        table = fetch_lease_table
+        self.ensure_shards(num_shards)
+        now = time.time()
+        free = and_(or_(table.c.done == None, table.c.done != round_id),
+                    or_(table.c.expires == None, table.c.expires < now))
+        shards = [row[0] for row in self.engine.execute(
+            select([table.c.shard]).where(and_(table.c.shard < num_shards, free)))]
+        random.shuffle(shards)
+        for shard in shards:
+            result = self.engine.execute(
+                table.update().where(and_(table.c.shard == shard, free)).
+                values(worker=worker, expires=now + lease_seconds))
+            # lost the race for this shard if nothing was updated
+            if result.rowcount == 1: return shard
+        return None
+
+    def renew(self, round_id, shard, worker, lease_seconds):
+        """Extends the worker's lease on shard.
+
+        Returns False if the worker no longer holds it.
+        """
+        table = fetch_lease_table
+        result = self.engine.execute(
+            table.update().where(and_(table.c.shard == shard,
+                                      table.c.worker == worker,
+                                      or_(table.c.done == None,
+                                          table.c.done != round_id))).
+            values(expires=time.time() + lease_seconds))
+        return result.rowcount == 1
+
+    def complete(self, round_id, shard, worker):
+        """Marks shard done for round_id and gives up the lease.
+
+        Returns False if the worker no longer held it.
+        """
+        table = fetch_lease_table
+        result = self.engine.execute(
+            table.update().where(and_(table.c.shard == shard,
+                                      table.c.worker == worker)).
+            values(worker=None, expires=None, done=round_id))
+        return result.rowcount == 1
+
+    def reset(self):
+        self.engine.execute(fetch_lease_table.delete())
+
+
+class Lease(object):
+    """Keeps the lease on a claimed shard renewed from a thread until
+    released. lost is set once a renewal fails, another worker having
+    taken the shard.
+
+    """
+    def __init__(self, queue, round_id, shard, worker, lease_seconds):
+        self.queue         = queue
+        self.round_id      = round_id
+        self.shard         = shard
+        self.worker        = worker
+        self.lease_seconds = lease_seconds
+        self.lost          = False
+        self.released      = threading.Event()
+        self.thread = threading.Thread(target=self.keep_renewed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def keep_renewed(self):
+        while not self.released.wait(self.lease_seconds / 3.0):
+            if not self.queue.renew(self.round_id, self.shard, self.worker,
+                                    self.lease_seconds):
+                self.lost = True
+                return
+
+    def release(self, complete=True):
+        """Stops renewing, and completes the shard unless the lease was
+        lost or complete is false.
+
+        Returns whether the shard was completed.
+        """
+        self.released.set()
+        self.thread.join()
+        if self.lost or not complete: return False
+        return self.queue.complete(self.round_id, self.shard, self.worker)